@@ -0,0 +1,364 @@
+import io
+import os
+import hmac
+import json
+import time
+import base64
+import asyncio
+import binascii
+import secrets
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from loguru import logger
+
+from imaging import EncodedImage, is_image_content
+from jobs import JOB_CANCELLED, Job, PRIORITY_NORMAL
+from pipeline import CompiledPipeline
+from templating import TemplateError
+from utils import accepted_options, API_MAX_BODY_BYTES, API_MAX_CONNECTIONS, API_MAX_JOBS, API_PORT, API_TOKEN_FILE
+
+API_HOST = "127.0.0.1"  # Только локальные подключения
+REQUEST_TIMEOUT = 30.0  # На чтение запроса; ожидание результата не ограничено
+MAX_HEADERS = 100
+
+_REASONS = {200: "OK", 400: "Bad Request", 401: "Unauthorized", 404: "Not Found", 405: "Method Not Allowed",
+            408: "Request Timeout", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class ApiError(Exception):
+    """Ошибка запроса: отдается клиенту как {"error": message} с кодом status."""
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+@dataclass
+class ApiRequest:
+    method: str
+    path: str
+    query: Dict[str, str]
+    headers: Dict[str, str]
+    body: bytes = field(repr=False, default=b"")
+
+    def json(self) -> Dict[str, Any]:
+        try:
+            data = json.loads(self.body or b"{}")
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise ApiError(400, f"Invalid JSON body: {e}")
+        if not isinstance(data, dict):
+            raise ApiError(400, "The JSON body must be an object.")
+        return data
+
+
+def load_or_create_token(path: str = API_TOKEN_FILE) -> str:
+    """Читает токен из файла; при первом запуске создает случайный токен, доступный только владельцу."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    token = secrets.token_urlsafe(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(token)
+    logger.info(f"Created a new local API token in {path}.")
+    return token
+
+
+class ApiServer(threading.Thread):
+    """
+    Локальный HTTP API для редакторов и скриптов, работающий с уже запущенным приложением.
+    Слушает только 127.0.0.1, каждый запрос проверяется по токену (заголовок Authorization: Bearer).
+    Задачи идут через ту же очередь JobEngine, кэш и историю, что и задачи из окна, но результат
+    не копируется в буфер обмена. Сервер асинхронный (asyncio в своем потоке); число подключений
+    и одновременных задач ограничено.
+
+    GET /templates, POST /jobs (JSON: template, text или image_base64, stream, history),
+    GET /history?q=&limit=, GET /history/<id>, GET /metrics.
+    """
+    def __init__(self, job_engine: Any, template_manager: Any, history_manager: Any, metrics: Optional[Any] = None,
+                 blob_store: Optional[Any] = None, port: int = API_PORT, token: Optional[str] = None,
+                 max_connections: int = API_MAX_CONNECTIONS, max_jobs: int = API_MAX_JOBS,
+                 max_body_bytes: int = API_MAX_BODY_BYTES):
+        super().__init__(name="ApiServer", daemon=True)
+        self.job_engine = job_engine
+        self.template_manager = template_manager
+        self.history_manager = history_manager
+        self.metrics = metrics
+        self.blob_store = blob_store
+        self.port = port
+        self.token = token or load_or_create_token()
+        self.max_connections = max_connections
+        self.max_jobs = max_jobs
+        self.max_body_bytes = max_body_bytes
+        self.error: Optional[Exception] = None
+        self._ready = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop_event: Optional[asyncio.Event] = None
+        self._job_slots: Optional[asyncio.Semaphore] = None
+        self._connections = 0
+
+    @classmethod
+    def from_settings(cls, settings: Optional[Dict[str, Any]], **services: Any) -> Optional["ApiServer"]:
+        """Создает сервер по разделу "api_server" настроек; None, если он выключен."""
+        options = dict(settings or {})
+        if not options.pop("enabled", False):
+            return None
+        return cls(**services, **accepted_options(cls, options, "api_server", provided=services))
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Ждет, пока сервер начнет принимать подключения (или не сможет запуститься)."""
+        return self._ready.wait(timeout) and self.error is None
+
+    def run(self) -> None:
+        try:
+            asyncio.run(self._serve())
+        except Exception as e:
+            self.error = e
+            logger.opt(exception=True).error(f"Local API server stopped: {e}")
+        finally:
+            self._ready.set()
+
+    def stop(self) -> None:
+        if self._loop is not None and self._stop_event is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+
+    async def _serve(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._stop_event = asyncio.Event()
+        self._job_slots = asyncio.Semaphore(self.max_jobs)
+        server = await asyncio.start_server(self._handle_connection, API_HOST, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        logger.info(f"Local API listening on http://{API_HOST}:{self.port} "
+                    f"(max {self.max_connections} connections, {self.max_jobs} jobs).")
+        self._ready.set()
+        async with server:
+            await self._stop_event.wait()
+        logger.info("Local API server stopped.")
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections += 1
+        try:
+            if self._connections > self.max_connections:
+                raise ApiError(503, "Too many connections.")
+            try:
+                request = await asyncio.wait_for(self._read_request(reader), REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                raise ApiError(408, "Timed out reading the request.")
+            self._authorize(request)
+            await self._route(request, writer)
+        except ApiError as e:
+            await self._send_json(writer, e.status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            logger.debug("Local API client disconnected.")
+        except Exception as e:
+            logger.opt(exception=True).error(f"Local API request failed: {e}")
+            await self._send_json(writer, 500, {"error": "Internal error. See the application log."})
+        finally:
+            self._connections -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> ApiRequest:
+        try:
+            method, target, _version = (await reader.readline()).decode("latin-1").split()
+        except ValueError:
+            raise ApiError(400, "Malformed request line.")
+        headers: Dict[str, str] = {}
+        for _ in range(MAX_HEADERS):
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        else:
+            raise ApiError(400, "Too many headers.")
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise ApiError(400, "Invalid Content-Length.")
+        if length > self.max_body_bytes:
+            raise ApiError(413, f"The body is larger than {self.max_body_bytes} bytes.")
+        body = await reader.readexactly(length) if length > 0 else b""
+        url = urlsplit(target)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        return ApiRequest(method.upper(), url.path.rstrip("/") or "/", query, headers, body)
+
+    def _authorize(self, request: ApiRequest) -> None:
+        scheme, _, token = request.headers.get("authorization", "").partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(token.strip().encode(), self.token.encode()):
+            raise ApiError(401, "Missing or invalid token.")
+
+    async def _route(self, request: ApiRequest, writer: asyncio.StreamWriter) -> None:
+        parts = request.path.strip("/").split("/")
+        resource = parts[0]
+        if resource not in ("templates", "jobs", "history", "metrics") or len(parts) > (2 if resource == "history" else 1):
+            raise ApiError(404, f"Unknown path {request.path}.")
+        expected = "POST" if resource == "jobs" else "GET"
+        if request.method != expected:
+            raise ApiError(405, f"Use {expected} for /{resource}.")
+        if resource == "jobs":
+            await self._submit_job(request, writer)
+            return
+        if len(parts) == 2:
+            payload = await asyncio.to_thread(self._history_entry, parts[1])
+        else:
+            handler = {"templates": self._list_templates, "history": self._history, "metrics": self._metrics}[resource]
+            payload = await asyncio.to_thread(handler, request)
+        await self._send_json(writer, 200, payload)
+
+    def _list_templates(self, _request: ApiRequest) -> Dict[str, Any]:
+        templates = [{"name": template.name, "description": template.description, "input_type": template.input_type,
+                      "pipeline": isinstance(template, CompiledPipeline)}
+                     for template in self.template_manager.get_templates()]
+        return {"templates": templates}
+
+    def _history(self, request: ApiRequest) -> Dict[str, Any]:
+        try:
+            limit = max(1, min(int(request.query.get("limit", 20)), 200))
+        except ValueError:
+            raise ApiError(400, "limit must be an integer.")
+        entries = self.history_manager.search(request.query.get("q", ""), limit)
+        return {"entries": [{"id": entry.id, "timestamp": entry.timestamp.isoformat(), "template": entry.template_name,
+                             "preview": entry.source_preview, "model": entry.model} for entry in entries]}
+
+    def _history_entry(self, entry_id: str) -> Dict[str, Any]:
+        if not entry_id.isdigit():
+            raise ApiError(404, f"Unknown history entry '{entry_id}'.")
+        entry = self.history_manager.get_entry(int(entry_id))
+        if entry is None:
+            raise ApiError(404, f"Unknown history entry '{entry_id}'.")
+        source: Dict[str, Any] = {"text": entry.source_content}
+        if isinstance(entry.source_content, EncodedImage):
+            source = {"mime_type": entry.source_content.mime_type,
+                      "image_base64": base64.b64encode(entry.source_content.data).decode("ascii")}
+        return {"id": entry.id, "timestamp": entry.timestamp.isoformat(), "template": entry.template_name,
+                "model": entry.model, "source": source, "result": entry.result_text}
+
+    def _metrics(self, _request: ApiRequest) -> Dict[str, Any]:
+        if self.metrics is None:
+            raise ApiError(404, "Metrics are not available.")
+        return self.metrics.snapshot()
+
+    def _parse_job(self, data: Dict[str, Any]) -> Tuple[Any, Any]:
+        """Возвращает (шаблон, контент) из тела POST /jobs. Вызывается в рабочем потоке: декодирует изображение."""
+        name = data.get("template")
+        if not isinstance(name, str) or not name:
+            raise ApiError(400, "'template' is required.")
+        try:
+            template = self.template_manager.resolve(name)
+        except TemplateError as e:
+            raise ApiError(400, f"Pipeline '{name}' cannot run: {e}")
+        if template is None:
+            raise ApiError(404, f"Unknown template '{name}'.")
+
+        if isinstance(data.get("text"), str):
+            content: Any = data["text"].strip()
+            if not content:
+                raise ApiError(400, "'text' is empty.")
+        elif isinstance(data.get("image_base64"), str):
+            from PIL import Image, UnidentifiedImageError
+            try:
+                with Image.open(io.BytesIO(base64.b64decode(data["image_base64"], validate=True))) as image:
+                    image.load()
+                    content = self.blob_store.put_image(image) if self.blob_store is not None else image.copy()
+            except (binascii.Error, UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+                raise ApiError(400, f"Could not decode 'image_base64': {e}")
+        else:
+            raise ApiError(400, "Either 'text' or 'image_base64' is required.")
+
+        is_image = is_image_content(content)
+        if template.input_type != ("image" if is_image else "text"):
+            raise ApiError(400, f"Template '{name}' takes {template.input_type} input.")
+        return template, content
+
+    async def _submit_job(self, request: ApiRequest, writer: asyncio.StreamWriter) -> None:
+        data = request.json()
+        template, content = await asyncio.to_thread(self._parse_job, data)
+        stream = (bool(data.get("stream")) and not isinstance(template, CompiledPipeline)
+                  and template.stream is not False)
+        save_history = data.get("history", True) is not False
+        events: asyncio.Queue = asyncio.Queue()
+        loop = self._loop
+
+        def on_complete(job: Job) -> None:
+            # Рабочий поток JobEngine: история и метрики пишутся здесь, клиент получает результат в цикле asyncio
+            if job.result is not None and save_history:
+                try:
+                    self.history_manager.add_entry(job.content, job.template.name, job.result, model=job.answered_by)
+                except Exception as e:
+                    logger.opt(exception=True).error(f"Could not save API job {job} to history: {e}")
+            job.trace.finish(ok=job.result is not None)
+            if self.metrics is not None:
+                self.metrics.record(job.trace)
+            loop.call_soon_threadsafe(events.put_nowait, ("done", job))
+
+        async with self._job_slots:
+            job = Job(template, content, priority=PRIORITY_NORMAL, source="api", stream=stream,
+                      on_complete=on_complete,
+                      on_chunk=(lambda text: loop.call_soon_threadsafe(events.put_nowait, ("chunk", text)))
+                      if stream else None)
+            started = time.perf_counter()
+            self.job_engine.submit(job)
+            if stream:
+                await self._start_stream(writer)
+            while True:
+                kind, payload = await events.get()
+                if kind == "chunk":
+                    await self._send_stream_line(writer, {"chunk": payload})
+                    continue
+                break
+
+        outcome = {"id": job.id, "template": template.name, "ok": job.result is not None, "status": job.status,
+                   "result": job.result,
+                   "model": job.answered_by, "elapsed_ms": round((time.perf_counter() - started) * 1000, 1)}
+        if job.error:
+            outcome["error"] = job.error
+        if job.pipeline_result is not None:
+            outcome["outputs"] = job.pipeline_result.output_texts()
+        if job.trace.segments:
+            outcome["segments"] = job.trace.segments
+        logger.info(f"Local API job {job} answered in {outcome['elapsed_ms']:.0f} ms.")
+        if stream:
+            await self._send_stream_line(writer, {"done": True, **outcome})
+            await self._end_stream(writer)
+        else:
+            # Задача отменена остановкой приложения — это не ошибка модели
+            status = 200 if outcome["ok"] else 503 if job.status == JOB_CANCELLED else 500
+            await self._send_json(writer, status, outcome)
+
+    @staticmethod
+    async def _send_json(writer: asyncio.StreamWriter, status: int, payload: Dict[str, Any]) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body)
+        try:
+            await writer.drain()
+        except ConnectionError:
+            logger.debug("Local API client disconnected before the response was sent.")
+
+    @staticmethod
+    async def _start_stream(writer: asyncio.StreamWriter) -> None:
+        """Потоковый ответ: JSON-строки (NDJSON) в chunked-кодировке, по строке на фрагмент."""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson; charset=utf-8\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _send_stream_line(writer: asyncio.StreamWriter, payload: Dict[str, Any]) -> None:
+        line = json.dumps(payload, ensure_ascii=False).encode("utf-8") + b"\n"
+        writer.write(f"{len(line):x}\r\n".encode("ascii") + line + b"\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _end_stream(writer: asyncio.StreamWriter) -> None:
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
@@ -1,29 +1,190 @@
 import os
+import time
 import queue
 import threading
 import tkinter
 from tkinter import Menu, messagebox
-from typing import Optional, Any
+from typing import TYPE_CHECKING, Optional, Any, List
 
 import customtkinter as ctk
-from loguru import logger
-from PIL import Image, ImageDraw, ImageFont
-import PIL
 import pyperclip
-from pystray import Icon as TrayIcon, MenuItem as TrayItem
+from loguru import logger
 
 import utils
-from managers import SettingsManager, TemplateManager, HistoryManager
-from services import LLMService, SoundService
-from background import ClipboardMonitor, HotkeyListener
-from utils import APP_NAME, GLOBAL_HOTKEY
+from blobstore import BlobStore, ImageHandle
+from managers import SettingsManager, TemplateManager, TemplateChanges, TemplateWatcher, HistoryManager
+from imaging import is_image_content
+from metrics import STAGES as METRIC_STAGES, MetricsRegistry
+from profiling import SamplingProfiler, StallMonitor, StartupProfile
+from sound import SoundService
+from templating import TemplateError
+from textview import ChunkedTextWriter
+from utils import APP_NAME, GLOBAL_HOTKEY, HISTORY_MAX_ENTRIES, HISTORY_MAX_BYTES, NotifyingQueue
+
+if TYPE_CHECKING:
+    # jobs, services и speculation импортируются в фоне после первой отрисовки (см. _init_llm_service)
+    from jobs import Job, JobEngine
+    from services import LLMService
+    from speculation import Speculator
+
+# Тяжелые модули (Gemini SDK, pystray, pynput, PIL) импортируются при первом использовании
+# или в фоне после первой отрисовки окна, чтобы не задерживать запуск.
+
+
+class HistorySearchDialog(ctk.CTkToplevel):
+    """
+    Окно поиска по истории. Запрос выполняется по FTS-индексу с задержкой
+    после ввода; в список загружаются только заголовки записей.
+    """
+    SEARCH_DELAY_MS = 200
+    RESULT_LIMIT = 200
+
+    def __init__(self, master: ctk.CTk, history_manager: HistoryManager, on_select, font: ctk.CTkFont):
+        super().__init__(master)
+        self.title("History search")
+        self.geometry("640x420")
+        self.history_manager = history_manager
+        self.on_select = on_select
+        self._entry_ids: list[int] = []
+        self._search_job: Optional[str] = None
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+        self.query_entry = ctk.CTkEntry(self, placeholder_text="Search source and result text...", font=font)
+        self.query_entry.grid(row=0, column=0, padx=10, pady=10, sticky="ew")
+        self.query_entry.bind("<KeyRelease>", self._schedule_search)
+        self.query_entry.bind("<Return>", lambda _event: self._choose())
+        self.results_list = tkinter.Listbox(self, activestyle="none", bg="#2D2D2D", fg="white",
+                                            selectbackground="#1F6AA5", borderwidth=0, highlightthickness=0,
+                                            font=(font.cget("family"), font.cget("size") - 1))
+        self.results_list.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="nsew")
+        self.results_list.bind("<Double-Button-1>", lambda _event: self._choose())
+        self.results_list.bind("<Return>", lambda _event: self._choose())
+
+        self._run_search()
+        self.after(100, self.query_entry.focus_set)
+
+    def _schedule_search(self, _event=None) -> None:
+        if self._search_job:
+            self.after_cancel(self._search_job)
+        self._search_job = self.after(self.SEARCH_DELAY_MS, self._run_search)
+
+    def _run_search(self) -> None:
+        self._search_job = None
+        entries = self.history_manager.search(self.query_entry.get(), limit=self.RESULT_LIMIT)
+        self._entry_ids = [entry.id for entry in entries]
+        self.results_list.delete(0, "end")
+        self.results_list.insert("end", *[str(entry) for entry in entries])
+        if entries:
+            self.results_list.selection_set(0)
+
+    def _choose(self) -> None:
+        selection = self.results_list.curselection()
+        if not selection:
+            return
+        self.on_select(self._entry_ids[selection[0]])
+        self.destroy()
+
+class StatsDialog(ctk.CTkToplevel):
+    """
+    Панель статистики: перцентили этапов обработки по шаблонам и моделям,
+    счетчики кэша и дублирующих запросов. Обновляется, пока окно открыто.
+    """
+    REFRESH_MS = 1000
+    MODEL_COUNTS_REFRESH_S = 10.0  # Счетчики моделей читаются из базы истории, поэтому реже остальных
+
+    def __init__(self, master: "AutoReclipperApp", font: ctk.CTkFont):
+        super().__init__(master)
+        self.title("Stats")
+        self.geometry("720x480")
+        self.app = master
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.textbox = ctk.CTkTextbox(self, wrap="none", font=ctk.CTkFont(family="Consolas", size=font.cget("size") - 1))
+        self.textbox.grid(row=0, column=0, columnspan=3, padx=10, pady=10, sticky="nsew")
+        self.path_label = ctk.CTkLabel(self, text="", anchor="w", font=font)
+        self.path_label.grid(row=1, column=0, padx=12, pady=(0, 10), sticky="ew")
+        self.profile_button = ctk.CTkButton(self, text="", width=120, command=self._toggle_profiling, font=font)
+        self.profile_button.grid(row=1, column=1, padx=(10, 0), pady=(0, 10))
+        self.save_button = ctk.CTkButton(self, text="Save JSON", width=100, command=self._save, font=font)
+        self.save_button.grid(row=1, column=2, padx=10, pady=(0, 10))
+        # Пульс mainloop работает, только пока открыта панель
+        self.stall_monitor = StallMonitor(self)
+        self.stall_monitor.start()
+        self.bind("<Destroy>", lambda event: self.stall_monitor.stop() if event.widget is self else None)
+        self._model_counts: dict[str, dict[str, int]] = {}
+        self._model_counts_at = float("-inf")
+        self._refresh()
+
+    def _refresh(self) -> None:
+        if not self.winfo_exists():
+            return
+        sections = [self.app.metrics.format_table(),
+                    f"UI: longest mainloop stall {self.stall_monitor.max_stall_ms:.0f} ms while this panel is open"]
+        if service := self.app.llm_service:
+            sections.append(f"Response cache: {service.cache_stats()}")
+            sections.append(f"Hedging: {service.hedge_stats.as_dict()}")
+        if time.monotonic() - self._model_counts_at >= self.MODEL_COUNTS_REFRESH_S:
+            self._model_counts = self.app.history_manager.model_counts()
+            self._model_counts_at = time.monotonic()
+        sections.append("Answered by (history): " + ("; ".join(
+            f"{template}: {', '.join(f'{model} {count}' for model, count in models.items())}"
+            for template, models in self._model_counts.items()) or "none"))
+        if speculator := self.app.speculator:
+            sections.append(f"Speculation: {speculator.stats.as_dict()}")
+        if engine := self.app.job_engine:
+            sections.append(f"Batching: {engine.batch_stats.as_dict()}")
+        sections.append(f"Image store: {self.app.blob_store.stats.as_dict()}")
+        sections.append(self.app.profiler.summary())
+        self.profile_button.configure(text="Stop profiling" if self.app.profiler.running else "Start profiling")
+        text = "\n\n".join(sections)
+        # Перерисовываем только при изменении, чтобы не сбрасывать прокрутку и выделение
+        if text != self.textbox.get("1.0", "end-1c"):
+            self.textbox.configure(state="normal")
+            self.textbox.delete("1.0", "end")
+            self.textbox.insert("1.0", text)
+            self.textbox.configure(state="disabled")
+        self.after(self.REFRESH_MS, self._refresh)
+
+    def _toggle_profiling(self) -> None:
+        self.app.toggle_profiling()
+        if self.app.profiler.last_report_path and not self.app.profiler.running:
+            self.path_label.configure(text=f"Profile saved to {os.path.abspath(self.app.profiler.last_report_path)}")
+
+    def _save(self) -> None:
+        path = self.app.metrics.path or utils.METRICS_FILE
+        try:
+            self.path_label.configure(text=f"Saved to {os.path.abspath(self.app.metrics.dump(path))}")
+        except OSError as e:
+            self.path_label.configure(text=f"Could not save metrics: {e}")
+
+class ProfileReportDialog(ctk.CTkToplevel):
+    """Сводка отчета профилировщика: самые частые функции по потокам и рост памяти."""
+    def __init__(self, master: "AutoReclipperApp", summary: str, path: Optional[str], font: ctk.CTkFont):
+        super().__init__(master)
+        self.title("Profile")
+        self.geometry("900x560")
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        textbox = ctk.CTkTextbox(self, wrap="none", font=ctk.CTkFont(family="Consolas", size=font.cget("size") - 1))
+        textbox.grid(row=0, column=0, padx=10, pady=10, sticky="nsew")
+        textbox.insert("1.0", summary)
+        textbox.configure(state="disabled")
+        text = f"Full report: {os.path.abspath(path)}" if path else "The report could not be saved."
+        ctk.CTkLabel(self, text=text, anchor="w", font=font).grid(row=1, column=0, padx=12, pady=(0, 10), sticky="ew")
+
 
 class AutoReclipperApp(ctk.CTk):
     """
     Основной класс GUI приложения AutoReclipper.
     """
-    def __init__(self):
+    BACKGROUND_START_FALLBACK_MS = 1000
+
+    def __init__(self, profile: Optional[StartupProfile] = None, exit_after_startup: bool = False):
         super().__init__()
+        self.profile = profile
+        self.exit_after_startup = exit_after_startup
         logger.info("Initializing AutoReclipperApp GUI.")
 
         self.title(APP_NAME)
@@ -31,35 +192,162 @@ class AutoReclipperApp(ctk.CTk):
         self.iconbitmap(icon_path) # for ico
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
 
-        # --- Инициализация менеджеров и сервисов ---
+        # --- Инициализация менеджеров; сервисы LLM создаются в фоне после первой отрисовки ---
         self.settings_manager = SettingsManager()
         self.template_manager = TemplateManager()
-        self.history_manager = HistoryManager()
-        self.llm_service = LLMService()
+        self._mark("settings & templates loaded")
         self.sound_service = SoundService()
+        self.llm_service: Optional["LLMService"] = None
+        self.job_engine: Optional["JobEngine"] = None
+        self.clipboard_monitor: Optional[Any] = None
+        self.hotkey_listener: Optional[Any] = None
+        self.template_watcher: Optional[TemplateWatcher] = None
+        self._jobs_waiting_for_service: List["Job"] = []
+        self._background_started = False
         
-        self.current_content: Optional[str | Image.Image] = None
-        self.processing_thread: Optional[threading.Thread] = None
+        # Текст или ссылка на изображение в blob_store; живой объект PIL окно не хранит
+        self.current_content: Optional[Any] = None
+        self.blob_store = BlobStore()
+        self._displayed_job_id: Optional[int] = None
+        # Тип входа выбранного шаблона; читается потоком ClipboardMonitor без обращения к виджетам
+        self._selected_input_type = "text"
+        self._selected_template_name: Optional[str] = None
+        # Упреждающие запросы по первому копированию (настройка "speculation", по умолчанию выключены)
+        self.speculator: Optional["Speculator"] = None
+        # Локальный HTTP API (настройка "api_server", по умолчанию выключен)
+        self.api_server: Optional[Any] = None
+        self.profiler: Optional[SamplingProfiler] = None
+        self._stream_started = False
         self.app_font: Optional[ctk.CTkFont] = None
         
         # --- ИЗМЕНЕНИЕ: Атрибуты для иконки в трее ---
-        self.tray_icon: Optional[TrayIcon] = None
+        self.tray_icon: Optional[Any] = None
         self.tray_icon_thread: Optional[threading.Thread] = None
 
         self.load_state()
+        self.metrics = MetricsRegistry(path=self.settings.get("metrics_file") or None)
+        self.history_manager = HistoryManager(
+            max_entries=self.settings.get("history_max_entries", HISTORY_MAX_ENTRIES),
+            max_bytes=self.settings.get("history_max_bytes", HISTORY_MAX_BYTES),
+        )
+        self._history_ids: dict[str, int] = {}
+        self._mark("history opened")
         self._setup_ui()
         self.apply_loaded_settings()
         self._setup_app_level_bindings()
+        self._mark("ui built")
+        # Профилировщик ничего не делает, пока его не включат из трея, панели Stats или настройкой
+        self.profiler = SamplingProfiler.from_settings(self.settings.get("profiling"))
+        if (self.settings.get("profiling") or {}).get("enabled"):
+            self.profiler.start()
 
         # --- Фоновые задачи ---
-        self.task_queue = queue.Queue()
-        self.clipboard_monitor = ClipboardMonitor(self.task_queue)
+        # Фоновые потоки будят mainloop виртуальным событием вместо постоянного опроса очереди
+        self._wakeup_pending = threading.Event()
+        self.bind("<<TaskQueued>>", lambda _event: self.drain_task_queue())
+        self.task_queue = NotifyingQueue(notify=self._wake_mainloop)
+
+        # Задачи, поставленные до запуска mainloop, забираем при первом простое
+        self.after_idle(self.drain_task_queue)
+        # Фоновые службы стартуют после первой отрисовки окна (или по таймеру, если окно не показано)
+        self.bind("<Map>", self._on_first_map, add="+")
+        self.after(self.BACKGROUND_START_FALLBACK_MS, self._start_background_services)
+        logger.info("GUI initialization complete.")
+
+    def _mark(self, phase: str) -> None:
+        if self.profile:
+            self.profile.mark(phase)
+
+    def _on_first_map(self, event) -> None:
+        if event.widget is self and not self._background_started:
+            # after_idle выполнится после перерисовки, поставленной в очередь при показе окна
+            self.after_idle(self._start_background_services)
+
+    def _start_background_services(self) -> None:
+        """
+        Запускает фоновые потоки и создает LLMService вне потока интерфейса.
+        Вызывается один раз, после того как окно отрисовано.
+        """
+        if self._background_started:
+            return
+        self._background_started = True
+        self._mark("first paint")
+        # Импорт SDK и настройка клиента — самая долгая часть, поэтому запускается первой
+        threading.Thread(target=self._init_llm_service, name="ServiceInit", daemon=True).start()
+        from background import ClipboardMonitor, HotkeyListener
+
+        self.clipboard_monitor = ClipboardMonitor(self.task_queue, wants_image=lambda: self._selected_input_type == "image",
+                                                  on_first_copy=self._on_first_copy, blob_store=self.blob_store)
         self.clipboard_monitor.start()
         self.hotkey_listener = HotkeyListener(GLOBAL_HOTKEY, lambda: self.task_queue.put(("TOGGLE_VISIBILITY", None)))
         self.hotkey_listener.start()
-        
-        self.after(100, self.check_task_queue)
-        logger.info("GUI initialization complete.")
+        self.template_watcher = TemplateWatcher(self.template_manager, lambda changes: self.task_queue.put(("TEMPLATES_CHANGED", changes)))
+        self.template_watcher.start()
+        self._mark("background threads started")
+
+    def _init_llm_service(self) -> None:
+        """Выполняется в фоновом потоке: импорт SDK и настройка клиентов провайдеров."""
+        try:
+            # jobs и speculation загружаются здесь, а не в потоке интерфейса при первом запросе
+            import jobs, speculation
+            from services import LLMService
+            service = LLMService.from_settings(self.settings)
+            service.init_providers(template.api_provider for template in self.template_manager.get_request_templates())
+        except Exception as e:
+            logger.opt(exception=True).error(f"Failed to initialize LLM service: {e}")
+            service = e
+        self._mark("llm service ready")
+        self.task_queue.put(("SERVICES_READY", service))
+
+    def _on_first_copy(self, content: Any) -> None:
+        """Вызывается из потока ClipboardMonitor при первом копировании нового текста."""
+        if self.speculator:
+            self.speculator.on_first_copy(content)
+
+    def _handle_services_ready(self, service: Any) -> None:
+        """Создает JobEngine и отправляет задачи, поставленные до готовности сервиса."""
+        if isinstance(service, Exception):
+            self.status_label.configure(text="LLM service failed to start. Check logs for details.")
+            messagebox.showerror("Error", f"Failed to initialize the LLM service: {service}")
+            self._jobs_waiting_for_service.clear()
+            return
+        from jobs import JobEngine
+        from speculation import Speculator
+        self.llm_service = service
+        self.job_engine = JobEngine(
+            self.llm_service,
+            on_complete=lambda job: self.task_queue.put(("PROCESSING_COMPLETE", job)),
+            on_chunk=lambda job, text: self.task_queue.put(("PROCESSING_CHUNK", (job.id, text))),
+            on_status_change=lambda status: self.task_queue.put(("JOBS_STATUS", status)),
+            max_workers=self.settings.get("max_concurrent_jobs", 4),
+            concurrency_limits=self.settings.get("concurrency_limits"),
+        )
+        self.speculator = Speculator.from_settings(
+            self.llm_service, self.settings.get("speculation"),
+            get_template=lambda: self.template_manager.get_template(self._selected_template_name),
+            repeat_threshold=self.clipboard_monitor.repeat_threshold if self.clipboard_monitor else 0.5,
+        )
+        if self.speculator:
+            logger.info("Speculative requests on the first copy are enabled.")
+        api_settings = self.settings.get("api_server")
+        if (api_settings or {}).get("enabled"):
+            # api_server тянет asyncio: импортируется, только если сервер включен
+            from api_server import ApiServer
+            self.api_server = ApiServer.from_settings(
+                api_settings, job_engine=self.job_engine, template_manager=self.template_manager,
+                history_manager=self.history_manager, metrics=self.metrics, blob_store=self.blob_store,
+            )
+            self.api_server.start()
+        for job in self._jobs_waiting_for_service:
+            self.job_engine.submit(job)
+        self._jobs_waiting_for_service.clear()
+        if self.settings.get("warm_up_models", True):
+            self.llm_service.warm_up(self.template_manager.get_request_templates())
+        self._mark("job engine ready")
+        if self.profile:
+            print(self.profile.format_report(), flush=True)
+        if self.exit_after_startup:
+            self.after(0, self.on_closing)
 
     def _setup_ui(self) -> None:
         """Создает и настраивает все виджеты интерфейса."""
@@ -77,8 +365,14 @@ class AutoReclipperApp(ctk.CTk):
         self.history_combo.grid(row=0, column=1, padx=5, pady=5, sticky="ew")
         self.history_combo.set("History...")
 
+        self.history_search_button = ctk.CTkButton(top_frame, text="Search", width=60, command=self.open_history_search, font=self.app_font)
+        self.history_search_button.grid(row=0, column=2, padx=5, pady=5)
+
+        self.stats_button = ctk.CTkButton(top_frame, text="Stats", width=60, command=self.open_stats, font=self.app_font)
+        self.stats_button.grid(row=0, column=3, padx=5, pady=5)
+
         self.execute_button = ctk.CTkButton(top_frame, text="Execute", command=self.on_execute_button_click, font=self.app_font)
-        self.execute_button.grid(row=0, column=2, padx=5, pady=5)
+        self.execute_button.grid(row=0, column=4, padx=5, pady=5)
 
         self.accordion_frame = ctk.CTkFrame(self)
         self.accordion_frame.grid(row=1, column=0, padx=10, pady=(0, 10), sticky="ew")
@@ -95,24 +389,43 @@ class AutoReclipperApp(ctk.CTk):
         self.clipboard_textbox = ctk.CTkTextbox(self.clipboard_textbox_frame, wrap="word", height=150, font=self.app_font)
         self.clipboard_textbox.grid(row=0, column=0, sticky="nsew")
         
-        result_frame = ctk.CTkFrame(self)
-        result_frame.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="nsew")
-        result_frame.grid_columnconfigure(0, weight=1)
-        result_frame.grid_rowconfigure(0, weight=1)
-
-        self.result_textbox = ctk.CTkTextbox(result_frame, wrap="word", state="disabled", font=self.app_font)
+        self.result_frame = ctk.CTkFrame(self)
+        self.result_frame.grid(row=2, column=0, padx=10, pady=(0, 10), sticky="nsew")
+        self.result_frame.grid_columnconfigure(0, weight=1)
+        self.result_frame.grid_rowconfigure(0, weight=1)
+        # Результаты параллельных ветвей конвейера показываются рядом, в отдельных колонках
+        self.outputs_frame: Optional[ctk.CTkFrame] = None
+        self.output_views: List[ChunkedTextWriter] = []
+
+        self.result_textbox = ctk.CTkTextbox(self.result_frame, wrap="word", state="disabled", font=self.app_font)
         self.result_textbox.grid(row=0, column=0, sticky="nsew", padx=2, pady=2)
 
+        self.status_label = ctk.CTkLabel(self, text="Ready", anchor="w", font=self.app_font)
+        self.status_label.grid(row=3, column=0, padx=12, pady=(0, 6), sticky="ew")
+
+        # Большие тексты выводятся частями, чтобы не блокировать mainloop
+        preview_chars = self.settings.get("text_preview_max_chars", utils.TEXT_PREVIEW_MAX_CHARS)
+        self.clipboard_view = ChunkedTextWriter(self.clipboard_textbox, max_chars=preview_chars)
+        self.result_view = ChunkedTextWriter(self.result_textbox, readonly=True, max_chars=preview_chars)
+
         self._setup_textbox_context_menu(self.clipboard_textbox)
         self.result_textbox.configure(state="normal")
         self._setup_textbox_context_menu(self.result_textbox)
         self.result_textbox.configure(state="disabled")
 
     def _is_textbox_disabled(self, textbox: ctk.CTkTextbox) -> bool:
-        if textbox is self.result_textbox: return True
-        if textbox is self.clipboard_textbox: return isinstance(self.current_content, Image.Image)
+        if self.result_view.owns(textbox) or any(view.owns(textbox) for view in self.output_views): return True
+        if self.clipboard_view.owns(textbox): return not self.clipboard_view.editable
         return False
 
+    def _full_text_of_selection(self, widget) -> Optional[str]:
+        """Полный текст обрезанного поля, если выделено все его содержимое."""
+        for view in (self.clipboard_view, self.result_view, *self.output_views):
+            if view.owns(widget) and view.truncated:
+                if widget.compare("sel.first", "==", "1.0") and widget.compare("sel.last", ">=", "end-1c"):
+                    return view.full_text
+        return None
+
     def _setup_textbox_context_menu(self, textbox: ctk.CTkTextbox):
         context_menu = Menu(textbox, tearoff=0, bg="#2D2D2D", fg="white", activebackground="#555555", activeforeground="white", bd=0, font=(self.app_font.cget("family"), self.app_font.cget("size") - 1))
         context_menu.add_command(label="Copy", command=lambda: self._handle_app_copy(textbox))
@@ -168,7 +481,8 @@ class AutoReclipperApp(ctk.CTk):
         if isinstance(focused_widget, (ctk.CTkTextbox, tkinter.Text)):
             try:
                 if focused_widget.tag_ranges("sel"):
-                    pyperclip.copy(focused_widget.get("sel.first", "sel.last"))
+                    full_text = self._full_text_of_selection(focused_widget)
+                    pyperclip.copy(full_text if full_text is not None else focused_widget.get("sel.first", "sel.last"))
                     return "break"
             except Exception as e: logger.error(f"Error during copy: {e}")
         return None
@@ -225,8 +539,12 @@ class AutoReclipperApp(ctk.CTk):
         self.withdraw()
         if not self.tray_icon:
             logger.info("Hiding window to system tray.")
+            from pystray import Icon as TrayIcon, MenuItem as TrayItem
             image = self._create_tray_icon_image()
-            menu = (TrayItem('Показать', self.show_from_tray, default=True), TrayItem('Выход', self.on_closing))
+            menu = (TrayItem('Показать', self.show_from_tray, default=True),
+                    TrayItem('Профилирование', lambda: self.task_queue.put(("TOGGLE_PROFILING", None)),
+                             checked=lambda item: self.profiler.running),
+                    TrayItem('Выход', self.on_closing))
             self.tray_icon = TrayIcon(APP_NAME, image, self.title(), menu)
             self.tray_icon_thread = threading.Thread(target=self.tray_icon.run, daemon=True)
             self.tray_icon_thread.start()
@@ -249,8 +567,9 @@ class AutoReclipperApp(ctk.CTk):
         self.lift()
         self.focus_force()
 
-    def _create_tray_icon_image(self) -> Image.Image:
+    def _create_tray_icon_image(self) -> Any:
         """Создает простое изображение для иконки в трее на лету."""
+        from PIL import Image, ImageDraw, ImageFont
         width, height = 64, 64
         image = Image.new('RGB', (width, height), color = 'black')
         draw = ImageDraw.Draw(image)
@@ -262,9 +581,12 @@ class AutoReclipperApp(ctk.CTk):
         return image
 
     def update_window_title(self, template_name: Optional[str] | None = None) -> None:
-        """Обновляет заголовок окна и, при наличии, подсказку иконки в трее."""
+        """Обновляет заголовок окна, подсказку иконки в трее и запоминает тип входа шаблона."""
         if template_name is None:
             template_name = self.template_combo.get()
+        if template := self.template_manager.get_template(template_name):
+            self._selected_input_type = template.input_type
+            self._selected_template_name = template_name
         new_title = f"{template_name} - {APP_NAME}"
         self.title(new_title)
         if self.tray_icon:
@@ -272,99 +594,293 @@ class AutoReclipperApp(ctk.CTk):
 
     def update_ui_for_content(self, content: Any) -> None:
         self.current_content = content
-        self.clipboard_textbox.configure(state="normal")
-        self.clipboard_textbox.delete("1.0", "end")
-        if isinstance(content, str): self.clipboard_textbox.insert("1.0", content)
-        elif isinstance(content, Image.Image):
-            self.clipboard_textbox.insert("1.0", f"[Image detected: {content.width}x{content.height}]")
-            self.clipboard_textbox.configure(state="disabled")
+        if isinstance(content, str): self.clipboard_view.set_text(content)
+        elif isinstance(content, ImageHandle):
+            from PIL import ImageTk
+            caption = (f"[Image detected: {content.width}x{content.height}, "
+                       f"{content.compressed_bytes // 1024} KB stored of {content.raw_bytes // 1024} KB]")
+            self.clipboard_view.set_image(ImageTk.PhotoImage(content.thumbnail()), caption)
+        elif is_image_content(content):
+            self.clipboard_view.set_text(f"[Image detected: {content.width}x{content.height}]", locked=True)
         else:
-            self.clipboard_textbox.insert("1.0", "[No text or image in clipboard]")
-            self.clipboard_textbox.configure(state="disabled")
+            self.clipboard_view.set_text("[No text or image in clipboard]", locked=True)
 
     def on_execute_button_click(self) -> None:
-        if self.processing_thread and self.processing_thread.is_alive():
-            logger.warning("Processing is already in progress.")
-            return
+        if is_image_content(self.current_content):
+            content_to_process = self.current_content
+        elif self.clipboard_view.editable:
+            content_to_process = self.clipboard_textbox.get("1.0", "end-1c").strip()
+        else:
+            # Поле показывает начало текста или еще заполняется: берем текст целиком
+            content_to_process = self.clipboard_view.full_text.strip()
+        self._submit_interactive_job(content_to_process, source="manual")
+
+    def _submit_interactive_job(self, content: Any, source: str, triggered_at: Optional[float] = None,
+                                detect_started: Optional[float] = None) -> None:
+        """
+        Ставит в очередь задачу для выбранного шаблона с интерактивным приоритетом.
+        Для двойного копирования в трассу задачи добавляются этапы detect и dispatch.
+        """
         template_name = self.template_combo.get()
-        template = self.template_manager.get_template(template_name)
+        try:
+            template = self.template_manager.resolve(template_name)
+        except TemplateError as e:
+            messagebox.showerror("Error", f"Pipeline '{template_name}' cannot run: {e}")
+            return
         if not template:
             messagebox.showerror("Error", "Please select a valid template.")
             return
-        content_to_process = self.clipboard_textbox.get("1.0", "end-1c").strip() if not isinstance(self.current_content, Image.Image) else self.current_content
-        if not content_to_process:
+        if not content:
             messagebox.showwarning("Warning", "Input content is empty.")
             return
-        self.set_ui_state("disabled")
+        from jobs import Job, PRIORITY_INTERACTIVE  # Уже загружен фоновым потоком, если сервис успел стартовать
         self.sound_service.play_in()
-        self.processing_thread = threading.Thread(target=self._process_request_thread, args=(template, content_to_process), daemon=True)
-        self.processing_thread.start()
-
-    def _process_request_thread(self, template: dict, content: Any) -> None:
-        logger.info(f"Starting processing thread for template '{template['name']}'.")
-        result = self.llm_service.execute_request(template, content)
-        self.task_queue.put(("PROCESSING_COMPLETE", (result, template, content)))
+        job = Job(
+            template=template,
+            content=content,
+            priority=PRIORITY_INTERACTIVE,
+            source=source,
+            stream=template.stream if template.stream is not None else self.settings.get("stream_responses", False),
+            triggered_at=triggered_at,
+        )
+        if source == "double_copy" and self.speculator:
+            job.speculation = self.speculator.claim(template, content)
+        if triggered_at is not None:
+            if detect_started is not None:
+                job.trace.origin = detect_started
+                job.trace.add_span("detect", detect_started, triggered_at)
+            job.trace.add_span("dispatch", triggered_at, job.submitted_at)
+        # Потоковый вывод показываем только для последней запущенной пользователем задачи
+        self._displayed_job_id = job.id
+        self._stream_started = False
+        if self.job_engine is None:
+            logger.info(f"LLM service is still starting; job {job} will be submitted when it is ready.")
+            self._jobs_waiting_for_service.append(job)
+            self.status_label.configure(text="Starting LLM service...")
+            return
+        self.job_engine.submit(job)
 
-    def _handle_processing_complete(self, result_data: tuple) -> None:
-        result_text, template, source_content = result_data
-        self.set_ui_state("normal")
+    def _handle_processing_chunk(self, chunk_data: tuple) -> None:
+        """Дописывает очередной фрагмент потокового ответа в поле результата."""
+        job_id, text = chunk_data
+        if job_id != self._displayed_job_id:
+            return
+        if not self._stream_started:
+            self._show_single_result()
+            self.result_view.set_text("", follow=True)
+            self._stream_started = True
+        self.result_view.append(text)
+
+    def _handle_processing_complete(self, job: "Job") -> None:
+        handled_at = time.perf_counter()
+        job.trace.add_span("deliver", job.finished_at, handled_at)
+        result_text = job.result
         self.sound_service.play_out()
+        if job.id == self._displayed_job_id:
+            self._displayed_job_id = None
         if result_text is None:
-            messagebox.showerror("API Error", "Failed to get response from the LLM service. Check logs for details.")
+            self._record_job_metrics(job, handled_at)
+            if job.error:
+                messagebox.showerror("Error", f"Cannot run '{job.template.name}'. {job.error}")
+                return
+            unavailable = self.llm_service.resilience.open_circuits() if self.llm_service else []
+            reason = f"Temporarily unavailable after repeated errors: {', '.join(unavailable)}." if unavailable else "Check logs for details."
+            messagebox.showerror("API Error", f"Failed to get response from the LLM service for '{job.template.name}'. {reason}")
             return
-        self.result_textbox.configure(state="normal")
-        self.result_textbox.delete("1.0", "end")
-        self.result_textbox.insert("1.0", result_text)
-        self.result_textbox.configure(state="disabled")
+        pipeline_result = job.pipeline_result
+        if pipeline_result is not None and len(pipeline_result.outputs) > 1:
+            self._show_side_by_side(pipeline_result.output_texts(), pipeline_result.timings_ms)
+        else:
+            self._show_single_result()
+            self.result_view.set_text(result_text)
+        if pipeline_result is not None:
+            logger.info(f"Pipeline job {job} step times, ms: "
+                        + ", ".join(f"{name}={ms:.0f}" for name, ms in pipeline_result.timings_ms.items()))
+        if job.trace.segments:
+            segments = job.trace.segments
+            self.status_label.configure(text=f"Reused {segments['reused']} of {segments['total']} paragraphs "
+                                             f"from cache; sent {segments['sent']} in {segments['requests']} requests.")
+        if self.result_view.truncated:
+            self.status_label.configure(text=f"Showing the beginning of a {len(result_text):,}-character result; "
+                                             f"the full text is in the clipboard.")
+        if self.clipboard_monitor:
+            self.clipboard_monitor.expect_own_update()
         pyperclip.copy(result_text)
-        logger.info("Result copied to clipboard.")
-        self.history_manager.add_entry(source_content, template["name"], result_text)
+        logger.info(f"Result of job {job} copied to clipboard.")
+        self.history_manager.add_entry(job.content, job.template.name, result_text, model=job.answered_by)
         self.update_history_combo()
+        self._record_job_metrics(job, handled_at)
 
-    def check_task_queue(self):
+    def _show_single_result(self) -> None:
+        """Возвращает одно поле результата вместо колонок конвейера."""
+        if self.outputs_frame is None:
+            return
+        for view in self.output_views:
+            view.cancel()
+        self.output_views = []
+        self.outputs_frame.destroy()
+        self.outputs_frame = None
+        self.result_textbox.grid()
+
+    def _show_side_by_side(self, outputs: dict, timings_ms: dict) -> None:
+        """Показывает результаты выходных шагов конвейера в колонках с временем выполнения."""
+        self._show_single_result()
+        self.result_textbox.grid_remove()
+        self.outputs_frame = ctk.CTkFrame(self.result_frame, fg_color="transparent")
+        self.outputs_frame.grid(row=0, column=0, sticky="nsew")
+        self.outputs_frame.grid_rowconfigure(1, weight=1)
+        preview_chars = self.settings.get("text_preview_max_chars", utils.TEXT_PREVIEW_MAX_CHARS)
+        for column, (name, text) in enumerate(outputs.items()):
+            self.outputs_frame.grid_columnconfigure(column, weight=1, uniform="outputs")
+            took = f" ({timings_ms[name] / 1000:.1f} s)" if name in timings_ms else ""
+            ctk.CTkLabel(self.outputs_frame, text=f"{name}{took}", anchor="w", font=self.app_font).grid(
+                row=0, column=column, padx=4, sticky="ew")
+            textbox = ctk.CTkTextbox(self.outputs_frame, wrap="word", font=self.app_font)
+            textbox.grid(row=1, column=column, padx=2, pady=2, sticky="nsew")
+            self._setup_textbox_context_menu(textbox)
+            view = ChunkedTextWriter(textbox, readonly=True, max_chars=preview_chars)
+            view.set_text(text)
+            self.output_views.append(view)
+
+    def _record_job_metrics(self, job: "Job", handled_at: float) -> None:
+        """Закрывает трассу задачи этапом ui и передает ее в метрики."""
+        job.trace.add_span("ui", handled_at)
+        job.trace.finish(ok=job.result is not None)
+        self.metrics.record(job.trace)
+        durations = job.trace.stage_durations()
+        logger.info(f"Job {job} stages, ms: " + ", ".join(f"{stage}={durations[stage] * 1000:.1f}"
+                                                           for stage in METRIC_STAGES if stage in durations))
+
+    def _handle_jobs_status(self, status: dict) -> None:
+        """Показывает состояние очереди задач в строке статуса."""
+        if status["running"] or status["queued"]:
+            text = f"Running: {status['running']} | Queued: {status['queued']}"
+            if status.get("waiting"):
+                text += " | " + "; ".join(status["waiting"])
+            self.status_label.configure(text=text)
+        else:
+            self.status_label.configure(text="Ready")
+
+    def _wake_mainloop(self) -> None:
+        """
+        Вызывается из фоновых потоков после постановки задачи в очередь.
+        Генерирует не более одного события пробуждения до следующей выборки очереди.
+        """
+        if self._wakeup_pending.is_set():
+            return
+        self._wakeup_pending.set()
         try:
-            task_type, data = self.task_queue.get_nowait()
+            self.event_generate("<<TaskQueued>>", when="tail")
+        except (RuntimeError, tkinter.TclError) as e:
+            # mainloop еще не запущен или окно уже уничтожено: задачу заберет after_idle из __init__
+            logger.debug(f"Could not wake up mainloop: {e}")
+            self._wakeup_pending.clear()
+
+    def drain_task_queue(self) -> None:
+        """Обрабатывает все накопившиеся задачи за один проход."""
+        self._wakeup_pending.clear()
+        while True:
+            try:
+                task_type, data = self.task_queue.get_nowait()
+            except queue.Empty:
+                return
             logger.debug(f"Got task from queue: {task_type}")
-            if task_type == "EXECUTE_FROM_CLIPBOARD":
-                self.show_from_tray() # Показываем окно перед выполнением
-                self.after(150, lambda: self.update_ui_for_content(data))
-                self.after(200, self.on_execute_button_click)
-            elif task_type == "PROCESSING_COMPLETE":
-                self._handle_processing_complete(data)
-            elif task_type == "TOGGLE_VISIBILITY":
-                self.toggle_visibility()
-        except queue.Empty: pass
-        finally: self.after(100, self.check_task_queue)
+            try:
+                self._dispatch_task(task_type, data)
+            except Exception as e:
+                logger.opt(exception=True).error(f"Failed to handle task {task_type}: {e}")
+
+    def _dispatch_task(self, task_type: str, data: Any) -> None:
+        if task_type == "EXECUTE_FROM_CLIPBOARD":
+            content, detect_started, triggered_at = data
+            logger.info(f"Double copy reached the GUI thread after {(time.perf_counter() - triggered_at) * 1000:.1f} ms.")
+            # Запрос уходит сразу, окно показывается параллельно
+            self._submit_interactive_job(content.strip() if isinstance(content, str) else content,
+                                         source="double_copy", triggered_at=triggered_at, detect_started=detect_started)
+            self.update_ui_for_content(content)
+            self.show_from_tray()
+        elif task_type == "PROCESSING_CHUNK":
+            self._handle_processing_chunk(data)
+        elif task_type == "PROCESSING_COMPLETE":
+            self._handle_processing_complete(data)
+        elif task_type == "JOBS_STATUS":
+            self._handle_jobs_status(data)
+        elif task_type == "SERVICES_READY":
+            self._handle_services_ready(data)
+        elif task_type == "TEMPLATES_CHANGED":
+            self._handle_templates_changed(data)
+        elif task_type == "TOGGLE_VISIBILITY":
+            self.toggle_visibility()
+        elif task_type == "TOGGLE_PROFILING":
+            self.toggle_profiling()
+
+    def _handle_templates_changed(self, changes: TemplateChanges) -> None:
+        """Обновляет список шаблонов на месте, сохраняя выбор, если шаблон не удален."""
+        names = self.template_manager.get_template_names()
+        current = self.template_combo.get()
+        self.template_combo.configure(values=names)
+        if current not in names and names:
+            self.template_combo.set(names[0])
+        self.update_window_title()
+        if changes.errors:
+            path, error = next(iter(changes.errors.items()))
+            self.status_label.configure(text=f"Template error in {os.path.basename(path)}: {error}")
+        else:
+            self.status_label.configure(text=f"Templates reloaded ({len(names)} available).")
 
     def on_template_select(self, template_name: str):
         if template := self.template_manager.get_template(template_name):
-            logger.info(f"Selected template '{template_name}': {template['description']}")
+            logger.info(f"Selected template '{template_name}': {template.description}")
         self.update_window_title(template_name)
 
     def on_history_select(self, history_str: str):
         if history_str == "History...": return
-        if entry := self.history_manager.get_entry_by_str(history_str):
+        if (entry_id := self._history_ids.get(history_str)) is not None:
+            self.restore_history_entry(entry_id)
+        self.after(100, lambda: self.history_combo.set("History..."))
+
+    def open_history_search(self) -> None:
+        HistorySearchDialog(self, self.history_manager, self.restore_history_entry, self.app_font)
+
+    def open_stats(self) -> None:
+        StatsDialog(self, self.app_font)
+
+    def toggle_profiling(self) -> None:
+        """Включает профилирование или останавливает его и показывает сводку отчета."""
+        if not self.profiler.running:
+            self.profiler.start()
+            self.status_label.configure(text="Profiling... Stop it from the tray menu or the Stats panel to get a report.")
+        else:
+            path = self.profiler.stop()
+            self.status_label.configure(text=f"Profile saved to {os.path.abspath(path)}" if path
+                                        else "Could not save the profile report. Check logs for details.")
+            ProfileReportDialog(self, self.profiler.summary(top=10), path, self.app_font)
+        if self.tray_icon:
+            self.tray_icon.update_menu()
+
+    def restore_history_entry(self, entry_id: int) -> None:
+        """Загружает запись истории целиком и восстанавливает по ней вход, шаблон и результат."""
+        if entry := self.history_manager.get_entry(entry_id):
             logger.info(f"Restoring state from history entry at {entry.timestamp}.")
             self.update_ui_for_content(entry.source_content)
             self.template_combo.set(entry.template_name)
             self.update_window_title(entry.template_name)
-            self.result_textbox.configure(state="normal")
-            self.result_textbox.delete("1.0", "end")
-            self.result_textbox.insert("1.0", entry.result_text)
-            self.result_textbox.configure(state="disabled")
-        self.after(100, lambda: self.history_combo.set("History..."))
+            self._show_single_result()
+            self.result_view.set_text(entry.result_text)
+            if entry.model:
+                self.status_label.configure(text=f"Answered by {entry.model}")
 
     def update_history_combo(self):
-        self.history_combo.configure(values=self.history_manager.get_history_display_list())
-
-    def set_ui_state(self, state: str):
-        self.execute_button.configure(state=state)
-        self.template_combo.configure(state=state)
-        self.history_combo.configure(state=state)
-        self.execute_button.configure(text="Processing..." if state == "disabled" else "Execute")
+        entries = self.history_manager.get_recent()
+        # Для одинаковых строк побеждает самая новая запись
+        self._history_ids = {}
+        for entry in entries:
+            self._history_ids.setdefault(str(entry), entry.id)
+        self.history_combo.configure(values=[str(entry) for entry in entries])
 
     def save_state(self):
         settings = {
+            **self.settings,
             "geometry": self.geometry(),
             "last_template": self.template_combo.get(),
             "font_family": self.app_font.cget("family"),
@@ -394,6 +910,7 @@ class AutoReclipperApp(ctk.CTk):
         elif self.template_manager.get_template_names():
             self.template_combo.set(self.template_manager.get_template_names()[0])
         self.update_window_title()
+        self.update_history_combo()
         logger.info("Loaded settings applied to UI.")
 
     def on_closing(self):
@@ -402,6 +919,22 @@ class AutoReclipperApp(ctk.CTk):
         if self.tray_icon:
             self.tray_icon.stop()
         self.save_state()
-        self.clipboard_monitor.stop()
-        self.hotkey_listener.stop()
+        for service in (self.api_server, self.clipboard_monitor, self.hotkey_listener, self.template_watcher,
+                        self.job_engine):
+            if service:
+                service.stop()
+        if self.speculator:
+            self.speculator.close()
+            logger.info(f"Speculation stats: {self.speculator.stats.as_dict()}")
+        if self.llm_service:
+            self.llm_service.close()
+        if self.metrics.path:
+            try:
+                self.metrics.dump()
+            except OSError as e:
+                logger.warning(f"Could not write metrics to {self.metrics.path}: {e}")
+        if self.profiler.running:
+            self.profiler.stop()
+        self.history_manager.close()
+        self.blob_store.close()
         self.destroy()
\ No newline at end of file
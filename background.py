@@ -1,14 +1,17 @@
 import time
 import threading
 from queue import Queue
-from typing import Callable, Optional
+from typing import Any, Callable, Optional
 import ctypes
 
 import pyperclip
-from PIL import Image, ImageGrab
+from PIL import Image
 from pynput import keyboard
 from loguru import logger
 
+from blobstore import BlobStore
+from clipboard import DoubleCopyDetector, Win32ClipboardSource
+
 try:
     import win32gui
     import win32con
@@ -23,19 +26,23 @@ class ClipboardMonitor(threading.Thread):
     Мониторит буфер обмена с использованием системных сообщений Windows (WM_CLIPBOARDUPDATE).
     Это эффективный, событийно-ориентированный подход.
     """
-    def __init__(self, task_queue: Queue, repeat_threshold: float = 0.5):
+    def __init__(self, task_queue: Queue, repeat_threshold: float = 0.5,
+                 wants_image: Callable[[], bool] = lambda: False,
+                 on_first_copy: Optional[Callable[[Any], None]] = None,
+                 blob_store: Optional[BlobStore] = None):
         if not win32gui:
             raise ImportError("Cannot start ClipboardMonitor because PyWin32 is not installed.")
         
         super().__init__(daemon=True)
         self.task_queue = task_queue
         self.repeat_threshold = repeat_threshold
+        # Изображения передаются дальше ссылкой на хранилище, а не живым объектом PIL
+        self.blob_store = blob_store
         self._stop_event = threading.Event()
         
         self.hwnd: Optional[int] = None
-        self._last_copy_time: float = time.time()
-        self._last_text_content: Optional[str] = None
-        self._ignore_next_update: bool = False
+        self.detector = DoubleCopyDetector(Win32ClipboardSource(), repeat_threshold=repeat_threshold, wants_image=wants_image,
+                                           on_first_copy=on_first_copy)
         
         logger.info("ClipboardMonitor thread initialized (using WM_CLIPBOARDUPDATE).")
 
@@ -77,38 +84,27 @@ class ClipboardMonitor(threading.Thread):
         return win32gui.DefWindowProc(hwnd, msg, wparam, lparam)
 
     def _handle_clipboard_update(self) -> None:
-        if self._ignore_next_update:
-            logger.debug("Ignoring clipboard update due to ignore flag.")
-            self._ignore_next_update = False
-            try: self._last_text_content = pyperclip.paste()
-            except pyperclip.PyperclipException: self._last_text_content = None
-            self._last_copy_time = time.time()
-            return
-
         try:
-            current_text = pyperclip.paste()
-            if isinstance(current_text, str) and current_text:
-                current_time = time.time()
-                time_diff = current_time - self._last_copy_time
-                
-                if (self._last_text_content is not None and
-                    current_text == self._last_text_content and
-                    0.09 < time_diff < self.repeat_threshold):
-                    
-                    logger.info(f"Repeated text copy detected ({time_diff:.2f}s). Queueing task.")
-                    image_content = ImageGrab.grabclipboard()
-                    content_to_send = image_content if isinstance(image_content, Image.Image) else current_text
-                    self.task_queue.put(("EXECUTE_FROM_CLIPBOARD", content_to_send))
-                    self._ignore_next_update = True
-                elif current_text != self._last_text_content:
-                    self._last_text_content = current_text
-                    self._last_copy_time = current_time
+            detect_started = time.perf_counter()
+            content = self.detector.handle_update()
+            if content is not None:
+                if self.blob_store is not None and isinstance(content, Image.Image):
+                    content = self.blob_store.put_image(content)
+                triggered_at = time.perf_counter()
+                logger.info("Queueing task for repeated copy.")
+                self.task_queue.put(("EXECUTE_FROM_CLIPBOARD", (content, detect_started, triggered_at)))
         except (pyperclip.PyperclipException, Image.DecompressionBombError):
-            self._last_text_content = None
-            self._last_copy_time = time.time()
+            self.detector.reset()
         except Exception as e:
             logger.opt(exception=True).error(f"Error handling clipboard update: {e}")
 
+    def expect_own_update(self) -> None:
+        """
+        Сообщает монитору, что следующее обновление буфера сделает само приложение
+        (запись результата), и его не нужно считать пользовательским копированием.
+        """
+        self.detector.expect_own_update()
+
     def stop(self) -> None:
         if self.hwnd:
             logger.info("Stopping ClipboardMonitor thread by posting WM_DESTROY.")
@@ -0,0 +1,105 @@
+"""
+Бенчмарк распознавания двойного копирования на поддельном буфере обмена.
+
+Сравнивает прежнюю логику ClipboardMonitor (полное чтение и сравнение текста
+на каждое уведомление, чтение изображения при срабатывании) с DoubleCopyDetector
+(номер последовательности, проверка форматов, отпечаток вместо текста).
+Каждое копирование сопровождается серией уведомлений, как у приложений,
+записывающих несколько форматов.
+
+Запуск: python benchmarks/bench_clipboard_detector.py [--size-mb 4] [--copies 50]
+"""
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loguru import logger
+from PIL import Image
+
+from clipboard import DoubleCopyDetector, FakeClipboardSource
+
+
+class LegacyDetector:
+    """Логика ClipboardMonitor до перехода на DoubleCopyDetector."""
+    def __init__(self, source: FakeClipboardSource, repeat_threshold: float = 0.5):
+        self.source = source
+        self.repeat_threshold = repeat_threshold
+        self._last_copy_time = 0.0
+        self._last_text_content = None
+
+    def handle_update(self, now: float):
+        current_text = self.source.read_text()
+        if isinstance(current_text, str) and current_text:
+            time_diff = now - self._last_copy_time
+            if current_text == self._last_text_content and 0.09 < time_diff < self.repeat_threshold:
+                image = self.source.read_image()
+                return image if image is not None else current_text
+            elif current_text != self._last_text_content:
+                self._last_text_content = current_text
+                self._last_copy_time = now
+        return None
+
+
+def run(detector_factory, size_mb: float, copies: int, burst: int) -> dict:
+    source = FakeClipboardSource()
+    detector = detector_factory(source)
+    screenshot = Image.new("RGB", (3840, 2160), "white")
+    triggers = 0
+    now = 0.0
+    text = ""
+    tracemalloc.start()
+    started = time.perf_counter()
+    for i in range(copies):
+        text = (f"{i:08d}" * int(size_mb * 1024 * 1024 / 8))
+        # Двойное копирование: два копирования с интервалом 0.2 с, каждое — серия уведомлений
+        for _ in range(2):
+            source.set_text(text, screenshot)
+            for b in range(burst):
+                if b:
+                    source.touch()
+                triggers += detector.handle_update(now=now + b * 0.005) is not None
+            now += 0.2
+        now += 1.0
+    elapsed = time.perf_counter() - started
+    text_reads, image_reads = source.text_reads, source.image_reads
+    # Память, которую детектор удерживает между копированиями
+    source.set_text(None)
+    del text, screenshot
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "triggers": triggers,
+        "ms_per_copy": elapsed * 1000 / (copies * 2),
+        "text_reads": text_reads,
+        "image_reads": image_reads,
+        "retained_kb": retained / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=float, default=4.0, help="Size of the copied text.")
+    parser.add_argument("--copies", type=int, default=30, help="Number of double copies.")
+    parser.add_argument("--burst", type=int, default=3, help="Clipboard notifications per copy.")
+    args = parser.parse_args()
+    logger.remove()
+
+    scenarios = {
+        "legacy": LegacyDetector,
+        "detector (text template)": lambda source: DoubleCopyDetector(source),
+        "detector (image template)": lambda source: DoubleCopyDetector(source, wants_image=lambda: True),
+    }
+    print(f"{'scenario':<28} {'triggers':>8} {'ms/copy':>9} {'text reads':>11} {'image reads':>12} {'retained KB':>12}")
+    for name, factory in scenarios.items():
+        r = run(factory, args.size_mb, args.copies, args.burst)
+        print(f"{name:<28} {r['triggers']:>8} {r['ms_per_copy']:>9.2f} {r['text_reads']:>11} "
+              f"{r['image_reads']:>12} {r['retained_kb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+"""
+Сквозной бенчмарк конвейера без Windows, GUI и сети.
+
+Поддельный буфер обмена (FakeClipboardSource) и DoubleCopyDetector распознают двойное
+копирование в потоке "монитора", поток "GUI" ставит задачи в JobEngine, LLMService
+обращается к FakeProvider с заданным распределением задержки, результат пишется
+обратно в буфер (и пропускается детектором) и в HistoryManager на временной базе.
+Так повторяется путь ClipboardMonitor -> drain_task_queue -> JobEngine -> history.
+
+Сценарии:
+  sequential  — следующее копирование только после результата: задержка от срабатывания до результата;
+  concurrent  — копирования поступают с частотой --rate (0 — сразу все): задачи в секунду под нагрузкой.
+Для каждого сценария считается рост памяти процесса (RSS и, с --tracemalloc, куча Python).
+
+Результаты сохраняются в JSON (--output). С --compare BASELINE.json скрипт завершается
+с кодом 1, если задержки, накладные расходы или пропускная способность хуже базовых
+больше чем на --tolerance (с абсолютным запасом --slack-ms), — это можно использовать как гейт.
+
+Запуск: python benchmarks/bench_e2e.py [--jobs 200] [--workers 4] [--latency-ms 300]
+        [--distribution lognormal] [--output results.json] [--compare baseline.json]
+"""
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import tracemalloc
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loguru import logger
+
+from cache import ResponseCache
+from clipboard import DoubleCopyDetector, FakeClipboardSource
+from jobs import Job, JobEngine, PRIORITY_INTERACTIVE
+from managers import HistoryManager
+from metrics import MetricsRegistry
+from providers import FakeProvider, ProviderRegistry
+from services import LLMService
+from speculation import Speculator
+from templating import compile_template
+from utils import percentile
+
+SCENARIOS = ("sequential", "concurrent")
+RESULTS_VERSION = 1
+TEMPLATE_DATA = {
+    "name": "bench",
+    "description": "End-to-end benchmark template",
+    "api_provider": "fake",
+    "model": "fake-model",
+    "input_type": "text",
+    "prompt": "Fix the text: {clipboard_text}",
+}
+# Интервалы виртуального времени детектора: пауза перед копированием, между двумя Ctrl+C, до записи результата
+IDLE_GAP_S = 1.0
+DOUBLE_COPY_GAP_S = 0.2
+OWN_WRITE_GAP_S = 0.05
+
+
+def current_rss_kb() -> Optional[int]:
+    """Текущий RSS процесса в КБ (psutil или /proc); None, если узнать нельзя."""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss // 1024
+    except ImportError:
+        pass
+    try:
+        with open("/proc/self/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def distribution_summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "p50": round(percentile(values, 50), 2),
+        "p90": round(percentile(values, 90), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(max(values), 2) if values else 0.0,
+    }
+
+
+class HeadlessPipeline:
+    """
+    Конвейер приложения без окна: поток монитора буфера и поток, заменяющий mainloop.
+    Все обращения к буферу и детектору — из потока монитора, как в ClipboardMonitor.
+    """
+    def __init__(self, service: LLMService, history: HistoryManager, workers: int, copy_gap_s: float = 0.0,
+                 speculate: bool = False):
+        self.source = FakeClipboardSource()
+        self.template = compile_template(TEMPLATE_DATA)
+        self.copy_gap_s = copy_gap_s
+        self.speculator = Speculator(service, get_template=lambda: self.template, window=1.0,
+                                     min_chars=1, max_per_minute=100000) if speculate else None
+        self.detector = DoubleCopyDetector(self.source,
+                                           on_first_copy=self.speculator.on_first_copy if self.speculator else None)
+        self.history = history
+        self.metrics = MetricsRegistry()
+        self.clipboard_events: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self.task_queue: "queue.Queue[Optional[tuple]]" = queue.Queue()
+        self.results: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.engine = JobEngine(service, on_complete=lambda job: self.task_queue.put(("PROCESSING_COMPLETE", job)),
+                                max_workers=workers)
+        self._virtual_now = 0.0
+        self._threads = [threading.Thread(target=self._monitor_loop, name="FakeClipboardMonitor", daemon=True),
+                         threading.Thread(target=self._gui_loop, name="FakeMainloop", daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def double_copy(self, text: str) -> None:
+        """Пользователь дважды нажимает Ctrl+C на одном тексте."""
+        self.clipboard_events.put(("copy", text, IDLE_GAP_S))
+        self.clipboard_events.put(("second_copy", text, DOUBLE_COPY_GAP_S))
+
+    def _monitor_loop(self) -> None:
+        while (event := self.clipboard_events.get()) is not None:
+            kind, text, advance = event
+            self._virtual_now += advance
+            if kind == "own_write":
+                self.detector.expect_own_update()
+            elif kind == "second_copy" and self.copy_gap_s:
+                time.sleep(self.copy_gap_s)  # Реальная пауза между Ctrl+C, в которую идет упреждающий запрос
+            self.source.set_text(text)
+            detect_started = time.perf_counter()
+            content = self.detector.handle_update(now=self._virtual_now)
+            if content is not None:
+                self.task_queue.put(("EXECUTE_FROM_CLIPBOARD", (content, detect_started, time.perf_counter())))
+
+    def _gui_loop(self) -> None:
+        while (task := self.task_queue.get()) is not None:
+            task_type, data = task
+            if task_type == "EXECUTE_FROM_CLIPBOARD":
+                content, detect_started, triggered_at = data
+                job = Job(template=self.template, content=content.strip(), priority=PRIORITY_INTERACTIVE,
+                          source="double_copy", triggered_at=triggered_at)
+                job.trace.origin = detect_started
+                job.trace.add_span("detect", detect_started, triggered_at)
+                job.trace.add_span("dispatch", triggered_at, job.submitted_at)
+                if self.speculator:
+                    job.speculation = self.speculator.claim(self.template, job.content)
+                self.engine.submit(job)
+            elif task_type == "PROCESSING_COMPLETE":
+                self._complete(data)
+
+    def _complete(self, job: Job) -> None:
+        handled_at = time.perf_counter()
+        job.trace.add_span("deliver", job.finished_at, handled_at)
+        if job.result is not None:
+            self.clipboard_events.put(("own_write", job.result, OWN_WRITE_GAP_S))
+            self.history.add_entry(job.content, job.template.name, job.result, model=job.answered_by)
+        job.trace.add_span("ui", handled_at)
+        job.trace.finish(ok=job.result is not None)
+        self.metrics.record(job.trace)
+        durations = job.trace.stage_durations()
+        self.results.put({
+            "ok": job.result is not None,
+            "total_ms": durations["total"] * 1000,
+            "network_ms": durations.get("network", 0.0) * 1000,
+        })
+
+    def close(self) -> None:
+        self.engine.stop()
+        self.clipboard_events.put(None)
+        self.task_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+
+def make_text(index: int, size_kb: float) -> str:
+    words = ("lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit")
+    body = " ".join(words[i % len(words)] for i in range(max(1, int(size_kb * 1024 / 6))))
+    return f"Item {index}. {body}"
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> Dict[str, Any]:
+    provider = FakeProvider(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, distribution=args.distribution,
+                            sigma=args.sigma, failure_rate=args.failure_rate, seed=args.seed)
+    registry = ProviderRegistry()
+    registry.register(provider)
+    service = LLMService(cache=ResponseCache(directory=None), providers=registry)
+    arrivals = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        history = HistoryManager(os.path.join(tmp, "history.db"))
+        pipeline = HeadlessPipeline(service, history, workers=args.workers, copy_gap_s=args.copy_gap_ms / 1000,
+                                    speculate=args.speculate)
+        # Прогрев: первые задачи создают пулы потоков, соединение SQLite и т.п.
+        for i in range(args.warmup):
+            pipeline.double_copy(make_text(-1 - i, args.text_kb))
+            pipeline.results.get(timeout=60)
+        pipeline.metrics = MetricsRegistry()
+
+        rss_before = current_rss_kb()
+        heap_before = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        started = time.perf_counter()
+        results = []
+        if name == "sequential":
+            for i in range(args.jobs):
+                pipeline.double_copy(make_text(i, args.text_kb))
+                results.append(pipeline.results.get(timeout=60))
+        else:
+            for i in range(args.jobs):
+                pipeline.double_copy(make_text(i, args.text_kb))
+                if args.rate > 0:
+                    time.sleep(arrivals.expovariate(args.rate))
+            results = [pipeline.results.get(timeout=120) for _ in range(args.jobs)]
+        elapsed = time.perf_counter() - started
+        rss_after = current_rss_kb()
+        heap_after = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+        stages = {row["model"]: row["stages_ms"] for row in pipeline.metrics.snapshot()["by_template_model"]}
+        pipeline.close()
+        history_entries = history.count()
+        history.close()
+    service.close()
+
+    totals = [r["total_ms"] for r in results]
+    overheads = [r["total_ms"] - r["network_ms"] for r in results if r["ok"]]
+    return {
+        "jobs": len(results),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "elapsed_s": round(elapsed, 3),
+        "jobs_per_s": round(len(results) / elapsed, 2),
+        "trigger_to_result_ms": distribution_summary(totals),
+        # Все, кроме времени ответа модели: детектор, очереди, кэш, история
+        "overhead_ms": distribution_summary(overheads),
+        "rss_growth_kb": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+        "py_heap_growth_kb": (heap_after - heap_before) // 1024 if heap_before is not None else None,
+        "history_entries": history_entries,
+        "provider_calls": provider.calls,
+        "speculation": pipeline.speculator.stats.as_dict() if pipeline.speculator else None,
+        "stages_ms": stages,
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Что сравнивается с базовым прогоном: (путь в результатах, чем больше — тем лучше)
+GATED_METRICS = (
+    (("trigger_to_result_ms", "p50"), False),
+    (("trigger_to_result_ms", "p95"), False),
+    (("overhead_ms", "p50"), False),
+    (("overhead_ms", "p95"), False),
+    (("jobs_per_s",), True),
+)
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, slack_ms: float,
+            slack_kb: int) -> List[str]:
+    """Возвращает список регрессий относительно базового прогона."""
+    failures = []
+    if baseline.get("config") != results["config"]:
+        print("WARNING: baseline was recorded with a different configuration; comparison may be meaningless.",
+              file=sys.stderr)
+    for scenario, current in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(scenario)
+        if base is None:
+            continue
+        for path, higher_is_better in GATED_METRICS:
+            now, before = current, base
+            for key in path:
+                now, before = now[key], before[key]
+            name = f"{scenario}.{'.'.join(path)}"
+            if higher_is_better and now < before * (1 - tolerance):
+                failures.append(f"{name}: {now} < {before} - {tolerance:.0%}")
+            elif not higher_is_better and now > before * (1 + tolerance) + slack_ms:
+                failures.append(f"{name}: {now} ms > {before} ms + {tolerance:.0%} + {slack_ms} ms")
+        growth, base_growth = current.get("rss_growth_kb"), base.get("rss_growth_kb")
+        if growth is not None and base_growth is not None and growth > max(base_growth, 0) * (1 + tolerance) + slack_kb:
+            failures.append(f"{scenario}.rss_growth_kb: {growth} KB > {base_growth} KB + {tolerance:.0%} + {slack_kb} KB")
+    return failures
+
+
+def print_report(results: Dict[str, Any]) -> None:
+    print(f"{'scenario':<12} {'jobs/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'overhead p50':>13} {'overhead p95':>13} {'RSS +KB':>9}")
+    for name, result in results["scenarios"].items():
+        latency, overhead = result["trigger_to_result_ms"], result["overhead_ms"]
+        rss = result["rss_growth_kb"]
+        print(f"{name:<12} {result['jobs_per_s']:>8.1f} {latency['p50']:>9.1f} {latency['p95']:>9.1f} "
+              f"{latency['p99']:>9.1f} {overhead['p50']:>13.2f} {overhead['p95']:>13.2f} "
+              f"{rss if rss is not None else 'n/a':>9}")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="JobEngine workers (max_concurrent_jobs).")
+    parser.add_argument("--rate", type=float, default=0.0,
+                        help="Double copies per second in the concurrent scenario (Poisson); 0 sends all at once.")
+    parser.add_argument("--text-kb", type=float, default=2.0)
+    parser.add_argument("--latency-ms", type=float, default=50.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="For the uniform distribution.")
+    parser.add_argument("--distribution", choices=FakeProvider.DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--sigma", type=float, default=0.5, help="For the lognormal distribution.")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--copy-gap-ms", type=float, default=0.0,
+                        help="Real pause between the two copies of a double copy.")
+    parser.add_argument("--speculate", action="store_true", help="Start the request on the first copy.")
+    parser.add_argument("--tracemalloc", action="store_true", help="Also report Python heap growth (slower).")
+    parser.add_argument("--output", help="Write results to this JSON file.")
+    parser.add_argument("--compare", metavar="BASELINE", help="Fail if results regress against this JSON file.")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression (default 10%%).")
+    parser.add_argument("--slack-ms", type=float, default=2.0, help="Allowed absolute latency regression.")
+    parser.add_argument("--slack-kb", type=int, default=4096, help="Allowed absolute RSS growth regression.")
+    args = parser.parse_args()
+    logger.remove()
+
+    config = {key: getattr(args, key) for key in ("jobs", "warmup", "workers", "rate", "text_kb", "latency_ms",
+                                                  "jitter_ms", "distribution", "sigma", "failure_rate", "seed",
+                                                  "copy_gap_ms", "speculate")}
+    if args.tracemalloc:
+        tracemalloc.start()
+    results = {
+        "version": RESULTS_VERSION,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": config,
+        "scenarios": {name: run_scenario(name, args) for name in args.scenarios},
+    }
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        failures = compare(results, baseline, args.tolerance, args.slack_ms, args.slack_kb)
+        for failure in failures:
+            print(f"FAIL: {failure}", file=sys.stderr)
+        if failures:
+            return 1
+        print(f"No regressions against {args.compare}.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+Бенчмарк накладных расходов на первый и последующие запросы к Gemini SDK.
+
+Сравнивает старый путь (новая GenerativeModel на каждый запрос) с пулом моделей
+LLMService без прогрева и с прогревом. Реальный SDK направляется на локальный
+REST-сервер (benchmarks/standin.py), поэтому измеряется только клиентская часть.
+Каждый сценарий запускается в отдельном процессе, чтобы SDK стартовал "с нуля".
+
+Запуск: python benchmarks/bench_model_pool.py [--requests 30]
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ("per_request_model", "pooled", "pooled_warmed")
+TEMPLATE_DATA = {
+    "name": "bench",
+    "description": "Benchmark template",
+    "api_provider": "gemini",
+    "model": "gemini-1.5-flash",
+    "input_type": "text",
+    "prompt": "Echo: {clipboard_text}",
+    "cache": False,
+}
+
+
+def run_scenario(scenario: str, requests: int) -> dict:
+    """Выполняется в дочернем процессе: возвращает задержки запросов в миллисекундах."""
+    import warnings
+    warnings.simplefilter("ignore")
+    from loguru import logger
+    logger.remove()
+
+    from benchmarks.standin import start_standin_server
+    server, url = start_standin_server()
+    os.environ.setdefault("GEMINI_API_KEY", "bench-" + "x" * 40)
+
+    import google.generativeai as genai
+    from cache import ResponseCache
+    from services import LLMService
+    from templating import compile_template
+
+    service = LLMService(cache=ResponseCache(directory=None))
+    template = compile_template(TEMPLATE_DATA)
+    # Провайдер создается до перенастройки SDK, иначе его genai.configure перезапишет адрес стенда
+    service.init_providers([template.api_provider])
+    genai.configure(api_key=os.environ["GEMINI_API_KEY"], transport="rest", client_options={"api_endpoint": url})
+
+    if scenario == "pooled_warmed":
+        service.warm_up([template]).join()
+
+    latencies = []
+    for i in range(requests):
+        started = time.perf_counter()
+        if scenario == "per_request_model":
+            # Поведение до пула: модель создается заново на каждый запрос
+            genai.GenerativeModel(template.model).generate_content(f"Echo: {i}").text
+        else:
+            service.execute_request(template, str(i))
+        latencies.append((time.perf_counter() - started) * 1000)
+    server.shutdown()
+    return {"first_ms": latencies[0], "steady_median_ms": statistics.median(latencies[1:]) if requests > 1 else None}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=30)
+    parser.add_argument("--scenario", choices=SCENARIOS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        print(json.dumps(run_scenario(args.scenario, args.requests)))
+        return
+
+    print(f"{'scenario':<20} {'first request, ms':>18} {'steady median, ms':>18}")
+    for scenario in SCENARIOS:
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--scenario", scenario, "--requests", str(args.requests)],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(f"{scenario:<20} {result['first_ms']:>18.2f} {result['steady_median_ms']:>18.2f}")
+
+
+if __name__ == "__main__":
+    main()
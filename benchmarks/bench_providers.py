@@ -0,0 +1,82 @@
+"""
+Бенчмарк OpenAI-совместимого провайдера: пул keep-alive соединений против
+нового соединения на каждый запрос. Сервер — локальный стенд (benchmarks/standin.py),
+поэтому измеряются только накладные расходы клиента и TCP.
+
+Запуск: python benchmarks/bench_providers.py [--requests 200] [--threads 4]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from loguru import logger
+
+from benchmarks.standin import start_standin_server
+from cache import ResponseCache
+from providers import OpenAICompatibleProvider, ProviderRegistry
+from services import LLMService
+from templating import compile_template
+
+TEMPLATE = compile_template({
+    "name": "bench",
+    "description": "Benchmark template",
+    "api_provider": "local",
+    "model": "local-model",
+    "input_type": "text",
+    "prompt": "Echo: {clipboard_text}",
+    "cache": False,
+})
+
+
+def run(pooled: bool, requests: int, threads: int, stream: bool, url: str) -> dict:
+    provider = OpenAICompatibleProvider("local", url + "/v1", pool_size=threads)
+    registry = ProviderRegistry()
+    registry.register(provider)
+    service = LLMService(cache=ResponseCache(directory=None), providers=registry)
+    on_chunk = (lambda _text: None) if stream else None
+
+    def one(i: int) -> float:
+        started = time.perf_counter()
+        assert service.execute_request(TEMPLATE, str(i), on_chunk=on_chunk) is not None
+        if not pooled:
+            # Поведение без пула: соединение закрывается после каждого запроса
+            provider.pool.close()
+        return (time.perf_counter() - started) * 1000
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        latencies = list(pool.map(one, range(requests)))
+    elapsed = time.perf_counter() - started
+    service.close()
+    return {
+        "median_ms": statistics.median(latencies),
+        "rps": requests / elapsed,
+        "connections": provider.pool.created,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+    logger.remove()
+
+    server, url = start_standin_server(reply="the quick brown fox jumps over the lazy dog")
+    print(f"{'scenario':<34} {'median, ms':>10} {'req/s':>8} {'connections':>12}")
+    for stream in (False, True):
+        for pooled in (False, True):
+            result = run(pooled, args.requests, args.threads, stream, url)
+            name = f"{'keep-alive pool' if pooled else 'connection per request'}{' (stream)' if stream else ''}"
+            print(f"{name:<34} {result['median_ms']:>10.2f} {result['rps']:>8.0f} {result['connections']:>12}")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Бенчмарк и проверка бюджета времени запуска.
+
+Сценарий "import": импорт app_gui в чистом процессе (все, что выполняется до
+создания окна) и проверка, что Gemini SDK, pystray, pynput, asyncio, локальный API,
+сервис LLM и очередь задач при этом не загружаются. Модули, которые загружают сами loguru и customtkinter,
+не считаются: их импорт от приложения не зависит.
+Сценарий "gui" (нужен дисплей): полный запуск main.py --profile-startup
+--exit-after-startup с разбором отчета по фазам и проверкой, что LLMService
+создается в фоновом потоке после первой отрисовки.
+
+Скрипт завершается с кодом 1, если загружен отложенный модуль, LLMService создан
+до отрисовки или (с --budget-ms) медиана импорта или первой отрисовки превышает бюджет.
+Его запускает CI (.github/workflows/startup.yml).
+
+Запуск: python benchmarks/bench_startup.py [--runs 5] [--budget-ms 400] [--paint-budget-ms 1500]
+"""
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули, которые не должны загружаться до первой отрисовки окна
+DEFERRED_MODULES = ("google.generativeai", "google.ai", "grpc", "pystray", "pynput", "background", "asyncio",
+                    "api_server", "services", "providers", "jobs", "speculation")
+
+_BASELINE_PROBE = """
+import sys, json
+import loguru, customtkinter
+print(json.dumps([m for m in %r if m in sys.modules]))
+""" % (DEFERRED_MODULES,)
+
+_IMPORT_PROBE = """
+import sys, time, json
+started = time.perf_counter()
+import app_gui
+elapsed_ms = (time.perf_counter() - started) * 1000
+print(json.dumps({"import_ms": elapsed_ms, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (DEFERRED_MODULES,)
+
+
+def measure_import() -> dict:
+    output = subprocess.run([sys.executable, "-c", _IMPORT_PROBE], cwd=ROOT, capture_output=True,
+                            text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_baseline() -> set:
+    """Отложенные модули, которые загружают уже сами зависимости окна (например, asyncio в loguru)."""
+    output = subprocess.run([sys.executable, "-c", _BASELINE_PROBE], cwd=ROOT, capture_output=True,
+                            text=True, check=True).stdout
+    return set(json.loads(output.strip().splitlines()[-1]))
+
+
+def measure_gui() -> dict:
+    """Запускает приложение до готовности сервисов и возвращает отметки фаз: {фаза: (мс, поток)}."""
+    env = dict(os.environ)
+    env.setdefault("GEMINI_API_KEY", "bench-" + "x" * 40)
+    with tempfile.TemporaryDirectory() as tmp:
+        report_path = os.path.join(tmp, "startup.json")
+        subprocess.run([sys.executable, os.path.join(ROOT, "main.py"), "--profile-startup", report_path,
+                        "--exit-after-startup"], cwd=ROOT, env=env, capture_output=True, timeout=120, check=True)
+        with open(report_path, encoding="utf-8") as f:
+            report = json.load(f)
+    return {phase["phase"]: (phase["at_ms"], phase["thread"]) for phase in report["phases"]}
+
+
+def has_display() -> bool:
+    return sys.platform.startswith("win") or sys.platform == "darwin" or bool(os.environ.get("DISPLAY"))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget-ms", type=float, help="Fail if the median app_gui import time exceeds this.")
+    parser.add_argument("--paint-budget-ms", type=float, help="Fail if the median time to first paint exceeds this.")
+    args = parser.parse_args()
+
+    failures = []
+    imports = [measure_import() for _ in range(args.runs)]
+    import_ms = statistics.median(run["import_ms"] for run in imports)
+    baseline = measure_baseline()
+    loaded = sorted({module for run in imports for module in run["loaded"]} - baseline)
+    print(f"import app_gui: median {import_ms:.0f} ms, min {min(r['import_ms'] for r in imports):.0f} ms "
+          f"over {args.runs} runs")
+    if baseline:
+        print(f"Already loaded by loguru/customtkinter, not checked: {', '.join(sorted(baseline))}")
+    if loaded:
+        failures.append(f"modules loaded before first paint: {', '.join(loaded)}")
+    if args.budget_ms is not None and import_ms > args.budget_ms:
+        failures.append(f"import time {import_ms:.0f} ms exceeds budget {args.budget_ms:.0f} ms")
+
+    if has_display():
+        runs = [measure_gui() for _ in range(args.runs)]
+        for phase in runs[0]:
+            values = [run[phase][0] for run in runs if phase in run]
+            print(f"{phase:<32} median {statistics.median(values):>7.0f} ms")
+        for run in runs:
+            ready = run.get("llm service ready")
+            if ready is None or ready[1] == "MainThread" or ready[0] < run["first paint"][0]:
+                failures.append(f"LLMService was not created in the background after the first paint: {ready}")
+                break
+        paint_ms = statistics.median(run["first paint"][0] for run in runs)
+        if args.paint_budget_ms is not None and paint_ms > args.paint_budget_ms:
+            failures.append(f"first paint {paint_ms:.0f} ms exceeds budget {args.paint_budget_ms:.0f} ms")
+    else:
+        print("No display available: skipping the full GUI startup scenario.")
+
+    for failure in failures:
+        print(f"FAIL: {failure}", file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
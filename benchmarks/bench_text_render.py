@@ -0,0 +1,110 @@
+"""
+Бенчмарк вывода больших текстов в текстовое поле: самое долгое зависание mainloop.
+
+Режим "blocking" — прежний вывод одним insert("1.0", text) в потоке интерфейса;
+режим "chunked" — ChunkedTextWriter (части через after() и обрезка до text_preview_max_chars).
+Зависание измеряет StallMonitor: пульс mainloop каждые 10 мс и самое большое опоздание пульса
+от вставки до конца вывода и перерисовки. Нужен дисплей.
+
+С --budget-ms скрипт завершается с кодом 1, если в режиме chunked зависание больше бюджета.
+
+Запуск: python benchmarks/bench_text_render.py [--sizes-kb 100 1000 5000] [--preview-chars 200000] [--budget-ms 50]
+"""
+import os
+import sys
+import time
+import argparse
+import tkinter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from profiling import StallMonitor
+from textview import ChunkedTextWriter
+from utils import TEXT_PREVIEW_MAX_CHARS
+
+MODES = ("blocking", "chunked")
+SETTLE_MS = 300  # Сколько ждать после вывода, чтобы захватить отложенную перерисовку
+
+
+def make_text(size_kb: int) -> str:
+    line = "2024-05-01 12:00:00,123 INFO worker-7 Processed request id=4821 in 35 ms, status=200, bytes=5120\n"
+    return line * max(1, size_kb * 1024 // len(line))
+
+
+def has_display() -> bool:
+    return sys.platform.startswith("win") or sys.platform == "darwin" or bool(os.environ.get("DISPLAY"))
+
+
+def measure(mode: str, text: str, preview_chars: int) -> dict:
+    root = tkinter.Tk()
+    root.geometry("600x500")
+    widget = tkinter.Text(root, wrap="word")
+    widget.pack(fill="both", expand=True)
+    root.update()
+    monitor = StallMonitor(root, interval_ms=10)
+    writer = ChunkedTextWriter(widget, readonly=True, max_chars=preview_chars)
+    timings = {}
+
+    def start() -> None:
+        monitor.reset()
+        timings["started"] = time.perf_counter()
+        if mode == "blocking":
+            widget.delete("1.0", "end")
+            widget.insert("1.0", text)
+        else:
+            writer.set_text(text)
+        wait_for_render()
+
+    def wait_for_render() -> None:
+        if writer.busy:
+            root.after(5, wait_for_render)
+            return
+        # Отрисовка после вставки тоже входит во время вывода
+        root.update_idletasks()
+        timings["rendered"] = time.perf_counter()
+        root.after(SETTLE_MS, root.quit)
+
+    monitor.start()
+    root.after(50, start)
+    root.mainloop()
+    monitor.stop()
+    shown = len(widget.get("1.0", "end-1c"))
+    root.destroy()
+    return {
+        "max_stall_ms": monitor.max_stall_ms,
+        "render_ms": (timings["rendered"] - timings["started"]) * 1000,
+        "shown_chars": shown,
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes-kb", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--preview-chars", type=int, default=TEXT_PREVIEW_MAX_CHARS,
+                        help="text_preview_max_chars for the chunked mode (0 shows the whole text).")
+    parser.add_argument("--budget-ms", type=float, help="Fail if the chunked mode stalls the mainloop longer.")
+    args = parser.parse_args()
+    if not has_display():
+        print("No display available: this benchmark needs Tk.")
+        return 0
+
+    print(f"{'size, KB':>9} {'mode':<10} {'max stall, ms':>14} {'render, ms':>11} {'shown chars':>12}")
+    worst_chunked = 0.0
+    for size_kb in args.sizes_kb:
+        text = make_text(size_kb)
+        for mode in MODES:
+            result = measure(mode, text, args.preview_chars)
+            if mode == "chunked":
+                worst_chunked = max(worst_chunked, result["max_stall_ms"])
+            print(f"{size_kb:>9} {mode:<10} {result['max_stall_ms']:>14.1f} {result['render_ms']:>11.1f} "
+                  f"{result['shown_chars']:>12}")
+    if args.budget_ms is not None and worst_chunked > args.budget_ms:
+        print(f"FAIL: chunked rendering stalled the mainloop for {worst_chunked:.1f} ms "
+              f"(budget {args.budget_ms:.0f} ms).")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import io
+import os
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Optional
+
+from loguru import logger
+
+from utils import BLOB_DIR, BLOB_DISK_MAX_BYTES, BLOB_MEMORY_BYTES, THUMBNAIL_SIZE
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+
+class ImageUnavailableError(LookupError):
+    """Изображение вытеснено из хранилища (превышены бюджеты памяти и диска): его пикселей больше нет."""
+
+
+@dataclass
+class BlobStats:
+    """Счетчики хранилища изображений."""
+    stored: int = 0
+    deduplicated: int = 0  # Повторные скриншоты, уже лежавшие в хранилище
+    spilled: int = 0  # Вытеснены из памяти на диск
+    evicted: int = 0  # Удалены совсем (превышен бюджет диска)
+    decoded: int = 0
+    memory_bytes: int = 0
+    disk_bytes: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+@dataclass(frozen=True)
+class ImageHandle:
+    """
+    Легкая ссылка на изображение в BlobStore: размеры, режим и маленькая миниатюра (PNG).
+    Пиксели декодируются только в open() — для показа или кодирования в запрос.
+    """
+    key: str
+    width: int
+    height: int
+    mode: str
+    compressed_bytes: int
+    thumbnail_png: bytes = field(repr=False)
+    store: "BlobStore" = field(repr=False, compare=False)
+
+    @property
+    def raw_bytes(self) -> int:
+        """Размер несжатого изображения."""
+        from PIL import Image
+        return self.width * self.height * Image.getmodebands(self.mode)
+
+    def open(self) -> "Image.Image":
+        """
+        Декодирует изображение из хранилища.
+        :raises ImageUnavailableError: если изображение уже вытеснено из хранилища.
+        """
+        return self.store.open(self)
+
+    def thumbnail(self) -> "Image.Image":
+        from PIL import Image
+        image = Image.open(io.BytesIO(self.thumbnail_png))
+        image.load()
+        return image
+
+
+class BlobStore:
+    """
+    Хранилище изображений из буфера обмена, адресуемое хэшем пикселей.
+    Пиксели хранятся сжатыми zlib (быстрый уровень: скриншоты сжимаются в десятки раз),
+    одинаковые скриншоты хранятся один раз. Сверх memory_bytes самые давние данные
+    переносятся на диск, сверх disk_max_bytes — удаляются. Файлы на диске живут одну сессию.
+    """
+    COMPRESS_LEVEL = 1
+
+    def __init__(self, directory: Optional[str] = BLOB_DIR, memory_bytes: int = BLOB_MEMORY_BYTES,
+                 disk_max_bytes: int = BLOB_DISK_MAX_BYTES, thumbnail_size: int = THUMBNAIL_SIZE):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.thumbnail_size = thumbnail_size
+        self.stats = BlobStats()
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._disk: OrderedDict[str, int] = OrderedDict()  # ключ -> размер файла
+        self._handles: Dict[str, ImageHandle] = {}
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._clear_directory()
+        logger.info(f"Initializing BlobStore (dir: {directory}, memory budget: {memory_bytes // (1024 * 1024)} MB, "
+                    f"disk budget: {disk_max_bytes // (1024 * 1024)} MB)")
+
+    def put_image(self, image: "Image.Image") -> ImageHandle:
+        """Сохраняет изображение PIL и возвращает ссылку на него. Повторное изображение не сохраняется заново."""
+        if image.mode in ("P", "PA"):
+            # Хранятся только пиксели и режим: палитра и прозрачность потерялись бы при восстановлении
+            has_alpha = image.mode == "PA" or "transparency" in image.info
+            image = image.convert("RGBA" if has_alpha else "RGB")
+        raw = image.tobytes()
+        hasher = hashlib.sha1(usedforsecurity=False)
+        hasher.update(f"{image.mode}:{image.width}x{image.height}:".encode("ascii"))
+        hasher.update(raw)
+        key = hasher.hexdigest()
+        with self._lock:
+            handle = self._handles.get(key)
+            if handle is not None and (key in self._memory or key in self._disk):
+                self.stats.deduplicated += 1
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                logger.debug(f"Image {image.width}x{image.height} already stored: {key[:12]}")
+                return handle
+
+        data = zlib.compress(raw, self.COMPRESS_LEVEL)
+        del raw
+        handle = ImageHandle(key=key, width=image.width, height=image.height, mode=image.mode,
+                             compressed_bytes=len(data), thumbnail_png=self._make_thumbnail(image), store=self)
+        with self._lock:
+            self._handles[key] = handle
+            self._memory[key] = data
+            self.stats.memory_bytes += len(data)
+            self.stats.stored += 1
+            self._spill_over_budget()
+        logger.info(f"Stored image {image.width}x{image.height} {image.mode}: "
+                    f"{len(data) // 1024} KB compressed ({handle.raw_bytes // 1024} KB raw).")
+        return handle
+
+    def open(self, handle: ImageHandle) -> "Image.Image":
+        """Декодирует изображение по ссылке; ImageUnavailableError — оно уже вытеснено."""
+        from PIL import Image
+        data = self._read(handle.key)
+        if data is None:
+            raise ImageUnavailableError(f"The {handle.width}x{handle.height} image is no longer available: "
+                                        f"it was evicted from the image store. Copy it again.")
+        with self._lock:
+            self.stats.decoded += 1
+        return Image.frombytes(handle.mode, (handle.width, handle.height), zlib.decompress(data))
+
+    def close(self) -> None:
+        """Удаляет файлы сессии с диска."""
+        with self._lock:
+            self._memory.clear()
+            self._disk.clear()
+            self._handles.clear()
+            self.stats.memory_bytes = self.stats.disk_bytes = 0
+        if self.directory:
+            self._clear_directory()
+
+    def _make_thumbnail(self, image: "Image.Image") -> bytes:
+        from PIL import Image
+        scale = min(1.0, self.thumbnail_size / max(image.size))
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        if image.mode not in ("RGB", "RGBA", "L", "LA", "1"):
+            image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        # reducing_gap сначала грубо уменьшает изображение в целое число раз: в разы быстрее для 4K
+        thumbnail = image.resize(size, Image.Resampling.BOX, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        thumbnail.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    def _read(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+            on_disk = key in self._disk
+        if not on_disk:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except OSError as e:
+            logger.warning(f"Could not read spilled image {key[:12]}: {e}")
+            return None
+
+    def _spill_over_budget(self) -> None:
+        """
+        Вызывается под блокировкой: переносит самые давние данные сверх бюджета памяти на диск.
+        Запись под блокировкой редкая и короткая, зато чтение не застает данные между памятью и диском.
+        """
+        # Последнее изображение остается в памяти, даже если оно одно больше бюджета
+        while self.stats.memory_bytes > self.memory_bytes and len(self._memory) > 1:
+            key, data = self._memory.popitem(last=False)
+            self.stats.memory_bytes -= len(data)
+            if not self.directory or not self._write_file(key, data):
+                self._forget(key)
+                continue
+            self._disk[key] = len(data)
+            self.stats.disk_bytes += len(data)
+            self.stats.spilled += 1
+        while self.stats.disk_bytes > self.disk_max_bytes and self._disk:
+            key, size = self._disk.popitem(last=False)
+            self.stats.disk_bytes -= size
+            self._remove_file(key)
+            self._forget(key)
+
+    def _forget(self, key: str) -> None:
+        self._handles.pop(key, None)
+        self.stats.evicted += 1
+        logger.debug(f"Image {key[:12]} evicted from the store.")
+
+    def _write_file(self, key: str, data: bytes) -> bool:
+        try:
+            with open(self._path(key), "wb") as f:
+                f.write(data)
+            return True
+        except OSError as e:
+            logger.warning(f"Could not spill image {key[:12]} to disk: {e}")
+            return False
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.zlib")
+
+    def _remove_file(self, key: str) -> None:
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _clear_directory(self) -> None:
+        try:
+            for name in os.listdir(self.directory):
+                if name.endswith(".zlib"):
+                    os.remove(os.path.join(self.directory, name))
+        except OSError as e:
+            logger.warning(f"Could not clear blob directory {self.directory}: {e}")
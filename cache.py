@@ -0,0 +1,297 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Optional
+
+from loguru import logger
+
+from imaging import EncodedImage, is_pil_image
+from utils import CACHE_DIR, CACHE_MEMORY_ENTRIES, CACHE_DISK_MAX_BYTES, CACHE_TTL_SECONDS
+
+
+def content_hash(content: Any) -> str:
+    """
+    Возвращает SHA-256 от содержимого запроса (текст или байты изображения).
+    """
+    if isinstance(content, EncodedImage):
+        return content.digest
+    hasher = hashlib.sha256()
+    if isinstance(content, str):
+        hasher.update(b"text:")
+        hasher.update(content.encode("utf-8", "surrogatepass"))
+    elif is_pil_image(content):
+        hasher.update(f"image:{content.mode}:{content.width}x{content.height}:".encode("ascii"))
+        hasher.update(content.tobytes())
+    else:
+        hasher.update(b"repr:")
+        hasher.update(repr(content).encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()
+
+
+def make_cache_key(provider: str, model: str, generation_config: str, prompt: str, content: Any) -> str:
+    """
+    Строит ключ кэша из провайдера, модели, параметров генерации (generation_config_key шаблона),
+    готового промпта и хэша контента.
+    """
+    payload = json.dumps([provider, model, generation_config, prompt, content_hash(content)], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8", "surrogatepass")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    """
+    Счетчики попаданий и промахов кэша.
+    """
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    deduplicated: int = 0
+    evictions: int = 0
+
+    @property
+    def hits(self) -> int:
+        return self.memory_hits + self.disk_hits
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "deduplicated": self.deduplicated,
+            "evictions": self.evictions,
+        }
+
+
+@dataclass
+class _Flight:
+    """Запрос, который уже выполняется и ожидается другими потоками."""
+    event: threading.Event = field(default_factory=threading.Event)
+    result: Optional[str] = None
+
+
+class ResponseCache:
+    """
+    Двухуровневый кэш ответов LLM: LRU в памяти и JSON-файлы на диске.
+    Одинаковые запросы, выполняющиеся одновременно, объединяются в один вызов API.
+    """
+    def __init__(self,
+                 directory: Optional[str] = CACHE_DIR,
+                 memory_entries: int = CACHE_MEMORY_ENTRIES,
+                 disk_max_bytes: int = CACHE_DISK_MAX_BYTES,
+                 ttl_seconds: float = CACHE_TTL_SECONDS):
+        self.directory = directory
+        self.memory_entries = memory_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.stats = CacheStats()
+
+        self._memory: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._scan_disk())
+        logger.info(f"Initializing ResponseCache (dir: {self.directory}, memory entries: {memory_entries}, "
+                    f"disk budget: {disk_max_bytes // (1024 * 1024)} MB, ttl: {ttl_seconds:.0f}s)")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Ищет ответ сначала в памяти, затем на диске. Просроченные записи удаляются.
+        """
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                created, value = item
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    logger.debug(f"Cache hit (memory): {key[:12]}")
+                    return value
+                del self._memory[key]
+
+        item = self._read_disk(key)
+        if item is not None:
+            created, value = item
+            if now - created <= self.ttl_seconds:
+                with self._lock:
+                    self._remember(key, created, value)
+                    self.stats.disk_hits += 1
+                logger.debug(f"Cache hit (disk): {key[:12]}")
+                return value
+            self._remove_disk(key)
+
+        with self._lock:
+            self.stats.misses += 1
+        logger.debug(f"Cache miss: {key[:12]}")
+        return None
+
+    def put(self, key: str, value: str) -> None:
+        """Сохраняет ответ в памяти и на диске."""
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, value)
+        self._write_disk(key, created, value)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Optional[str]]) -> Optional[str]:
+        """
+        Возвращает ответ из кэша или вычисляет его. Если такой же запрос уже
+        выполняется в другом потоке, дожидается его результата вместо повторного вызова.
+        Значения None (ошибки) не кэшируются.
+        """
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                # Пока мы проверяли диск, другой поток успел получить ответ
+                return item[1]
+            flight = self._inflight.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = _Flight()
+                self._inflight[key] = flight
+            else:
+                self.stats.deduplicated += 1
+
+        if not is_leader:
+            logger.info(f"Identical request already in flight, waiting for it: {key[:12]}")
+            flight.event.wait()
+            return flight.result
+
+        result: Optional[str] = None
+        try:
+            result = compute()
+            if result is not None:
+                self.put(key, result)
+            return result
+        finally:
+            flight.result = result
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    def clear(self) -> None:
+        """Полностью очищает кэш в памяти и на диске."""
+        with self._lock:
+            self._memory.clear()
+        for path, _, _ in self._scan_disk():
+            self._unlink(path)
+        self._disk_bytes = 0
+        logger.info("Response cache cleared.")
+
+    def _remember(self, key: str, created: float, value: str) -> None:
+        """Кладет запись в LRU и вытесняет самые старые. Вызывается под блокировкой."""
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+            self.stats.evictions += 1
+
+    def _path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read_disk(self, key: str) -> Optional[tuple[float, str]]:
+        if not self.directory:
+            return None
+        path = self._path_for(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return float(data["created"]), data["value"]
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, KeyError, TypeError, ValueError, IOError) as e:
+            logger.warning(f"Corrupted cache file {path}: {e}")
+            self._remove_disk(key)
+            return None
+
+    def _write_disk(self, key: str, created: float, value: str) -> None:
+        if not self.directory:
+            return
+        path = self._path_for(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"created": created, "value": value}, f, ensure_ascii=False)
+            replaced = self._file_size(path)  # Перезапись ключа не должна увеличивать счетчик дважды
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except IOError as e:
+            logger.error(f"Failed to write cache file {path}: {e}")
+            self._unlink(tmp_path)
+            return
+        with self._lock:
+            self._disk_bytes += size - replaced
+            over_budget = self._disk_bytes > self.disk_max_bytes
+        if over_budget:
+            self._enforce_disk_budget()
+
+    def _remove_disk(self, key: str) -> None:
+        if not self.directory:
+            return
+        path = self._path_for(key)
+        size = self._file_size(path)
+        if self._unlink(path):
+            with self._lock:
+                self._disk_bytes = max(0, self._disk_bytes - size)
+
+    def _scan_disk(self) -> list[tuple[str, int, float]]:
+        """Возвращает (путь, размер, mtime) для всех файлов кэша на диске."""
+        entries = []
+        if not self.directory or not os.path.isdir(self.directory):
+            return entries
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _enforce_disk_budget(self) -> None:
+        """Удаляет просроченные и самые старые файлы, пока кэш не уложится в 90% бюджета."""
+        entries = sorted(self._scan_disk(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.disk_max_bytes * 0.9)
+        expire_before = time.time() - self.ttl_seconds
+        removed = 0
+        for path, size, mtime in entries:
+            if total <= target and mtime >= expire_before:
+                break
+            self._unlink(path)
+            total -= size
+            removed += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.stats.evictions += removed
+        logger.info(f"Disk cache trimmed: removed {removed} files, {total // 1024} KB left.")
+
+    @staticmethod
+    def _unlink(path: str) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
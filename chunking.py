@@ -0,0 +1,116 @@
+import re
+from typing import List, Optional, Sequence, Tuple
+
+# Грубая оценка: в среднем около 4 символов на токен
+CHARS_PER_TOKEN = 4
+
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])(\s+)")
+_WHITESPACE_RE = re.compile(r"(\s+)")
+_SEGMENT_SEPARATOR_RE = re.compile(r"(\n\s*\n)")
+
+# Разметка нескольких абзацев в одном запросе инкрементального режима
+PACK_MARKER = "<<<{}>>>"
+_PACK_MARKER_RE = re.compile(r"^[ \t]*<<<(\d+)>>>[ \t]*$", re.MULTILINE)
+PACK_INSTRUCTION = ("\n\nThe text is split into numbered parts, each starting with a marker line such as <<<1>>>. "
+                    "Process every part separately and return each result under its original marker line, "
+                    "in the same order. Keep the marker lines exactly as they are.")
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценивает количество токенов в тексте."""
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def split_text(text: str, max_tokens: int) -> List[str]:
+    """
+    Делит текст на фрагменты не длиннее max_tokens (по оценке).
+    Сначала режет по абзацам, слишком длинные абзацы — по предложениям,
+    а слишком длинные предложения — по словам.
+    """
+    return [chunk for _, chunk in split_text_with_separators(text, max_tokens)]
+
+
+def split_text_with_separators(text: str, max_tokens: int) -> List[Tuple[str, str]]:
+    """
+    То же, что split_text, но возвращает пары (разделитель перед фрагментом, фрагмент), как split_segments.
+    Разделители берутся из текста (перевод строки, пробел или пустая строка при разрезе слова),
+    поэтому ответы на фрагменты склеиваются с теми же границами.
+    """
+    budget = max(1, max_tokens) * CHARS_PER_TOKEN
+    if len(text) <= budget:
+        return [("", text)]
+
+    pieces: List[Tuple[str, str]] = []
+    for paragraph_separator, paragraph in split_segments(text):
+        if len(paragraph) <= budget:
+            pieces.append((paragraph_separator, paragraph))
+            continue
+        for sentence_separator, sentence in _split_keeping(_SENTENCE_RE, paragraph, paragraph_separator):
+            pieces.extend(_split_long(sentence_separator, sentence, budget))
+
+    chunks: List[Tuple[str, str]] = []
+    current, current_separator = "", ""
+    for separator, piece in pieces:
+        if not current:
+            current, current_separator = piece, separator
+        elif len(current) + len(separator) + len(piece) <= budget:
+            current += separator + piece
+        else:
+            chunks.append((current_separator, current))
+            current, current_separator = piece, separator
+    if current:
+        chunks.append((current_separator, current))
+    return chunks
+
+
+def _split_keeping(pattern: "re.Pattern[str]", text: str, leading: str = "") -> List[Tuple[str, str]]:
+    """Делит text по pattern с группой; возвращает пары (разделитель перед частью, часть), у первой — leading."""
+    parts = pattern.split(text)
+    return [(parts[i - 1] if i else leading, parts[i]) for i in range(0, len(parts), 2) if parts[i]]
+
+
+def _split_long(separator: str, sentence: str, budget: int) -> List[Tuple[str, str]]:
+    """Режет слишком длинное предложение по пробельным символам, а при их отсутствии — по символам."""
+    if len(sentence) <= budget:
+        return [(separator, sentence)]
+    parts: List[Tuple[str, str]] = []
+    for separator, word in _split_keeping(_WHITESPACE_RE, sentence, separator):
+        while len(word) > budget:
+            parts.append((separator, word[:budget]))
+            word, separator = word[budget:], ""
+        if word:
+            parts.append((separator, word))
+    return parts
+
+
+def split_segments(text: str) -> List[Tuple[str, str]]:
+    """
+    Делит текст на абзацы для инкрементальной обработки. Возвращает пары (разделитель перед абзацем, абзац);
+    склейка разделителей и абзацев восстанавливает текст без начальных и конечных пробелов.
+    """
+    parts = _SEGMENT_SEPARATOR_RE.split(text.strip())
+    return [(parts[i - 1] if i else "", parts[i]) for i in range(0, len(parts), 2)]
+
+
+def normalize_segment(segment: str) -> str:
+    """Приводит абзац к виду для ключа кэша: правка одних пробелов не делает абзац новым."""
+    return "\n".join(" ".join(line.split()) for line in segment.strip().splitlines())
+
+
+def pack_segments(segments: Sequence[str]) -> str:
+    """Собирает абзацы в один текст запроса, помечая каждый номером (PACK_MARKER)."""
+    return "\n\n".join(f"{PACK_MARKER.format(number)}\n{segment}" for number, segment in enumerate(segments, 1))
+
+
+def unpack_segments(text: str, count: int) -> Optional[List[str]]:
+    """
+    Разбирает ответ на пакет из count абзацев по меткам. None — модель потеряла, переставила
+    или добавила метки, либо вписала текст перед первой меткой.
+    """
+    markers = list(_PACK_MARKER_RE.finditer(text))
+    if [int(marker.group(1)) for marker in markers] != list(range(1, count + 1)):
+        return None
+    if text[:markers[0].start()].strip():
+        return None
+    ends = [marker.start() for marker in markers[1:]] + [len(text)]
+    return [text[marker.end():end].strip() for marker, end in zip(markers, ends)]
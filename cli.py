@@ -0,0 +1,162 @@
+"""
+Пакетный режим без GUI: прогоняет файлы, glob-шаблоны или stdin через шаблон.
+
+Модуль намеренно не импортирует customtkinter, pystray и pynput.
+Пример: python main.py batch "Corrector" docs/*.txt --parallel 4 --output-dir out
+"""
+import os
+import sys
+import glob
+import json
+import time
+import queue
+import argparse
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, TextIO
+
+from loguru import logger
+
+from jobs import Job, JobEngine, PRIORITY_NORMAL
+from managers import SettingsManager, TemplateManager
+from metrics import MetricsRegistry
+from pipeline import CompiledPipeline
+from services import LLMService
+from templating import TemplateError
+from utils import percentile
+
+
+@dataclass
+class BatchItem:
+    """Один элемент пакетной обработки."""
+    id: str
+    content: Any
+
+
+def run_batch(args: argparse.Namespace) -> int:
+    """
+    Выполняет пакетную обработку. Возвращает код выхода процесса.
+    """
+    template_manager = TemplateManager(args.templates_dir)
+    try:
+        template = template_manager.resolve(args.template)
+    except TemplateError as e:
+        print(f"Pipeline '{args.template}' cannot run: {e}", file=sys.stderr)
+        return 2
+    if not template:
+        print(f"Unknown template '{args.template}'. Available: {', '.join(template_manager.get_template_names())}",
+              file=sys.stderr)
+        return 2
+
+    service = LLMService.from_settings(SettingsManager().load_settings())
+    providers = template.providers() if isinstance(template, CompiledPipeline) else [template.api_provider]
+    for provider in providers:
+        try:
+            service.providers.get(provider)
+        except KeyError:
+            print(f"Template '{template.name}' uses unknown provider '{provider}'. "
+                  f"Configured: {', '.join(service.providers.names())}", file=sys.stderr)
+            return 2
+        except ValueError as e:
+            print(f"Provider '{provider}' is not configured: {e}", file=sys.stderr)
+            return 2
+
+    try:
+        items = list(_iter_inputs(args.inputs, args.jsonl, template.input_type))
+    except (OSError, ValueError) as e:
+        print(f"Failed to read inputs: {e}", file=sys.stderr)
+        return 2
+    if not items:
+        print("No inputs to process.", file=sys.stderr)
+        return 2
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    completed: "queue.Queue[Job]" = queue.Queue()
+    engine = JobEngine(service, on_complete=completed.put, max_workers=args.parallel)
+    started = time.perf_counter()
+    items_by_job: Dict[int, BatchItem] = {}
+    for item in items:
+        job = engine.submit(Job(template=template, content=item.content, priority=PRIORITY_NORMAL, source="batch"))
+        items_by_job[job.id] = item
+
+    metrics = MetricsRegistry()
+    latencies: List[float] = []
+    failed = 0
+    for _ in range(len(items)):
+        job = completed.get()
+        job.trace.finish(ok=job.result is not None, end=job.finished_at)
+        metrics.record(job.trace)
+        item = items_by_job[job.id]
+        latency_ms = (job.finished_at - job.started_at) * 1000
+        latencies.append(latency_ms)
+        if job.result is None:
+            failed += 1
+        _write_result(args, item, job.result, latency_ms, multiple=len(items) > 1)
+    engine.stop()
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Processed {len(items)} items ({failed} failed) in {elapsed:.2f}s: "
+        f"{len(items) / elapsed:.2f} items/s; latency ms p50={percentile(latencies, 50):.0f} "
+        f"p95={percentile(latencies, 95):.0f} max={max(latencies):.0f}",
+        file=sys.stderr,
+    )
+    if args.metrics:
+        try:
+            metrics.dump(args.metrics)
+        except OSError as e:
+            print(f"Failed to write metrics: {e}", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def _iter_inputs(inputs: List[str], jsonl: bool, input_type: str) -> Iterator[BatchItem]:
+    """Разворачивает glob-шаблоны и читает элементы из файлов или stdin."""
+    for pattern in inputs:
+        if pattern == "-":
+            yield from _read_stream(sys.stdin, "stdin", jsonl)
+            continue
+        paths = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in paths:
+            if os.path.isdir(path):
+                continue
+            if input_type == "image":
+                from PIL import Image
+                with Image.open(path) as image:
+                    image.load()
+                    yield BatchItem(path, image.copy())
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                yield from _read_stream(f, path, jsonl)
+
+
+def _read_stream(stream: TextIO, name: str, jsonl: bool) -> Iterator[BatchItem]:
+    if not jsonl:
+        yield BatchItem(name, stream.read())
+        return
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if not isinstance(record, dict) or not isinstance(record.get("text"), str):
+            raise ValueError(f"{name}:{line_no}: expected an object with a 'text' field")
+        yield BatchItem(str(record.get("id", f"{name}:{line_no}")), record["text"])
+
+
+def _write_result(args: argparse.Namespace, item: BatchItem, result: str | None, latency_ms: float, multiple: bool) -> None:
+    """Выводит результат сразу по готовности: в файл, JSONL или текстом."""
+    if result is None:
+        logger.error(f"Item '{item.id}' failed.")
+    if args.output_dir:
+        if result is not None:
+            safe_name = "".join(c if c.isalnum() or c in "-_." else "_" for c in item.id).strip("._") or "item"
+            with open(os.path.join(args.output_dir, f"{safe_name}.txt"), "w", encoding="utf-8") as f:
+                f.write(result)
+        return
+    if args.format == "jsonl":
+        record = {"id": item.id, "ok": result is not None, "result": result, "latency_ms": round(latency_ms, 1)}
+        sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+    elif result is not None:
+        if multiple:
+            sys.stdout.write(f"==> {item.id} <==\n")
+        sys.stdout.write(result + "\n")
+    sys.stdout.flush()
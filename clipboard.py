@@ -0,0 +1,242 @@
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, Tuple
+
+from loguru import logger
+
+# Отпечаток содержимого буфера: длина и хэш вместо полной копии текста.
+# Отпечатки живут только в памяти процесса, поэтому хватает встроенного hash(): он считается
+# прямо по строке, без кодирования в UTF-8, и в разы быстрее SHA-1 на мегабайтных текстах.
+Fingerprint = Tuple[int, int]
+
+
+def fingerprint_text(text: str) -> Fingerprint:
+    """Возвращает (длина, хэш) для текста."""
+    return len(text), hash(text)
+
+
+def fingerprint_image(image: Any) -> Fingerprint:
+    """Возвращает (размер в пикселях, хэш) для изображения PIL."""
+    return image.width * image.height, hash((image.mode, image.size, image.tobytes()))
+
+
+class ClipboardSource:
+    """
+    Интерфейс доступа к системному буферу обмена.
+    Проверки номера последовательности и форматов должны быть дешевыми,
+    чтение данных — только по запросу.
+    """
+    def sequence_number(self) -> int:
+        raise NotImplementedError
+
+    def has_text(self) -> bool:
+        raise NotImplementedError
+
+    def has_image(self) -> bool:
+        raise NotImplementedError
+
+    def read_text(self) -> Optional[str]:
+        raise NotImplementedError
+
+    def read_image(self) -> Optional[Any]:
+        raise NotImplementedError
+
+
+class Win32ClipboardSource(ClipboardSource):
+    """
+    Буфер обмена Windows: GetClipboardSequenceNumber и IsClipboardFormatAvailable
+    не требуют открытия буфера и не копируют данные.
+    """
+    def __init__(self):
+        import win32clipboard
+        import win32con
+        self._clipboard = win32clipboard
+        self._text_formats = (win32con.CF_UNICODETEXT, win32con.CF_TEXT)
+        self._image_formats = (win32con.CF_DIB, win32con.CF_DIBV5, win32con.CF_BITMAP)
+
+    def sequence_number(self) -> int:
+        return self._clipboard.GetClipboardSequenceNumber()
+
+    def has_text(self) -> bool:
+        return any(self._clipboard.IsClipboardFormatAvailable(fmt) for fmt in self._text_formats)
+
+    def has_image(self) -> bool:
+        return any(self._clipboard.IsClipboardFormatAvailable(fmt) for fmt in self._image_formats)
+
+    def read_text(self) -> Optional[str]:
+        import pyperclip
+        text = pyperclip.paste()
+        return text if isinstance(text, str) else None
+
+    def read_image(self) -> Optional[Any]:
+        from PIL import Image, ImageGrab
+        image = ImageGrab.grabclipboard()
+        return image if isinstance(image, Image.Image) else None
+
+
+class FakeClipboardSource(ClipboardSource):
+    """
+    Буфер обмена в памяти для бенчмарков и проверки логики на любой платформе.
+    Считает фактические чтения данных.
+    """
+    def __init__(self):
+        self._sequence = 0
+        self._text: Optional[str] = None
+        self._image: Optional[Any] = None
+        self.text_reads = 0
+        self.image_reads = 0
+
+    def set_text(self, text: Optional[str], image: Optional[Any] = None) -> None:
+        """Имитирует копирование: меняет содержимое и увеличивает номер последовательности."""
+        self._text, self._image = text, image
+        self._sequence += 1
+
+    def set_image(self, image: Any) -> None:
+        self.set_text(None, image)
+
+    def touch(self) -> None:
+        """Имитирует повторную запись того же содержимого (еще один формат из той же операции)."""
+        self._sequence += 1
+
+    def sequence_number(self) -> int:
+        return self._sequence
+
+    def has_text(self) -> bool:
+        return bool(self._text)
+
+    def has_image(self) -> bool:
+        return self._image is not None
+
+    def read_text(self) -> Optional[str]:
+        self.text_reads += 1
+        # Как и настоящее чтение буфера, каждый раз возвращает новую строку
+        return None if self._text is None else self._text.encode("utf-8", "surrogatepass").decode("utf-8", "surrogatepass")
+
+    def read_image(self) -> Optional[Any]:
+        self.image_reads += 1
+        return self._image
+
+
+@dataclass
+class DetectorStats:
+    """Счетчики работы детектора."""
+    updates: int = 0
+    unchanged: int = 0
+    coalesced: int = 0
+    ignored: int = 0
+    triggers: int = 0
+
+
+class DoubleCopyDetector:
+    """
+    Определяет двойное копирование по уведомлениям об изменении буфера.
+    Хранит только отпечаток последнего содержимого; изображение читается,
+    только если выбранный шаблон работает с изображениями.
+    """
+    def __init__(self,
+                 source: ClipboardSource,
+                 repeat_threshold: float = 0.5,
+                 min_interval: float = 0.09,
+                 coalesce_window: float = 0.03,
+                 wants_image: Callable[[], bool] = lambda: False,
+                 on_first_copy: Optional[Callable[[Any], None]] = None):
+        self.source = source
+        self.repeat_threshold = repeat_threshold
+        self.min_interval = min_interval
+        self.coalesce_window = coalesce_window
+        self.wants_image = wants_image
+        # Вызывается с содержимым каждого нового первого копирования (для упреждающего запроса)
+        self.on_first_copy = on_first_copy
+        self.stats = DetectorStats()
+
+        self._last_sequence: Optional[int] = None
+        self._last_update_time = float("-inf")
+        self._burst_has_content = False
+        self._last_fingerprint: Optional[Fingerprint] = None
+        self._last_copy_time = float("-inf")
+        self._ignore_next_update = False
+
+    def expect_own_update(self) -> None:
+        """Следующее изменение буфера сделает само приложение — его нужно пропустить."""
+        self._ignore_next_update = True
+
+    def reset(self) -> None:
+        """Забывает последнее содержимое (например, после ошибки чтения буфера)."""
+        self._last_fingerprint = None
+        self._burst_has_content = False
+
+    def _notify_first_copy(self, content: Any) -> None:
+        if self.on_first_copy is None:
+            return
+        try:
+            self.on_first_copy(content)
+        except Exception as e:
+            logger.opt(exception=True).error(f"First copy handler failed: {e}")
+
+    def handle_update(self, now: Optional[float] = None) -> Optional[Any]:
+        """
+        Обрабатывает уведомление об изменении буфера.
+        Возвращает текст или изображение, если распознано двойное копирование, иначе None.
+        """
+        now = time.monotonic() if now is None else now
+        self.stats.updates += 1
+
+        sequence = self.source.sequence_number()
+        if sequence == self._last_sequence:
+            self.stats.unchanged += 1
+            return None
+        self._last_sequence = sequence
+
+        # Приложения, записывающие несколько форматов, присылают серию уведомлений подряд
+        in_burst = now - self._last_update_time < self.coalesce_window
+        self._last_update_time = now
+        if in_burst and self._burst_has_content:
+            self.stats.coalesced += 1
+            return None
+
+        if self._ignore_next_update:
+            self._ignore_next_update = False
+            self.stats.ignored += 1
+            logger.debug("Ignoring clipboard update due to ignore flag.")
+            self.reset()
+            self._last_copy_time = now
+            return None
+
+        text: Optional[str] = None
+        image: Optional[Any] = None
+        if self.source.has_text():
+            text = self.source.read_text() or None
+        wants_image = self.wants_image() and self.source.has_image()
+        if text is not None:
+            fingerprint = fingerprint_text(text)
+        elif wants_image:
+            image = self.source.read_image()
+            fingerprint = fingerprint_image(image) if image is not None else None
+        else:
+            fingerprint = None
+
+        self._burst_has_content = fingerprint is not None
+        if fingerprint is None:
+            self._last_fingerprint = None
+            return None
+
+        time_diff = now - self._last_copy_time
+        if fingerprint != self._last_fingerprint:
+            self._last_fingerprint = fingerprint
+            self._last_copy_time = now
+            self._notify_first_copy(text if text is not None else image)
+            return None
+        if time_diff <= self.min_interval:
+            return None
+        if time_diff >= self.repeat_threshold:
+            # Тот же текст скопирован повторно, но слишком поздно — считаем это новым первым копированием
+            self._last_copy_time = now
+            self._notify_first_copy(text if text is not None else image)
+            return None
+
+        logger.info(f"Repeated copy detected ({time_diff:.2f}s).")
+        self.stats.triggers += 1
+        self._last_fingerprint = None
+        if wants_image and image is None:
+            image = self.source.read_image()
+        return image if image is not None else text
@@ -0,0 +1,151 @@
+import queue
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+from loguru import logger
+
+from resilience import RequestCancelled
+from utils import HEDGE_LATENCY_WINDOW, percentile
+
+# Попытка получает событие отмены и claim(): потоковая попытка вызывает claim() перед первым
+# фрагментом и продолжает, только если получила True (стала победителем)
+Attempt = Callable[[threading.Event, Callable[[], bool]], Any]
+
+
+class LatencyTracker:
+    """
+    Скользящее окно времени успешных ответов по ключу (например, "gemini/gemini-1.5-flash").
+    Используется для выбора задержки дублирующего запроса.
+    """
+    def __init__(self, window: int = HEDGE_LATENCY_WINDOW):
+        self.window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key: str, pct: float, min_samples: int = 1) -> Optional[float]:
+        """Перцентиль времени ответа в секундах или None, если замеров меньше min_samples."""
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        if len(samples) < min_samples:
+            return None
+        return percentile(samples, pct)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            items = [(key, list(samples)) for key, samples in self._samples.items()]
+        return {key: {"samples": len(samples),
+                      "p50_ms": round(percentile(samples, 50) * 1000, 1),
+                      "p95_ms": round(percentile(samples, 95) * 1000, 1)} for key, samples in items}
+
+
+@dataclass
+class HedgeStats:
+    """
+    Счетчики дублирующих запросов.
+    """
+    requests: int = 0  # Запросы с настроенным hedging
+    hedges_sent: int = 0  # Отправлено дублирующих запросов по таймеру
+    fallbacks_after_error: int = 0  # Запасная модель запрошена из-за ошибки основной
+    fallback_wins: int = 0  # Ответила не основная модель
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def increment(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self) -> Dict[str, int]:
+        return {
+            "requests": self.requests,
+            "hedges_sent": self.hedges_sent,
+            "fallbacks_after_error": self.fallbacks_after_error,
+            "fallback_wins": self.fallback_wins,
+        }
+
+
+@dataclass
+class HedgeResult:
+    index: int  # Номер ответившей попытки
+    value: Any
+    launched: int  # Сколько попыток было запущено
+
+
+def run_hedged(attempts: Sequence[Attempt], delay_for: Callable[[int], float],
+               stats: Optional[HedgeStats] = None, name: str = "request") -> HedgeResult:
+    """
+    Запускает attempts[0]; если за delay_for(0) секунд нет ответа, запускает attempts[1] и т.д.
+    Ошибка попытки сразу запускает следующую. Первый успешный результат побеждает,
+    остальные попытки отменяются через событие cancel.
+    :raises Exception: ошибка последней попытки, если все завершились неудачно,
+        или ошибка победившей потоковой попытки.
+    """
+    results: "queue.Queue[Tuple[int, Any, Optional[BaseException]]]" = queue.Queue()
+    cancels: List[threading.Event] = []
+    winner: List[Optional[int]] = [None]
+    lock = threading.Lock()
+
+    def claim(index: int) -> bool:
+        with lock:
+            if winner[0] is None:
+                winner[0] = index
+                for i, cancel in enumerate(cancels):
+                    if i != index:
+                        cancel.set()
+            return winner[0] == index
+
+    def launch() -> bool:
+        cancel = threading.Event()
+        with lock:
+            if winner[0] is not None:
+                return False  # Потоковая попытка уже начала отвечать
+            index = len(cancels)
+            cancels.append(cancel)
+
+        def _run() -> None:
+            try:
+                results.put((index, attempts[index](cancel, lambda: claim(index)), None))
+            except BaseException as e:
+                results.put((index, None, e))
+
+        threading.Thread(target=_run, name=f"Hedge-{index}", daemon=True).start()
+        return True
+
+    launch()
+    finished = 0
+    last_error: Optional[BaseException] = None
+    while True:
+        can_hedge = len(cancels) < len(attempts) and winner[0] is None
+        try:
+            index, value, error = results.get(timeout=delay_for(len(cancels) - 1) if can_hedge else None)
+        except queue.Empty:
+            delay_ms = delay_for(len(cancels) - 1) * 1000
+            if launch():
+                logger.info(f"Hedging {name}: no answer from attempt {len(cancels) - 1} in {delay_ms:.0f} ms, "
+                            f"sent attempt {len(cancels)}.")
+                if stats is not None:
+                    stats.increment("hedges_sent")
+            continue
+
+        finished += 1
+        if error is None:
+            if claim(index):
+                return HedgeResult(index=index, value=value, launched=len(cancels))
+            continue  # Результат проигравшей попытки, которую не успели прервать
+        if winner[0] == index:
+            raise error  # Поток победителя оборвался: продолжить другой моделью нельзя без дублирования текста
+        if not isinstance(error, RequestCancelled):
+            last_error = error
+            logger.warning(f"Hedging {name}: attempt {index + 1} failed: {type(error).__name__}: {error}")
+        if len(cancels) < len(attempts) and winner[0] is None:
+            if launch() and stats is not None:
+                stats.increment("fallbacks_after_error")
+        elif finished == len(cancels) and winner[0] is None:
+            raise last_error or RequestCancelled(f"All attempts of {name} were cancelled.")
@@ -0,0 +1,149 @@
+import io
+import sys
+import time
+import hashlib
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+from loguru import logger
+
+from blobstore import ImageHandle
+
+if TYPE_CHECKING:
+    from PIL import Image
+
+# Настройки по умолчанию; шаблон переопределяет их ключом "image_pipeline"
+DEFAULT_IMAGE_PIPELINE: Dict[str, Any] = {
+    "max_long_edge": 2048,   # 0 — не уменьшать
+    "mode": None,            # None, "RGB", "L" (оттенки серого) или "P" (палитра)
+    "colors": 256,           # Число цветов для режима "P"
+    "format": "WEBP",        # "WEBP", "JPEG" или "PNG"
+    "quality": 85,           # Для WEBP/JPEG; 100 для WEBP означает lossless
+    "crop_borders": False,   # Обрезать однотонные поля по краям
+    "border_tolerance": 8,
+}
+
+_MIME_TYPES = {"WEBP": "image/webp", "JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+@dataclass(frozen=True)
+class EncodedImage:
+    """
+    Изображение, закодированное один раз. Эти же байты идут в запрос, ключ кэша и историю.
+    """
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    source_width: int
+    source_height: int
+    raw_bytes: int  # Размер несжатого исходного изображения
+
+    @property
+    def digest(self) -> str:
+        return hashlib.sha256(self.data).hexdigest()
+
+    def to_blob(self) -> Dict[str, Any]:
+        """Возвращает часть запроса в формате, который принимает Gemini SDK."""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def open(self) -> "Image.Image":
+        """Декодирует изображение (например, для повторной обработки)."""
+        from PIL import Image
+        image = Image.open(io.BytesIO(self.data))
+        image.load()
+        return image
+
+
+def is_pil_image(content: Any) -> bool:
+    """
+    Проверяет, является ли контент изображением PIL, не импортируя PIL:
+    если модуль еще не загружен, изображения PIL в процессе быть не может.
+    """
+    pil_image = sys.modules.get("PIL.Image")
+    return pil_image is not None and isinstance(content, pil_image.Image)
+
+
+def is_image_content(content: Any) -> bool:
+    """Проверяет, является ли контент изображением (исходным, ссылкой на хранилище или уже закодированным)."""
+    return isinstance(content, (EncodedImage, ImageHandle)) or is_pil_image(content)
+
+
+def prepare_image(image: "Image.Image | ImageHandle | EncodedImage",
+                  config: Optional[Dict[str, Any]] = None) -> EncodedImage:
+    """
+    Уменьшает, обрезает, упрощает цвета и кодирует изображение согласно настройкам шаблона.
+    Изображение из хранилища декодируется здесь; уже закодированное возвращается без изменений.
+    """
+    if isinstance(image, EncodedImage):
+        return image
+    if isinstance(image, ImageHandle):
+        image = image.open()
+    from PIL import Image
+    settings = {**DEFAULT_IMAGE_PIPELINE, **(config or {})}
+    started = time.perf_counter()
+    source_width, source_height = image.size
+    raw_bytes = source_width * source_height * len(image.getbands())
+
+    if settings["crop_borders"]:
+        image = _crop_uniform_borders(image, settings["border_tolerance"])
+
+    max_edge = settings["max_long_edge"]
+    if max_edge and max(image.size) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+    fmt = str(settings["format"]).upper()
+    if fmt not in _MIME_TYPES:
+        raise ValueError(f"Unsupported image format '{settings['format']}'. Use one of: {', '.join(_MIME_TYPES)}.")
+    image = _convert_mode(image, settings["mode"], settings["colors"], fmt)
+
+    buffer = io.BytesIO()
+    if fmt == "WEBP":
+        quality = settings["quality"]
+        image.save(buffer, format="WEBP", quality=min(quality, 100), lossless=quality >= 100, method=4)
+    elif fmt == "JPEG":
+        image.save(buffer, format="JPEG", quality=settings["quality"], optimize=True)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+
+    encoded = EncodedImage(
+        data=buffer.getvalue(),
+        mime_type=_MIME_TYPES[fmt],
+        width=image.width,
+        height=image.height,
+        source_width=source_width,
+        source_height=source_height,
+        raw_bytes=raw_bytes,
+    )
+    logger.info(
+        f"Image prepared in {(time.perf_counter() - started) * 1000:.0f} ms: "
+        f"{source_width}x{source_height} -> {encoded.width}x{encoded.height} {fmt}, "
+        f"{len(encoded.data) // 1024} KB ({(raw_bytes - len(encoded.data)) // 1024} KB saved vs raw bitmap)."
+    )
+    return encoded
+
+
+def _crop_uniform_borders(image: "Image.Image", tolerance: int) -> "Image.Image":
+    """Обрезает поля, совпадающие по цвету с левым верхним пикселем."""
+    from PIL import Image, ImageChops
+    rgb = image.convert("RGB")
+    background = Image.new("RGB", rgb.size, rgb.getpixel((0, 0)))
+    diff = ImageChops.difference(rgb, background).convert("L").point(lambda p: 255 if p > tolerance else 0)
+    bbox = diff.getbbox()
+    if not bbox or bbox == (0, 0, image.width, image.height):
+        return image
+    return image.crop(bbox)
+
+
+def _convert_mode(image: "Image.Image", mode: Optional[str], colors: int, fmt: str) -> "Image.Image":
+    """Приводит цветовой режим к заданному и совместимому с форматом."""
+    if mode == "P":
+        return image.convert("RGB").quantize(colors=colors) if fmt != "JPEG" else image.convert("RGB")
+    if mode in ("RGB", "L"):
+        return image.convert(mode)
+    if fmt == "JPEG" and image.mode not in ("RGB", "L"):
+        return image.convert("RGB")
+    if image.mode not in ("RGB", "RGBA", "L", "LA", "P"):
+        return image.convert("RGBA" if "A" in image.getbands() else "RGB")
+    return image
@@ -0,0 +1,375 @@
+import time
+import itertools
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from loguru import logger
+
+from blobstore import ImageUnavailableError
+from chunking import estimate_tokens, split_segments
+from metrics import RequestTrace
+from pipeline import CompiledPipeline, PipelineResult
+from speculation import Speculation
+from templating import CompiledTemplate
+
+# Приоритеты: меньшее значение выполняется раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 10
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"  # Не выполнялась: JobEngine остановлен раньше
+
+_job_ids = itertools.count(1)
+
+
+@dataclass
+class Job:
+    """
+    Одна задача обработки: шаблон, контент и состояние выполнения.
+    """
+    template: Union[CompiledTemplate, CompiledPipeline]  # Конвейер передается после bind()
+    content: Any
+    priority: int = PRIORITY_NORMAL
+    source: str = "manual"
+    stream: bool = False
+    id: int = field(default_factory=lambda: next(_job_ids))
+    status: str = JOB_QUEUED
+    detail: Optional[str] = None  # Чего ждет выполняемая задача: квоты, повтора и т.п.
+    error: Optional[str] = None  # Понятная пользователю причина неудачи, если она известна
+    result: Optional[str] = None
+    submitted_at: float = field(default_factory=time.perf_counter)
+    triggered_at: Optional[float] = None
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    trace: Optional[RequestTrace] = None
+    pipeline_result: Optional[PipelineResult] = None  # Результаты шагов, если шаблон — конвейер
+    speculation: Optional[Speculation] = None  # Упреждающий запрос, подтвержденный этой задачей
+    # Колбэки самой задачи вместо колбэков JobEngine: результат задачи локального API не идет в окно
+    on_chunk: Optional[Callable[[str], None]] = field(default=None, repr=False)
+    on_complete: Optional[Callable[["Job"], None]] = field(default=None, repr=False)
+    # Группа пакетной отправки; вычисляется один раз в JobEngine.submit()
+    batch_key: Optional[Tuple[str, ...]] = field(default=None, init=False, repr=False)
+
+    def __post_init__(self) -> None:
+        if self.trace is None:
+            origin = self.triggered_at if self.triggered_at is not None else self.submitted_at
+            requested = "pipeline" if self.is_pipeline else f"{self.template.api_provider}/{self.template.model}"
+            self.trace = RequestTrace(self.template.name, requested, origin)
+
+    @property
+    def is_pipeline(self) -> bool:
+        return isinstance(self.template, CompiledPipeline)
+
+    @property
+    def answered_by(self) -> Optional[str]:
+        """Провайдер/модель, фактически давшие ответ (через запятую, если несколько); None для ответа из кэша."""
+        return self.trace.model
+
+    @property
+    def limit_keys(self) -> List[str]:
+        """
+        Ключи, по которым применяются лимиты параллелизма: провайдер и провайдер/модель.
+        Конвейер не ограничивается: параллельность его шагов задает сам конвейер, как у фрагментов длинного текста.
+        """
+        if self.is_pipeline:
+            return []
+        provider = self.template.api_provider
+        return [provider, f"{provider}/{self.template.model}"]
+
+    def compute_batch_key(self) -> Optional[Tuple[str, ...]]:
+        """
+        Группа пакетной отправки: задачи с одинаковым ключом можно отправить одним запросом.
+        None — задача выполняется отдельно (пакетная отправка выключена, не текст, длинный текст и т.п.).
+        """
+        template = self.template
+        if not isinstance(template, CompiledTemplate) or template.batching is None or self.speculation is not None:
+            return None
+        if not isinstance(self.content, str) or estimate_tokens(self.content) > template.batching.max_tokens:
+            return None
+        if template.incremental and len(split_segments(self.content)) > 1:
+            return None
+        return template.api_provider, template.model, template.prompt.source, template.generation_config_key
+
+    def __str__(self) -> str:
+        return f"#{self.id} {self.template.name} [{self.status}]"
+
+
+@dataclass
+class BatchStats:
+    """Счетчики пакетной отправки задач."""
+    batches: int = 0
+    jobs: int = 0
+
+    @property
+    def saved_requests(self) -> int:
+        return self.jobs - self.batches
+
+    def as_dict(self) -> Dict[str, int]:
+        return {"batches": self.batches, "jobs": self.jobs, "saved_requests": self.saved_requests}
+
+
+class JobEngine:
+    """
+    Очередь задач с приоритетами и ограниченным пулом рабочих потоков.
+    Результаты передаются в on_complete в порядке завершения задач.
+    """
+    def __init__(self,
+                 llm_service: Any,
+                 on_complete: Callable[[Job], None],
+                 on_chunk: Optional[Callable[[Job, str], None]] = None,
+                 on_status_change: Optional[Callable[[Dict[str, Any]], None]] = None,
+                 max_workers: int = 4,
+                 concurrency_limits: Optional[Dict[str, int]] = None):
+        self.llm_service = llm_service
+        self.on_complete = on_complete
+        self.on_chunk = on_chunk
+        self.on_status_change = on_status_change
+        self.max_workers = max(1, max_workers)
+        self.concurrency_limits = dict(concurrency_limits or {})
+
+        self._pending: List[Job] = []
+        self._running: Dict[int, Job] = {}
+        self._running_per_key: Dict[str, int] = {}
+        self._collecting: Set[Tuple[str, ...]] = set()  # Группы, для которых рабочий поток сейчас собирает пакет
+        self.batch_stats = BatchStats()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"JobWorker-{i}", daemon=True)
+            for i in range(self.max_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+        logger.info(f"JobEngine started with {self.max_workers} workers, limits: {self.concurrency_limits}")
+
+    def submit(self, job: Job) -> Job:
+        """Ставит задачу в очередь."""
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("JobEngine is stopped.")
+            job.status = JOB_QUEUED
+            # Ключ зависит от всего текста (оценка токенов, абзацы), поэтому не пересчитывается при каждом выборе задачи
+            job.batch_key = job.compute_batch_key()
+            self._pending.append(job)
+            self._cond.notify_all()
+        logger.info(f"Job {job} submitted (priority {job.priority}, source: {job.source}).")
+        self._notify_status()
+        return job
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Возвращает количество выполняемых и ожидающих задач и описания ожиданий выполняемых задач."""
+        with self._cond:
+            return {
+                "running": len(self._running),
+                "queued": len(self._pending),
+                "waiting": [f"#{job.id} {job.detail}" for job in self._running.values() if job.detail],
+            }
+
+    def pending_jobs(self) -> List[Job]:
+        """Возвращает копию списка ожидающих задач в порядке выполнения."""
+        with self._cond:
+            return sorted(self._pending, key=lambda j: (j.priority, j.id))
+
+    def stop(self) -> None:
+        """
+        Останавливает рабочие потоки. Ожидающие задачи не выполняются: они завершаются
+        со статусом JOB_CANCELLED и result None, чтобы ждущие их (например, клиенты API) получили ответ.
+        """
+        with self._cond:
+            self._stopped = True
+            dropped = sorted(self._pending, key=lambda j: (j.priority, j.id))
+            self._pending.clear()
+            self._cond.notify_all()
+        for job in dropped:
+            job.status = JOB_CANCELLED
+            job.result = None
+            job.finished_at = time.perf_counter()
+            try:
+                (job.on_complete or self.on_complete)(job)
+            except Exception as e:
+                logger.opt(exception=True).error(f"Completion handler for cancelled job {job} failed: {e}")
+        logger.info(f"JobEngine stopped ({len(dropped)} queued jobs cancelled).")
+
+    def _has_capacity(self, job: Job) -> bool:
+        """Проверяет лимиты параллелизма для провайдера и модели. Вызывается под блокировкой."""
+        for key in job.limit_keys:
+            limit = self.concurrency_limits.get(key)
+            if limit is not None and self._running_per_key.get(key, 0) >= limit:
+                return False
+        return True
+
+    def _take_next(self) -> Optional[Job]:
+        """Выбирает задачу с наивысшим приоритетом, для которой есть свободный слот."""
+        for job in sorted(self._pending, key=lambda j: (j.priority, j.id)):
+            if self._has_capacity(job) and job.batch_key not in self._collecting:
+                self._pending.remove(job)
+                return job
+        return None
+
+    def _worker_loop(self) -> None:
+        while True:
+            with self._cond:
+                while True:
+                    if self._stopped:
+                        return
+                    job = self._take_next()
+                    if job is not None:
+                        break
+                    self._cond.wait()
+                self._start(job)
+                # Пакет занимает один слот лимита параллелизма: это один запрос
+                for key in job.limit_keys:
+                    self._running_per_key[key] = self._running_per_key.get(key, 0) + 1
+                batch = [job] + self._collect_batch(job) if job.batch_key is not None else [job]
+            self._notify_status()
+
+            try:
+                if len(batch) > 1:
+                    self._run_batch(batch)
+                else:
+                    self._run_job(job)
+            finally:
+                with self._cond:
+                    for member in batch:
+                        self._running.pop(member.id, None)
+                    for key in job.limit_keys:
+                        self._running_per_key[key] -= 1
+                    self._cond.notify_all()
+                self._notify_status()
+                for member in batch:
+                    (member.on_complete or self.on_complete)(member)
+
+    def _start(self, job: Job) -> None:
+        """Вызывается под блокировкой."""
+        job.status = JOB_RUNNING
+        job.started_at = time.perf_counter()
+        self._running[job.id] = job
+
+    def _collect_batch(self, first: Job) -> List[Job]:
+        """
+        Забирает из очереди задачи той же группы, что и first, ожидая новые до конца окна window_ms.
+        Интерактивная задача окно не ждет: пакет собирается только из уже стоящих в очереди.
+        Вызывается под блокировкой; на время ожидания группа исключается из выбора другими потоками.
+        """
+        config = first.template.batching
+        group = first.batch_key
+        window = 0.0 if first.priority == PRIORITY_INTERACTIVE else config.window_ms / 1000
+        deadline = first.started_at + window
+        tokens = estimate_tokens(first.content)
+        mates: List[Job] = []
+        self._collecting.add(group)
+        try:
+            while True:
+                for job in sorted(self._pending, key=lambda j: (j.priority, j.id)):
+                    if len(mates) + 1 >= config.max_items:
+                        break
+                    if job.batch_key != group or tokens + estimate_tokens(job.content) > config.max_tokens:
+                        continue
+                    self._pending.remove(job)
+                    self._start(job)
+                    mates.append(job)
+                    tokens += estimate_tokens(job.content)
+                remaining = deadline - time.perf_counter()
+                if self._stopped or remaining <= 0 or len(mates) + 1 >= config.max_items:
+                    return mates
+                self._cond.wait(remaining)
+        finally:
+            self._collecting.discard(group)
+            # Задачи группы, не вошедшие в пакет, снова доступны остальным потокам
+            self._cond.notify_all()
+
+    def _run_batch(self, jobs: List[Job]) -> None:
+        """Выполняет пакет задач одним запросом; ответы раздаются задачам по порядку."""
+        first = jobs[0]
+        logger.info(f"Sending {len(jobs)} jobs for '{first.template.name}' as one request: "
+                    f"{', '.join(f'#{job.id}' for job in jobs)}.")
+        started = time.perf_counter()
+        for job in jobs:
+            job.trace.add_span("queue", job.submitted_at, job.started_at)
+        try:
+            results = self.llm_service.execute_batch(first.template, [job.content for job in jobs],
+                                                     on_status=lambda text: self._set_detail(first, text),
+                                                     trace=first.trace)
+        except Exception as e:
+            logger.opt(exception=True).error(f"Batch of jobs {[job.id for job in jobs]} crashed: {e}")
+            results = [None] * len(jobs)
+        finished = time.perf_counter()
+        with self._cond:
+            self.batch_stats.batches += 1
+            self.batch_stats.jobs += len(jobs)
+        first.detail = None
+        for job, result in zip(jobs, results):
+            if job is not first:
+                # Токены пакета записаны в трассу первой задачи, остальным — время запроса и модель
+                job.trace.add_span("network", started, finished)
+                if first.trace.model:
+                    job.trace.set_model(first.trace.model)
+            job.result = result
+            job.finished_at = finished
+            job.status = JOB_DONE if result is not None else JOB_FAILED
+        logger.info(f"Batch of {len(jobs)} jobs finished in {(finished - started) * 1000:.0f} ms. "
+                    f"Batching stats: {self.batch_stats.as_dict()}")
+
+    def _run_job(self, job: Job) -> None:
+        logger.info(f"Running job {job} (waited {(job.started_at - job.submitted_at) * 1000:.0f} ms in queue).")
+        if job.triggered_at is not None:
+            logger.info(f"Trigger-to-request latency for job {job}: {(time.perf_counter() - job.triggered_at) * 1000:.1f} ms.")
+        on_chunk = None
+        if job.stream and job.on_chunk:
+            on_chunk = job.on_chunk
+        elif job.stream and self.on_chunk:
+            on_chunk = lambda text: self.on_chunk(job, text)
+        job.trace.add_span("queue", job.submitted_at, job.started_at)
+        try:
+            # Изображение кодируется один раз; те же байты попадут в запрос и в историю
+            with job.trace.span("prepare"):
+                job.content = self.llm_service.prepare_content(job.template, job.content)
+            on_status = lambda text: self._set_detail(job, text)
+            if job.is_pipeline:
+                job.pipeline_result = self.llm_service.execute_pipeline(job.template, job.content,
+                                                                        on_status=on_status, trace=job.trace)
+                job.result = job.pipeline_result.combined_text()
+            else:
+                job.result = self._adopt_speculation(job, on_chunk)
+                if job.result is None:
+                    if job.speculation is not None and job.speculation.streamed:
+                        on_chunk = None  # Часть текста уже показана: новый ответ заменит ее целиком
+                    job.result = self.llm_service.execute_request(job.template, job.content, on_chunk=on_chunk,
+                                                                  on_status=on_status, trace=job.trace)
+        except ImageUnavailableError as e:
+            logger.warning(f"Job {job} cannot run: {e}")
+            job.error = str(e)
+            job.result = None
+        except Exception as e:
+            logger.opt(exception=True).error(f"Job {job} crashed: {e}")
+            job.result = None
+        job.detail = None
+        job.finished_at = time.perf_counter()
+        job.status = JOB_DONE if job.result is not None else JOB_FAILED
+        logger.info(f"Job {job} finished in {(job.finished_at - job.started_at) * 1000:.0f} ms.")
+
+    def _adopt_speculation(self, job: Job, on_chunk: Optional[Callable[[str], None]]) -> Optional[str]:
+        """Забирает ответ упреждающего запроса; None — его нет или он не удался (тогда выполняется обычный запрос)."""
+        if job.speculation is None:
+            return None
+        result = job.speculation.adopt(on_chunk, job.trace)
+        if result is None:
+            logger.warning(f"Speculative request for job {job} failed; sending the request again.")
+            return None
+        if not job.speculation.from_cache:
+            self.llm_service.remember(job.template, job.content, result)
+        return result
+
+    def _set_detail(self, job: Job, detail: Optional[str]) -> None:
+        job.detail = detail
+        if detail:
+            logger.info(f"Job {job}: {detail}")
+        self._notify_status()
+
+    def _notify_status(self) -> None:
+        if self.on_status_change:
+            self.on_status_change(self.snapshot())
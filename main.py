@@ -1,13 +1,13 @@
 import os
 import sys
-from tkinter import messagebox
+import argparse
 import webbrowser
 import subprocess
 
 from loguru import logger
 from dotenv import load_dotenv
 
-from app_gui import AutoReclipperApp
+from utils import TEMPLATES_DIR
 
 # Константы
 LOG_FILE = "autoreclipper.log"
@@ -89,8 +89,11 @@ def _prompt_api_key_setup(env_path: str) -> None:
 
     root.mainloop()
 
-def setup_logging():
-    """Настраивает систему логирования с использованием Loguru."""
+def setup_logging(console=sys.stdout):
+    """
+    Настраивает систему логирования с использованием Loguru.
+    В пакетном режиме консольный лог пишется в stderr, чтобы не смешиваться с результатами.
+    """
     logger.remove()
     log_format = (
         "<green>{time:YYYY-MM-DD HH:mm:ss.SSS}</green> | "
@@ -100,7 +103,7 @@ def setup_logging():
     
     try:
         # Логирование в консоль
-        logger.add(sys.stdout, colorize=True, format=log_format, level="INFO")
+        logger.add(console, colorize=True, format=log_format, level="INFO")
     except Exception as e:
         # Эта ошибка может возникнуть, если нет доступной консоли (например, при запуске с pythonw.exe)
         # Логируем это в файл для отладки, но не прерываем работу.
@@ -113,12 +116,55 @@ def setup_logging():
     logger.info("Logging is configured.")
 
 
+def _add_batch_arguments(parser: argparse.ArgumentParser) -> None:
+    """Описывает аргументы подкоманды batch (сама обработка — в cli.run_batch)."""
+    parser.add_argument("template", help="Template name, as shown in the GUI dropdown.")
+    parser.add_argument("inputs", nargs="*", default=["-"],
+                        help="Files or glob patterns to process; '-' reads stdin (default).")
+    parser.add_argument("--jsonl", action="store_true",
+                        help="Treat each input line as a JSON object with 'text' and optional 'id'.")
+    parser.add_argument("--parallel", type=int, default=4, help="Number of concurrent requests (default: 4).")
+    parser.add_argument("--output-dir", help="Write each result to <output-dir>/<id>.txt instead of stdout.")
+    parser.add_argument("--format", choices=("text", "jsonl"), default="text", help="stdout format (default: text).")
+    parser.add_argument("--templates-dir", default=TEMPLATES_DIR, help=f"Templates directory (default: {TEMPLATES_DIR}).")
+    parser.add_argument("--metrics", metavar="JSON_FILE",
+                        help="Write per-stage latency percentiles and token usage to this file.")
+
+
+def _parse_args(argv=None) -> argparse.Namespace:
+    """Разбирает аргументы командной строки. Без подкоманды запускается GUI."""
+    parser = argparse.ArgumentParser(description="Clipboard automation utility using LLM templates.")
+    parser.add_argument("--profile-startup", nargs="?", const="-", metavar="JSON_FILE",
+                        help="Print an import-time and init-phase breakdown once the app is ready; "
+                             "optionally also write it to JSON_FILE.")
+    parser.add_argument("--exit-after-startup", action="store_true",
+                        help="Quit as soon as startup completes (for startup benchmarks).")
+    subparsers = parser.add_subparsers(dest="command")
+    # Аргументы описаны здесь, а не в cli: импорт cli тянет JobEngine, LLMService и sqlite3
+    _add_batch_arguments(subparsers.add_parser("batch", help="Run a template over files or stdin without the GUI."))
+    return parser.parse_args(argv)
+
+
 def main():
     """Основная функция для запуска приложения. Main application launch function."""
-    setup_logging()
+    # Профиль создается до разбора аргументов, чтобы в него попали все импорты запуска
+    profile = None
+    if any(arg.partition("=")[0] == "--profile-startup" for arg in sys.argv[1:]):
+        from profiling import StartupProfile
+        profile = StartupProfile()
+    args = _parse_args()
+    if profile and args.command == "batch":
+        profile.imports.uninstall()
+        profile = None
+    setup_logging(sys.stderr if args.command == "batch" else sys.stdout)
 
     # Загрузка переменных окружения
     load_dotenv()
+    if args.command == "batch":
+        # Наличие ключа проверяет провайдер выбранного шаблона: локальным провайдерам он не нужен
+        from cli import run_batch
+        sys.exit(run_batch(args))
+
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key or len(api_key) < 30:
         logger.error("GEMINI_API_KEY not found in environment.")
@@ -127,13 +173,23 @@ def main():
         _prompt_api_key_setup(env_path)
         return
 
+    # GUI-зависимости импортируются только для графического режима
+    from tkinter import messagebox
+    from app_gui import AutoReclipperApp
+    if profile:
+        profile.mark("gui modules imported")
+
     try:
-        app = AutoReclipperApp()
+        app = AutoReclipperApp(profile=profile, exit_after_startup=args.exit_after_startup)
         app.mainloop()
     except Exception as e:
         logger.opt(exception=True).critical(f"An unhandled exception occurred: {e}")
         messagebox.showerror("Critical Error", f"Произошла критическая ошибка: {e}\n\nСмотрите {LOG_ERROR_FILE} для деталей.")
     finally:
+        if profile:
+            profile.imports.uninstall()
+            if args.profile_startup != "-":
+                profile.write_json(args.profile_startup)
         logger.info("Application shutting down.")
 
 
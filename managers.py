@@ -1,13 +1,20 @@
 import os
 import json
+import threading
+from dataclasses import dataclass, field
 from datetime import datetime
-from collections import deque
-from typing import List, Dict, Optional, Any, Tuple
+from typing import Callable, List, Dict, Optional, Any, Tuple
 
 from loguru import logger
-from PIL import Image
 
-from utils import SETTINGS_FILE, TEMPLATES_DIR, HISTORY_MAX_LEN, HistoryEntry
+from blobstore import ImageHandle
+from imaging import EncodedImage, is_pil_image, prepare_image
+from pipeline import CompiledPipeline, compile_pipeline, is_pipeline_data
+from templating import CompiledTemplate, TemplateError, compile_template
+from utils import (SETTINGS_FILE, TEMPLATES_DIR, TEMPLATES_POLL_INTERVAL, HISTORY_MAX_LEN, HISTORY_DB_FILE, HISTORY_MAX_ENTRIES,
+                   HISTORY_MAX_BYTES, METRICS_FILE, TEXT_PREVIEW_MAX_CHARS, SPECULATION_MIN_CHARS, SPECULATION_MAX_CHARS,
+                   SPECULATION_MAX_PER_MINUTE, API_PORT, API_MAX_CONNECTIONS, API_MAX_JOBS, PROFILE_INTERVAL_MS,
+                   PROFILE_TOP, HistoryEntry, make_source_preview)
 
 class SettingsManager:
     """
@@ -28,6 +35,23 @@ class SettingsManager:
             "last_template": None,
             "font_family": "Segoe UI",
             "font_size": 13,
+            "stream_responses": False,
+            "warm_up_models": True,
+            "max_concurrent_jobs": 4,
+            "concurrency_limits": {"gemini": 4},
+            "providers": {},
+            "rate_limits": {},
+            "retry": {"max_attempts": 4, "base_delay": 1.0, "max_delay": 30.0},
+            "circuit_breaker": {"failure_threshold": 5, "reset_timeout": 30.0},
+            "history_max_entries": HISTORY_MAX_ENTRIES,
+            "history_max_bytes": HISTORY_MAX_BYTES,
+            "metrics_file": METRICS_FILE,
+            "text_preview_max_chars": TEXT_PREVIEW_MAX_CHARS,
+            "speculation": {"enabled": False, "min_chars": SPECULATION_MIN_CHARS, "max_chars": SPECULATION_MAX_CHARS,
+                            "max_per_minute": SPECULATION_MAX_PER_MINUTE},
+            "api_server": {"enabled": False, "port": API_PORT, "max_connections": API_MAX_CONNECTIONS,
+                           "max_jobs": API_MAX_JOBS},
+            "profiling": {"enabled": False, "interval_ms": PROFILE_INTERVAL_MS, "top": PROFILE_TOP, "memory": True},
         }
         try:
             with open(self.filepath, 'r', encoding='utf-8') as f:
@@ -50,19 +74,37 @@ class SettingsManager:
         except IOError as e:
             logger.error(f"Failed to save settings to {self.filepath}: {e}")
 
+@dataclass
+class TemplateChanges:
+    """Результат повторного сканирования директории шаблонов."""
+    added: List[str] = field(default_factory=list)
+    updated: List[str] = field(default_factory=list)
+    removed: List[str] = field(default_factory=list)
+    errors: Dict[str, str] = field(default_factory=dict)  # путь к файлу -> текст ошибки
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.updated or self.removed or self.errors)
+
+
 class TemplateManager:
     """
     Управляет загрузкой и доступом к шаблонам (промптам).
+    Каждый файл компилируется один раз при загрузке; reload_changed() перечитывает
+    только файлы с изменившимися mtime/размером и сохраняет последнюю рабочую
+    версию шаблона, если новая содержит ошибки.
     """
     def __init__(self, directory: str = TEMPLATES_DIR):
         self.directory = directory
-        self.templates: Dict[str, Dict[str, Any]] = {}
+        self.templates: Dict[str, CompiledTemplate | CompiledPipeline] = {}
+        # путь -> ((mtime_ns, size), имя шаблона или None, если файл пока ни разу не загрузился)
+        self._files: Dict[str, Tuple[Tuple[int, int], Optional[str]]] = {}
+        self._lock = threading.Lock()
         logger.info(f"Initializing TemplateManager with directory: {self.directory}")
         self.load_templates()
 
     def load_templates(self) -> None:
         """
-        Сканирует директорию, загружает и валидирует все .json шаблоны.
+        Сканирует директорию, загружает и компилирует все .json шаблоны.
         """
         if not os.path.isdir(self.directory):
             logger.error(f"Templates directory not found: {self.directory}")
@@ -70,70 +112,361 @@ class TemplateManager:
             logger.info(f"Created templates directory: {self.directory}")
             return
 
-        self.templates = {}
-        for filename in os.listdir(self.directory):
-            if filename.endswith(".json"):
-                filepath = os.path.join(self.directory, filename)
-                try:
-                    with open(filepath, 'r', encoding='utf-8') as f:
-                        template_data = json.load(f)
-                    
-                    if self._is_valid(template_data):
-                        name = template_data["name"]
-                        self.templates[name] = template_data
-                        logger.debug(f"Successfully loaded template: {name}")
-                    else:
-                        logger.warning(f"Invalid template file (missing required keys): {filepath}")
-                except (json.JSONDecodeError, IOError) as e:
-                    logger.error(f"Failed to load or parse template {filepath}: {e}")
+        with self._lock:
+            self.templates = {}
+            self._files = {}
+        self.reload_changed()
         logger.info(f"Loaded {len(self.templates)} templates.")
 
-    def _is_valid(self, data: Dict[str, Any]) -> bool:
-        """Проверяет наличие обязательных полей в шаблоне."""
-        required_keys = ["name", "description", "api_provider", "model", "input_type", "prompt"]
-        return all(key in data for key in required_keys)
+    def reload_changed(self) -> TemplateChanges:
+        """
+        Перечитывает новые, измененные и удаленные файлы шаблонов.
+        Безопасно вызывать из фонового потока.
+        """
+        changes = TemplateChanges()
+        current = self._scan()
+        with self._lock:
+            known = dict(self._files)
+
+        for path in sorted(set(known) - set(current)):
+            _, name = known[path]
+            with self._lock:
+                del self._files[path]
+                if name and self._owner_of(name) is None:
+                    self.templates.pop(name, None)
+                    changes.removed.append(name)
+            logger.info(f"Template file removed: {path}")
+
+        for path, signature in sorted(current.items()):
+            previous = known.get(path)
+            if previous and previous[0] == signature:
+                continue
+            old_name = previous[1] if previous else None
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                compile = compile_pipeline if is_pipeline_data(data) else compile_template
+                template = compile(data, source_path=path)
+            except (json.JSONDecodeError, TemplateError, IOError) as e:
+                # Последняя рабочая версия остается доступной до исправления файла
+                with self._lock:
+                    self._files[path] = (signature, old_name)
+                changes.errors[path] = str(e)
+                logger.error(f"Failed to load template {path}: {e}")
+                continue
+
+            with self._lock:
+                other = self.templates.get(template.name)
+                if other is not None and other.source_path != path and old_name != template.name:
+                    self._files[path] = (signature, old_name)
+                    changes.errors[path] = f"duplicate template name '{template.name}' (already defined in {other.source_path})"
+                    logger.error(f"Failed to load template {path}: {changes.errors[path]}")
+                    continue
+                self._files[path] = (signature, template.name)
+                if old_name and old_name != template.name:
+                    self.templates.pop(old_name, None)
+                    changes.removed.append(old_name)
+                (changes.updated if template.name in self.templates else changes.added).append(template.name)
+                self.templates[template.name] = template
+            logger.debug(f"Successfully loaded template: {template.name}")
+
+        if changes and known:
+            logger.info(f"Templates reloaded: added {changes.added}, updated {changes.updated}, "
+                        f"removed {changes.removed}, errors in {list(changes.errors)}")
+        return changes
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        """Возвращает (mtime_ns, размер) для каждого .json файла в директории."""
+        signatures = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".json") and entry.is_file():
+                        stat = entry.stat()
+                        signatures[entry.path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError as e:
+            logger.error(f"Failed to scan templates directory {self.directory}: {e}")
+        return signatures
+
+    def _owner_of(self, name: str) -> Optional[str]:
+        """Возвращает путь файла, который сейчас определяет шаблон с этим именем. Вызывается под блокировкой."""
+        for path, (_, file_name) in self._files.items():
+            if file_name == name:
+                return path
+        return None
 
     def get_template_names(self) -> List[str]:
         """Возвращает отсортированный список имен всех загруженных шаблонов."""
-        return sorted(list(self.templates.keys()))
+        with self._lock:
+            return sorted(self.templates.keys())
+
+    def get_template(self, name: str) -> Optional[CompiledTemplate | CompiledPipeline]:
+        """Возвращает скомпилированный шаблон или конвейер по имени."""
+        with self._lock:
+            return self.templates.get(name)
+
+    def get_templates(self) -> List[CompiledTemplate | CompiledPipeline]:
+        """Возвращает снимок всех загруженных шаблонов."""
+        with self._lock:
+            return list(self.templates.values())
+
+    def get_request_templates(self) -> List[CompiledTemplate]:
+        """Возвращает шаблоны с запросом к модели (без конвейеров)."""
+        return [template for template in self.get_templates() if isinstance(template, CompiledTemplate)]
+
+    def resolve(self, name: str) -> Optional[CompiledTemplate | CompiledPipeline]:
+        """
+        Возвращает шаблон, готовый к запуску: конвейер — с подставленными текущими шаблонами шагов.
+        :raises TemplateError: если шаг конвейера ссылается на отсутствующий или неподходящий шаблон.
+        """
+        template = self.get_template(name)
+        if isinstance(template, CompiledPipeline):
+            return template.bind(self.get_template)
+        return template
+
+class TemplateWatcher(threading.Thread):
+    """
+    Следит за директорией шаблонов, опрашивая mtime и размер файлов (работает на любой ОС).
+    Изменения применяются через TemplateManager.reload_changed(), о результате сообщает on_change.
+    """
+    def __init__(self, manager: TemplateManager, on_change: Callable[[TemplateChanges], None],
+                 interval: float = TEMPLATES_POLL_INTERVAL):
+        super().__init__(name="TemplateWatcher", daemon=True)
+        self.manager = manager
+        self.on_change = on_change
+        self.interval = interval
+        self._stop_event = threading.Event()
 
-    def get_template(self, name: str) -> Optional[Dict[str, Any]]:
-        """Возвращает данные шаблона по его имени."""
-        return self.templates.get(name)
+    def run(self) -> None:
+        logger.info(f"Watching templates in {self.manager.directory} (every {self.interval:.1f}s).")
+        while not self._stop_event.wait(self.interval):
+            try:
+                changes = self.manager.reload_changed()
+            except Exception as e:
+                logger.opt(exception=True).error(f"Template reload failed: {e}")
+                continue
+            if changes:
+                self.on_change(changes)
+
+    def stop(self) -> None:
+        self._stop_event.set()
 
 class HistoryManager:
     """
-    Управляет историей выполненных операций.
+    Управляет историей выполненных операций. Записи хранятся в SQLite
+    с полнотекстовым индексом (FTS5) по исходному тексту и результату.
+    Изображения лежат в отдельной таблице и читаются только при открытии записи.
+    """
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            template_name TEXT NOT NULL,
+            source_kind TEXT NOT NULL,
+            source_preview TEXT NOT NULL,
+            source_text TEXT,
+            result_text TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            model TEXT
+        );
+        CREATE TABLE IF NOT EXISTS images (
+            entry_id INTEGER PRIMARY KEY REFERENCES entries(id) ON DELETE CASCADE,
+            mime_type TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            height INTEGER NOT NULL,
+            source_width INTEGER NOT NULL,
+            source_height INTEGER NOT NULL,
+            raw_bytes INTEGER NOT NULL,
+            data BLOB NOT NULL
+        );
+        CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+            source_text, result_text, content='entries', content_rowid='id'
+        );
+        CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+            INSERT INTO entries_fts(rowid, source_text, result_text)
+            VALUES (new.id, coalesce(new.source_text, ''), new.result_text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+            INSERT INTO entries_fts(entries_fts, rowid, source_text, result_text)
+            VALUES ('delete', old.id, coalesce(old.source_text, ''), old.result_text);
+        END;
     """
-    def __init__(self, max_len: int = HISTORY_MAX_LEN):
-        self.history: deque[HistoryEntry] = deque(maxlen=max_len)
-        logger.info(f"Initializing HistoryManager with max length: {max_len}")
+    _SUMMARY_COLUMNS = "id, timestamp, template_name, source_preview"
+
+    def __init__(self,
+                 db_path: str = HISTORY_DB_FILE,
+                 max_entries: int = HISTORY_MAX_ENTRIES,
+                 max_bytes: int = HISTORY_MAX_BYTES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        import sqlite3  # Не в начале модуля: импорт managers не должен тянуть sqlite3, он нужен только истории
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self._SCHEMA)
+        self._migrate()
+        logger.info(f"Initializing HistoryManager with database: {db_path} "
+                    f"(max entries: {max_entries}, max size: {max_bytes // (1024 * 1024)} MB)")
+
+    def _migrate(self) -> None:
+        """Добавляет колонки, появившиеся после создания базы."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(entries)")}
+        if "model" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE entries ADD COLUMN model TEXT")
+            logger.info("History database migrated: added 'model' column.")
+
+    def add_entry(self, source_content: Any, template_name: str, result_text: str, model: Optional[str] = None) -> int:
+        """
+        Добавляет новую запись в историю и применяет ограничения хранения.
+        model — "провайдер/модель", которые фактически ответили.
+        Возвращает id записи.
+        """
+        if is_pil_image(source_content) or isinstance(source_content, ImageHandle):
+            source_content = prepare_image(source_content)
+        is_image = isinstance(source_content, EncodedImage)
+        source_text = None if is_image else str(source_content)
+        size_bytes = len(result_text.encode("utf-8")) + (
+            len(source_content.data) if is_image else len(source_text.encode("utf-8", "surrogatepass")))
+
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO entries (timestamp, template_name, source_kind, source_preview, source_text, result_text, size_bytes, model) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (datetime.now().isoformat(timespec="seconds"), template_name, "image" if is_image else "text",
+                 make_source_preview(source_content), source_text, result_text, size_bytes, model),
+            )
+            entry_id = cursor.lastrowid
+            if is_image:
+                self._conn.execute(
+                    "INSERT INTO images (entry_id, mime_type, width, height, source_width, source_height, raw_bytes, data) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (entry_id, source_content.mime_type, source_content.width, source_content.height,
+                     source_content.source_width, source_content.source_height, source_content.raw_bytes,
+                     source_content.data),
+                )
+            self._apply_retention()
+        logger.info(f"Added new entry #{entry_id} to history for template: {template_name}"
+                    + (f" (answered by {model})" if model else ""))
+        return entry_id
 
-    def add_entry(self, source_content: Any, template_name: str, result_text: str) -> None:
+    def get_recent(self, limit: int = HISTORY_MAX_LEN) -> List[HistoryEntry]:
+        """Возвращает последние записи без исходного контента и результата."""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {self._SUMMARY_COLUMNS} FROM entries ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._summary_from_row(row) for row in rows]
+
+    def search(self, query: str, limit: int = 200) -> List[HistoryEntry]:
         """
-        Добавляет новую запись в историю.
+        Ищет записи по исходному тексту и результату (префиксный поиск по словам).
+        Пустой запрос возвращает последние записи.
         """
-        entry = HistoryEntry(
+        match = self._fts_query(query)
+        if not match:
+            return self.get_recent(limit)
+        columns = ", ".join(f"e.{c.strip()}" for c in self._SUMMARY_COLUMNS.split(","))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {columns} FROM entries_fts JOIN entries e ON e.id = entries_fts.rowid "
+                f"WHERE entries_fts MATCH ? ORDER BY e.id DESC LIMIT ?", (match, limit)
+            ).fetchall()
+        return [self._summary_from_row(row) for row in rows]
+
+    def get_entry(self, entry_id: int) -> Optional[HistoryEntry]:
+        """Загружает запись полностью, включая изображение."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, timestamp, template_name, source_preview, source_kind, source_text, result_text, model "
+                "FROM entries WHERE id = ?", (entry_id,)
+            ).fetchone()
+            image_row = None
+            if row and row[4] == "image":
+                image_row = self._conn.execute(
+                    "SELECT data, mime_type, width, height, source_width, source_height, raw_bytes "
+                    "FROM images WHERE entry_id = ?", (entry_id,)
+                ).fetchone()
+        if row is None:
+            logger.warning(f"Could not find history entry #{entry_id}")
+            return None
+        source_content = row[5]
+        if image_row is not None:
+            source_content = EncodedImage(*image_row)
+        return HistoryEntry(
+            id=row[0],
+            timestamp=datetime.fromisoformat(row[1]),
+            template_name=row[2],
+            source_preview=row[3],
             source_content=source_content,
-            template_name=template_name,
-            result_text=result_text,
-            timestamp=datetime.now()
+            result_text=row[6],
+            model=row[7],
         )
-        self.history.appendleft(entry)
-        logger.info(f"Added new entry to history for template: {template_name}")
 
-    def get_history_display_list(self) -> List[str]:
+    def model_counts(self, template_name: Optional[str] = None) -> Dict[str, Dict[str, int]]:
         """
-        Возвращает список строк для отображения в ComboBox.
+        Сколько ответов дала каждая модель, по шаблонам: {шаблон: {модель: количество}}.
+        Показывает, как часто срабатывают дублирующие запросы к запасным моделям.
         """
-        return [str(entry) for entry in self.history]
+        query = "SELECT template_name, COALESCE(model, 'unknown'), COUNT(*) FROM entries"
+        params: Tuple[Any, ...] = ()
+        if template_name is not None:
+            query += " WHERE template_name = ?"
+            params = (template_name,)
+        with self._lock:
+            rows = self._conn.execute(query + " GROUP BY 1, 2 ORDER BY 1, 3 DESC", params).fetchall()
+        counts: Dict[str, Dict[str, int]] = {}
+        for template, model, count in rows:
+            counts.setdefault(template, {})[model] = count
+        return counts
 
-    def get_entry_by_str(self, entry_str: str) -> Optional[HistoryEntry]:
+    def get_history_display_list(self) -> List[str]:
         """
-        Находит запись в истории по ее строковому представлению.
+        Возвращает список строк для отображения в ComboBox.
         """
-        for entry in self.history:
-            if str(entry) == entry_str:
-                return entry
-        logger.warning(f"Could not find history entry for: {entry_str}")
-        return None
\ No newline at end of file
+        return [str(entry) for entry in self.get_recent()]
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def _apply_retention(self) -> None:
+        """Удаляет самые старые записи сверх лимитов по количеству и размеру. Вызывается под блокировкой."""
+        deleted = self._conn.execute(
+            "DELETE FROM entries WHERE id NOT IN (SELECT id FROM entries ORDER BY id DESC LIMIT ?)",
+            (self.max_entries,),
+        ).rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM entries").fetchone()[0]
+        if total > self.max_bytes:
+            # Оставляем самые новые записи, чья суммарная величина укладывается в лимит
+            deleted += self._conn.execute(
+                "DELETE FROM entries WHERE id IN ("
+                "  SELECT id FROM (SELECT id, SUM(size_bytes) OVER (ORDER BY id DESC) AS running FROM entries)"
+                "  WHERE running > ?)",
+                (self.max_bytes,),
+            ).rowcount
+        if deleted:
+            logger.info(f"History retention removed {deleted} old entries.")
+
+    @staticmethod
+    def _fts_query(query: str) -> str:
+        """Превращает пользовательский ввод в безопасный запрос FTS5: каждое слово — префикс."""
+        terms = [term.replace('"', '""') for term in query.split()]
+        return " ".join(f'"{term}"*' for term in terms if term)
+
+    @staticmethod
+    def _summary_from_row(row: tuple) -> HistoryEntry:
+        return HistoryEntry(
+            id=row[0],
+            timestamp=datetime.fromisoformat(row[1]),
+            template_name=row[2],
+            source_preview=row[3],
+            source_content=None,
+            result_text=None,
+        )
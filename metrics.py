@@ -0,0 +1,249 @@
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+from utils import METRICS_DUMP_INTERVAL, METRICS_WINDOW, percentile
+
+# Этапы обработки задачи в порядке выполнения
+STAGES = (
+    "detect",       # Распознавание двойного копирования в ClipboardMonitor
+    "dispatch",     # От распознавания до обработки в потоке GUI
+    "queue",        # Ожидание свободного рабочего потока
+    "prepare",      # Подготовка контента (кодирование изображения)
+    "prompt",       # Рендер промпта
+    "cache",        # Поиск в кэше ответов
+    "network",      # Запрос к провайдеру, включая ожидание квоты и повторы
+    "first_chunk",  # От отправки запроса до первого фрагмента потокового ответа
+    "deliver",      # От готовности результата до обработки в потоке GUI
+    "ui",           # Вывод результата, запись в буфер обмена и историю
+    "total",        # От двойного копирования (или нажатия Execute) до конца вывода
+)
+REPORTED_PERCENTILES = (50, 90, 99)
+STEP_PREFIX = "step:"
+
+
+@dataclass
+class TokenUsage:
+    """Токены запроса по данным провайдера (или по оценке, если провайдер их не сообщает)."""
+    prompt_tokens: int = 0
+    output_tokens: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.output_tokens
+
+
+class RequestTrace:
+    """
+    Отрезки времени (spans) по этапам одной задачи и расход токенов.
+    Время — значения time.perf_counter(); отрезки можно добавлять из любого потока.
+    Если этап встречается несколько раз (фрагменты длинного текста, дублирующие запросы),
+    его длительность считается от самого раннего начала до самого позднего конца.
+    """
+    def __init__(self, template: str, requested_model: str = "", origin: Optional[float] = None):
+        self.template = template
+        self.requested_model = requested_model  # "провайдер/модель" из шаблона
+        self.origin = origin if origin is not None else time.perf_counter()
+        self.model: Optional[str] = None  # "провайдер/модель", давшие ответ; None — ответ из кэша или ошибка
+        self.ok: Optional[bool] = None
+        self.usage = TokenUsage()
+        self.segments: Optional[Dict[str, int]] = None  # Инкрементальный режим: абзацы всего, из кэша, отправлено
+        self.spans: List[Tuple[str, float, float]] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, start: float, end: Optional[float] = None) -> None:
+        end = time.perf_counter() if end is None else end
+        with self._lock:
+            self.spans.append((stage, start, end))
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(stage, start)
+
+    def add_usage(self, usage: TokenUsage) -> None:
+        with self._lock:
+            self.usage.prompt_tokens += usage.prompt_tokens
+            self.usage.output_tokens += usage.output_tokens
+
+    def set_model(self, model: str) -> None:
+        with self._lock:
+            models = self.model.split(", ") if self.model else []
+            if model not in models:
+                self.model = ", ".join(models + [model])
+
+    @property
+    def model_label(self) -> str:
+        """Модель для группировки: ответившая, "cache" для ответа из кэша или запрошенная при ошибке."""
+        if self.model:
+            return self.model
+        return "cache" if self.ok else self.requested_model
+
+    def finish(self, ok: bool, end: Optional[float] = None) -> None:
+        """Завершает трассу: этап total — от начала до end."""
+        self.ok = ok
+        self.add_span("total", self.origin, end)
+
+    def stage_durations(self) -> Dict[str, float]:
+        """Длительность каждого этапа в секундах."""
+        with self._lock:
+            spans = list(self.spans)
+        extents: Dict[str, Tuple[float, float]] = {}
+        for stage, start, end in spans:
+            first, last = extents.get(stage, (start, end))
+            extents[stage] = (min(first, start), max(last, end))
+        return {stage: end - start for stage, (start, end) in extents.items()}
+
+    def as_dict(self) -> Dict[str, Any]:
+        durations = self.stage_durations()
+        summary = {
+            "template": self.template,
+            "model": self.model_label,
+            "ok": self.ok,
+            "stages_ms": {stage: round(durations[stage] * 1000, 2) for stage in STAGES if stage in durations},
+            "prompt_tokens": self.usage.prompt_tokens,
+            "output_tokens": self.usage.output_tokens,
+        }
+        # Шаги составного шаблона записываются отрезками "step:<имя шага>"
+        steps = {stage[len(STEP_PREFIX):]: round(seconds * 1000, 2)
+                 for stage, seconds in durations.items() if stage.startswith(STEP_PREFIX)}
+        if steps:
+            summary["steps_ms"] = steps
+        if self.segments:
+            summary["segments"] = dict(self.segments)
+        return summary
+
+
+class _Aggregate:
+    """Скользящие окна длительностей этапов и счетчики для пары шаблон/модель."""
+    def __init__(self, window: int):
+        self.count = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.output_tokens = 0
+        self.stages: Dict[str, Deque[float]] = {stage: deque(maxlen=window) for stage in STAGES}
+
+    def add(self, trace: RequestTrace) -> None:
+        self.count += 1
+        self.failed += 0 if trace.ok else 1
+        self.prompt_tokens += trace.usage.prompt_tokens
+        self.output_tokens += trace.usage.output_tokens
+        for stage, seconds in trace.stage_durations().items():
+            if stage in self.stages:
+                self.stages[stage].append(seconds * 1000)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "count": self.count,
+            "failed": self.failed,
+            "prompt_tokens": self.prompt_tokens,
+            "output_tokens": self.output_tokens,
+            "stages_ms": {
+                stage: {"samples": len(values),
+                        **{f"p{pct}": round(percentile(values, pct), 2) for pct in REPORTED_PERCENTILES}}
+                for stage, values in self.stages.items() if values
+            },
+        }
+
+
+class MetricsRegistry:
+    """
+    Собирает завершенные трассы задач и считает перцентили этапов по шаблонам и моделям
+    на последних window задачах. Сводка периодически сохраняется в JSON-файл.
+    """
+    def __init__(self, path: Optional[str] = None, window: int = METRICS_WINDOW,
+                 dump_interval: float = METRICS_DUMP_INTERVAL, recent: int = 50):
+        self.path = path
+        self.window = window
+        self.dump_interval = dump_interval
+        self.started_at = datetime.now()
+        self._aggregates: Dict[Tuple[str, str], _Aggregate] = {}
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=recent)
+        self._last_dump = 0.0
+        self._dump_pending = False
+        self._lock = threading.Lock()
+        self._dump_lock = threading.Lock()
+
+    def record(self, trace: RequestTrace) -> None:
+        """Добавляет завершенную трассу и, если пора, сохраняет сводку в фоне."""
+        key = (trace.template, trace.model_label)
+        summary = trace.as_dict()
+        with self._lock:
+            aggregate = self._aggregates.get(key)
+            if aggregate is None:
+                aggregate = self._aggregates[key] = _Aggregate(self.window)
+            aggregate.add(trace)
+            self._recent.append(summary)
+            due = (self.path and not self._dump_pending
+                   and time.monotonic() - self._last_dump >= self.dump_interval)
+            if due:
+                self._dump_pending = True
+        logger.debug(f"Job trace: {summary}")
+        if due:
+            threading.Thread(target=self._dump_in_background, name="MetricsDump", daemon=True).start()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Сводка в машиночитаемом виде: перцентили этапов, счетчики и последние трассы."""
+        with self._lock:
+            rows = [{"template": template, "model": model, **aggregate.as_dict()}
+                    for (template, model), aggregate in sorted(self._aggregates.items())]
+            recent = list(self._recent)
+        return {
+            "generated_at": datetime.now().isoformat(timespec="seconds"),
+            "started_at": self.started_at.isoformat(timespec="seconds"),
+            "window": self.window,
+            "stages": list(STAGES),
+            "by_template_model": rows,
+            "recent": recent,
+        }
+
+    def format_table(self, stages: Tuple[str, ...] = ("queue", "network", "first_chunk", "ui", "total")) -> str:
+        """Текстовая таблица p50/p90/p99 для панели статистики."""
+        rows = self.snapshot()["by_template_model"]
+        if not rows:
+            return "No completed jobs yet."
+        lines = []
+        for row in rows:
+            lines.append(f"{row['template']} | {row['model']}: {row['count']} jobs, {row['failed']} failed, "
+                         f"tokens in/out {row['prompt_tokens']}/{row['output_tokens']}")
+            for stage in stages:
+                values = row["stages_ms"].get(stage)
+                if values:
+                    lines.append(f"    {stage:<12}" + "".join(f"{f'p{pct}':>6} {values[f'p{pct}']:>9.1f} ms"
+                                                           for pct in REPORTED_PERCENTILES))
+            lines.append("")
+        return "\n".join(lines).rstrip()
+
+    def dump(self, path: Optional[str] = None) -> Optional[str]:
+        """Записывает сводку в JSON (атомарно, через временный файл). Возвращает путь."""
+        path = path or self.path
+        if not path:
+            return None
+        data = self.snapshot()
+        with self._dump_lock:
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+        return path
+
+    def _dump_in_background(self) -> None:
+        try:
+            self.dump()
+        except OSError as e:
+            logger.warning(f"Could not write metrics to {self.path}: {e}")
+        finally:
+            with self._lock:
+                self._last_dump = time.monotonic()
+                self._dump_pending = False
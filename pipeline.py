@@ -0,0 +1,173 @@
+from dataclasses import dataclass, field, replace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from imaging import DEFAULT_IMAGE_PIPELINE
+from templating import CompiledTemplate, TemplateError, validate
+from utils import PIPELINE_PARALLELISM
+
+# Вход шага по умолчанию — контент из буфера обмена
+PIPELINE_INPUT = "clipboard"
+
+PIPELINE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "required": ["name", "description", "steps"],
+    "additionalProperties": False,
+    "properties": {
+        "name": {"type": "string", "minLength": 1},
+        "description": {"type": "string"},
+        "input_type": {"type": "string", "enum": ["text", "image"]},
+        "steps": {
+            "type": "object",
+            "minProperties": 1,
+            "additionalProperties": {
+                "type": "object",
+                "required": ["template"],
+                "additionalProperties": False,
+                "properties": {
+                    "template": {"type": "string", "minLength": 1},
+                    "input": {"type": "string", "minLength": 1},
+                },
+            },
+        },
+        "output": {"type": "array", "minItems": 1, "items": {"type": "string", "minLength": 1}},
+        "parallelism": {"type": "integer", "minimum": 1},
+    },
+}
+
+
+def is_pipeline_data(data: Any) -> bool:
+    """Файл шаблона описывает конвейер, а не запрос к модели."""
+    return isinstance(data, dict) and "steps" in data
+
+
+@dataclass(frozen=True)
+class PipelineStep:
+    name: str
+    template_name: str
+    input: str = PIPELINE_INPUT  # PIPELINE_INPUT или имя другого шага
+    template: Optional[CompiledTemplate] = None  # Заполняется bind() перед запуском
+
+
+@dataclass(frozen=True)
+class CompiledPipeline:
+    """
+    Составной шаблон: небольшой граф (DAG) из существующих шаблонов.
+    Шаг получает на вход буфер обмена или результат другого шага; независимые шаги
+    выполняются параллельно. Шаги хранятся в топологическом порядке.
+    Шаблоны шагов ищутся по имени при запуске (bind), поэтому их правка подхватывается сразу.
+    """
+    name: str
+    description: str
+    input_type: str
+    steps: Tuple[PipelineStep, ...]
+    outputs: Tuple[str, ...]
+    parallelism: int = PIPELINE_PARALLELISM
+    source_path: Optional[str] = None
+    raw: Dict[str, Any] = field(default_factory=dict, compare=False, repr=False)
+
+    # Конвейер не выводит ответ по мере генерации: результат собирается из нескольких шагов
+    stream = False
+
+    @property
+    def image_pipeline(self) -> Dict[str, Any]:
+        """Настройки кодирования изображения первого шага (вход конвейера кодируется один раз)."""
+        first = self.steps[0].template
+        return first.image_pipeline if first is not None else dict(DEFAULT_IMAGE_PIPELINE)
+
+    def bind(self, get_template: Callable[[str], Any]) -> "CompiledPipeline":
+        """
+        Подставляет текущие версии шаблонов шагов.
+        :raises TemplateError: если шаблон не найден, сам является конвейером или не подходит по типу входа.
+        """
+        steps = []
+        for step in self.steps:
+            template = get_template(step.template_name)
+            if template is None:
+                raise TemplateError(f"step '{step.name}': unknown template '{step.template_name}'")
+            if not isinstance(template, CompiledTemplate):
+                raise TemplateError(f"step '{step.name}': pipelines cannot be nested ('{step.template_name}')")
+            expected = self.input_type if step.input == PIPELINE_INPUT else "text"
+            if template.input_type != expected:
+                raise TemplateError(f"step '{step.name}': template '{step.template_name}' takes "
+                                    f"{template.input_type} input, but gets {expected}")
+            steps.append(replace(step, template=template))
+        return replace(self, steps=tuple(steps))
+
+    def providers(self) -> List[str]:
+        """Провайдеры шагов (после bind)."""
+        return sorted({step.template.api_provider for step in self.steps if step.template is not None})
+
+
+@dataclass
+class PipelineResult:
+    """Результаты и время выполнения шагов конвейера."""
+    outputs: Tuple[str, ...]
+    results: Dict[str, Optional[str]] = field(default_factory=dict)  # None — шаг завершился ошибкой
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    skipped: List[str] = field(default_factory=list)  # Не запускались из-за ошибки предыдущего шага
+
+    @property
+    def ok(self) -> bool:
+        """Хотя бы один выходной шаг дал результат."""
+        return any(self.results.get(name) is not None for name in self.outputs)
+
+    def output_texts(self) -> Dict[str, str]:
+        """Тексты выходных шагов; для неудачных — пометка об ошибке."""
+        return {name: self.results[name] if self.results.get(name) is not None
+                else ("[Skipped: an earlier step failed]" if name in self.skipped else "[Step failed]")
+                for name in self.outputs}
+
+    def combined_text(self) -> Optional[str]:
+        """Текст для буфера обмена и истории: единственный выход или все выходы с заголовками."""
+        if not self.ok:
+            return None
+        texts = self.output_texts()
+        if len(texts) == 1:
+            return next(iter(texts.values()))
+        return "\n\n".join(f"### {name}\n\n{text}" for name, text in texts.items())
+
+
+def compile_pipeline(data: Any, source_path: Optional[str] = None) -> CompiledPipeline:
+    """
+    Проверяет описание конвейера по схеме, ссылки между шагами и отсутствие циклов.
+    :raises TemplateError: если описание некорректно.
+    """
+    errors = validate(data, PIPELINE_SCHEMA)
+    if errors:
+        raise TemplateError("; ".join(errors))
+
+    specs = data["steps"]
+    if PIPELINE_INPUT in specs:
+        raise TemplateError(f"$.steps: '{PIPELINE_INPUT}' is reserved for the pipeline input")
+    for name, spec in specs.items():
+        source = spec.get("input", PIPELINE_INPUT)
+        if source != PIPELINE_INPUT and source not in specs:
+            raise TemplateError(f"$.steps.{name}.input: unknown step '{source}'")
+
+    # Топологическая сортировка; порядок описания сохраняется для независимых шагов
+    ordered: List[str] = []
+    while len(ordered) < len(specs):
+        ready = [name for name, spec in specs.items() if name not in ordered
+                 and spec.get("input", PIPELINE_INPUT) in (PIPELINE_INPUT, *ordered)]
+        if not ready:
+            cycle = [name for name in specs if name not in ordered]
+            raise TemplateError(f"$.steps: steps form a cycle: {', '.join(cycle)}")
+        ordered.extend(ready)
+
+    consumed = {spec.get("input") for spec in specs.values()}
+    outputs = tuple(data.get("output") or [name for name in specs if name not in consumed])
+    for name in outputs:
+        if name not in specs:
+            raise TemplateError(f"$.output: unknown step '{name}'")
+
+    return CompiledPipeline(
+        name=data["name"],
+        description=data["description"],
+        input_type=data.get("input_type", "text"),
+        steps=tuple(PipelineStep(name, specs[name]["template"], specs[name].get("input", PIPELINE_INPUT))
+                    for name in ordered),
+        outputs=outputs,
+        parallelism=data.get("parallelism", PIPELINE_PARALLELISM),
+        source_path=source_path,
+        raw=data,
+    )
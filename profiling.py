@@ -0,0 +1,397 @@
+import os
+import sys
+import json
+import time
+import builtins
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import datetime
+from types import CodeType, FrameType
+from typing import Any, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from utils import PROFILE_DIR, PROFILE_INTERVAL_MS, PROFILE_MEMORY_FRAMES, PROFILE_MEMORY_INTERVAL_S, PROFILE_TOP
+
+
+class ImportTimer:
+    """
+    Считает собственное время импорта модулей, сгруппированное по пакету верхнего уровня.
+    Работает через подмену builtins.__import__, поэтому включается только в режиме профилирования.
+    """
+    def __init__(self):
+        self.self_times: Dict[str, float] = defaultdict(float)
+        self._original_import = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def install(self) -> None:
+        if self._original_import is None:
+            self._original_import = builtins.__import__
+            builtins.__import__ = self._timed_import
+
+    def uninstall(self) -> None:
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if not self._is_new_import(name, globals, fromlist, level):
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)  # Время вложенных импортов
+        started = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - started
+            children = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            package = self._resolve(name, globals, level).partition(".")[0]
+            with self._lock:
+                self.self_times[package] += elapsed - children
+
+    @staticmethod
+    def _resolve(name: str, globals: Optional[Dict[str, Any]], level: int) -> str:
+        if level and globals:
+            return globals.get("__package__") or globals.get("__name__", name)
+        return name
+
+    def _is_new_import(self, name, globals, fromlist, level) -> bool:
+        full_name = self._resolve(name, globals, level) + (f".{name}" if level and name else "")
+        if full_name not in sys.modules:
+            return True
+        return any(f"{full_name}.{item}" not in sys.modules and not hasattr(sys.modules[full_name], item)
+                   for item in (fromlist or ()) if item != "*")
+
+    def top(self, limit: int = 15) -> List[Tuple[str, float]]:
+        with self._lock:
+            return sorted(self.self_times.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+
+class StartupProfile:
+    """
+    Профиль запуска: отметки фаз инициализации и время импорта по пакетам.
+    Отметки можно ставить из любого потока.
+    """
+    def __init__(self, trace_imports: bool = True):
+        self.started = time.perf_counter()
+        self.phases: List[Tuple[str, float, str]] = []  # (фаза, секунды от старта, поток)
+        self.imports = ImportTimer()
+        self._lock = threading.Lock()
+        if trace_imports:
+            self.imports.install()
+
+    def mark(self, phase: str) -> None:
+        """Отмечает завершение фазы."""
+        with self._lock:
+            self.phases.append((phase, time.perf_counter() - self.started, threading.current_thread().name))
+
+    def elapsed_ms(self, phase: str) -> Optional[float]:
+        """Время от старта до отметки фазы в миллисекундах."""
+        with self._lock:
+            for name, at, _ in self.phases:
+                if name == phase:
+                    return at * 1000
+        return None
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            phases = [{"phase": name, "at_ms": round(at * 1000, 1), "thread": thread} for name, at, thread in self.phases]
+        return {
+            "phases": phases,
+            "imports_ms": {package: round(seconds * 1000, 1) for package, seconds in self.imports.top(limit=50)},
+        }
+
+    def format_report(self, import_limit: int = 15) -> str:
+        """Возвращает текстовый отчет: фазы с длительностью и самые дорогие импорты."""
+        lines = ["Startup profile", "", f"{'phase':<36}{'at, ms':>10}{'took, ms':>10}  thread"]
+        previous: Dict[str, float] = {}
+        with self._lock:
+            phases = list(self.phases)
+        for name, at, thread in phases:
+            took = at - previous.get(thread, 0.0)
+            previous[thread] = at
+            lines.append(f"{name:<36}{at * 1000:>10.1f}{took * 1000:>10.1f}  {thread}")
+        lines += ["", f"{'imported package (self time)':<36}{'ms':>10}"]
+        for package, seconds in self.imports.top(import_limit):
+            lines.append(f"{package:<36}{seconds * 1000:>10.1f}")
+        return "\n".join(lines)
+
+    def write_json(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+class StallMonitor:
+    """
+    Измеряет зависания mainloop: пульс через after(interval_ms) и самый большой сдвиг
+    его срабатывания относительно расписания. Работает с любым виджетом Tk, пока запущен.
+    """
+    def __init__(self, widget: Any, interval_ms: int = 20):
+        self.widget = widget
+        self.interval = interval_ms / 1000
+        self.max_stall_ms = 0.0
+        self.beats = 0
+        self._expected: Optional[float] = None
+        self._after_id: Optional[str] = None
+
+    def start(self) -> None:
+        if self._after_id is None:
+            self._expected = time.perf_counter() + self.interval
+            self._after_id = self.widget.after(int(self.interval * 1000), self._beat)
+
+    def stop(self) -> None:
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+
+    def reset(self) -> None:
+        self.max_stall_ms = 0.0
+        self.beats = 0
+
+    def _beat(self) -> None:
+        now = time.perf_counter()
+        self.max_stall_ms = max(self.max_stall_ms, (now - self._expected) * 1000)
+        self.beats += 1
+        self._expected = now + self.interval
+        self._after_id = self.widget.after(int(self.interval * 1000), self._beat)
+
+
+# Функции, в которых поток ждет (событие, очередь, сообщения окна), а не работает.
+# Выборка, у которой такая функция на вершине стека, считается простоем потока.
+IDLE_FUNCTIONS = frozenset({
+    "threading.Condition.wait",
+    "threading.Event.wait",
+    "threading.Thread.join",
+    "threading.Thread._wait_for_tstate_lock",
+    "queue.Queue.get",
+    "selectors.SelectSelector.select",
+    "selectors.EpollSelector.select",
+    "selectors.KqueueSelector.select",
+    "socket.socket.accept",
+    "concurrent.futures.thread._worker",
+    "tkinter.Misc.mainloop",
+    "background.ClipboardMonitor.run",  # Внутри win32gui.PumpMessages
+})
+
+
+class SamplingProfiler:
+    """
+    Профилировщик работающего приложения, включаемый и выключаемый на лету.
+    Фоновый поток каждые interval_ms снимает стеки всех потоков (mainloop Tk, ClipboardMonitor,
+    рабочие потоки JobEngine) и считает функции: собственные выборки, выборки вместе с вызванными
+    и свернутые стеки. При memory=True tracemalloc сравнивает память в начале и в конце профилирования.
+    stop() пишет отчет в profiles/profile-<время>.txt и стеки для flamegraph в ...-stacks.txt.
+    Пока профилирование выключено, не работает ни поток, ни tracemalloc.
+    """
+    MAX_DEPTH = 64
+
+    def __init__(self, directory: str = PROFILE_DIR, interval_ms: float = PROFILE_INTERVAL_MS, top: int = PROFILE_TOP,
+                 memory: bool = True, memory_frames: int = PROFILE_MEMORY_FRAMES,
+                 memory_interval_s: float = PROFILE_MEMORY_INTERVAL_S):
+        self.directory = directory
+        self.interval = interval_ms / 1000
+        self.top = top
+        self.memory = memory
+        self.memory_frames = memory_frames
+        self.memory_interval = memory_interval_s
+        self.last_report: Optional[str] = None
+        self.last_report_path: Optional[str] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._reset()
+
+    @classmethod
+    def from_settings(cls, settings: Optional[Dict[str, Any]]) -> "SamplingProfiler":
+        """Создает профилировщик по разделу "profiling" настроек; "enabled" решает только, запускать ли его сразу."""
+        options = dict(settings or {})
+        options.pop("enabled", None)
+        return cls(**options)
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def _reset(self) -> None:
+        self.samples = 0
+        self.sampling_seconds = 0.0  # Время самого профилировщика на снятие стеков
+        self.started_at: Optional[datetime] = None
+        self._started = 0.0
+        self._duration = 0.0
+        self._thread_samples: Counter = Counter()
+        self._thread_busy: Counter = Counter()
+        self._self_counts: Counter = Counter()  # (поток, функция) -> выборки на вершине стека
+        self._total_counts: Counter = Counter()  # (поток, функция) -> выборки в любом месте стека
+        self._stacks: Counter = Counter()  # "поток;внешняя;...;внутренняя" -> выборки
+        self._labels: Dict[CodeType, str] = {}
+        self._memory_timeline: List[Tuple[float, int]] = []  # (секунды от старта, байты)
+        self._memory_baseline: Optional[tracemalloc.Snapshot] = None
+        self._memory_growth: List[tracemalloc.StatisticDiff] = []
+        self._owns_tracemalloc = False
+
+    def start(self) -> None:
+        """Начинает профилирование; прежние данные сбрасываются."""
+        if self.running:
+            return
+        with self._lock:
+            self._reset()
+            self.started_at = datetime.now()
+            self._started = time.perf_counter()
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(self.memory_frames)
+                self._owns_tracemalloc = True
+            self._memory_baseline = tracemalloc.take_snapshot()
+            self._memory_timeline.append((0.0, tracemalloc.get_traced_memory()[0]))
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="SamplingProfiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Profiling started (every {self.interval * 1000:.0f} ms, memory: {self.memory}).")
+
+    def stop(self) -> Optional[str]:
+        """Останавливает профилирование и пишет отчет. Возвращает путь к отчету (None — не удалось записать)."""
+        if not self.running:
+            return None
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        with self._lock:
+            self._duration = time.perf_counter() - self._started
+        if self._memory_baseline is not None:
+            snapshot = tracemalloc.take_snapshot().filter_traces(
+                (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__, all_frames=True)))
+            self._memory_timeline.append((self._duration, tracemalloc.get_traced_memory()[0]))
+            self._memory_growth = snapshot.compare_to(self._memory_baseline, "traceback")
+            self._memory_baseline = None
+            if self._owns_tracemalloc:
+                tracemalloc.stop()
+        self.last_report = self.format_report()
+        self.last_report_path = self._write_report(self.last_report)
+        logger.info(f"Profiling stopped after {self._duration:.1f} s, {self.samples} samples. "
+                    f"Report: {self.last_report_path}")
+        return self.last_report_path
+
+    def summary(self, top: int = 5) -> str:
+        """Короткая сводка для окна: текущее профилирование или последний отчет."""
+        if not self.running and self.last_report is None:
+            return "Profiling: off"
+        return self.format_report(top)
+
+    def _run(self) -> None:
+        own_id = threading.get_ident()
+        next_memory = time.perf_counter() + self.memory_interval
+        while not self._stop_event.wait(self.interval):
+            started = time.perf_counter()
+            self._sample(own_id)
+            finished = time.perf_counter()
+            if self.memory and finished >= next_memory:
+                next_memory = finished + self.memory_interval
+                self._memory_timeline.append((finished - self._started, tracemalloc.get_traced_memory()[0]))
+            with self._lock:
+                self.sampling_seconds += finished - started
+
+    def _sample(self, own_id: int) -> None:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        with self._lock:
+            self.samples += 1
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                thread = names.get(thread_id, f"thread-{thread_id}")
+                stack = self._stack(frame)
+                self._thread_samples[thread] += 1
+                if stack[-1] in IDLE_FUNCTIONS:
+                    continue
+                self._thread_busy[thread] += 1
+                self._self_counts[thread, stack[-1]] += 1
+                for label in set(stack):
+                    self._total_counts[thread, label] += 1
+                self._stacks[";".join((thread, *stack))] += 1
+        del frames
+
+    def _stack(self, frame: Optional[FrameType]) -> List[str]:
+        """Стек от внешней функции к внутренней, не глубже MAX_DEPTH."""
+        stack = []
+        while frame is not None and len(stack) < self.MAX_DEPTH:
+            code = frame.f_code
+            label = self._labels.get(code)
+            if label is None:
+                label = self._labels[code] = f"{frame.f_globals.get('__name__', '?')}.{code.co_qualname}"
+            stack.append(label)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def format_report(self, top: Optional[int] = None) -> str:
+        """Текстовый отчет: потоки, самые частые функции, свернутые стеки и рост памяти."""
+        top = top or self.top
+        with self._lock:
+            duration = self._duration if not self.running else time.perf_counter() - self._started
+            samples, sampling_seconds = self.samples, self.sampling_seconds
+            thread_samples, thread_busy = Counter(self._thread_samples), Counter(self._thread_busy)
+            self_counts = self._self_counts.most_common(top)
+            total_counts = self._total_counts.most_common(top)
+        overhead = sampling_seconds / duration * 100 if duration else 0.0
+        state = "running" if self.running else "finished"
+        lines = [f"Profile {state}: {self.started_at:%Y-%m-%d %H:%M:%S}, {duration:.1f} s, {samples} samples every "
+                 f"{self.interval * 1000:.0f} ms (sampling took {overhead:.1f}% of one core)",
+                 "", f"{'thread':<32}{'busy':>8}{'samples':>10}"]
+        for thread, count in thread_samples.most_common():
+            lines.append(f"{thread:<32}{thread_busy[thread]:>8}{count:>10}")
+        for title, counts in (("own samples", self_counts), ("samples with callees", total_counts)):
+            lines += ["", f"Top functions by {title}", f"{'samples':>8}{'%':>7}  function [thread]"]
+            for (thread, label), count in counts:
+                share = count / thread_busy[thread] * 100 if thread_busy[thread] else 0.0
+                lines.append(f"{count:>8}{share:>6.1f}%  {label} [{thread}]")
+        lines += self._format_memory(top)
+        return "\n".join(lines)
+
+    def _format_memory(self, top: int) -> List[str]:
+        if not self.memory:
+            return []
+        lines = ["", "Traced memory: " + ", ".join(f"{at:.0f} s: {size / 1024 / 1024:.1f} MB"
+                                                for at, size in self._memory_timeline[-10:])]
+        if self.running:
+            current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (0, 0)
+            lines.append(f"Now {current / 1024 / 1024:.1f} MB, peak {peak / 1024 / 1024:.1f} MB; "
+                         f"growth by line is reported when profiling stops")
+            return lines
+        lines += ["", "Top memory growth since start", f"{'KB':>10}{'blocks':>9}  allocated at (callers below)"]
+        for stat in self._memory_growth[:top]:
+            if stat.size_diff <= 0:
+                break
+            frames = [f"{self._short_path(frame.filename)}:{frame.lineno}" for frame in reversed(stat.traceback)]
+            lines.append(f"{stat.size_diff / 1024:>+10.1f}{stat.count_diff:>+9}  {frames[0]}")
+            lines += [f"{'':>21}{frame}" for frame in frames[1:3]]
+        return lines
+
+    @staticmethod
+    def _short_path(path: str) -> str:
+        """Путь внутри проекта — относительный, иначе (стандартная библиотека, пакеты) — два последних компонента."""
+        try:
+            relative = os.path.relpath(path)
+        except ValueError:  # Другой диск в Windows
+            relative = ".."
+        if not relative.startswith(".."):
+            return relative
+        return os.path.join(*path.replace("\\", "/").split("/")[-2:])
+
+    def _write_report(self, report: str) -> Optional[str]:
+        base = os.path.join(self.directory, f"profile-{self.started_at:%Y%m%d-%H%M%S}")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{base}.txt", "w", encoding="utf-8") as f:
+                f.write(report + "\n")
+            # Свернутые стеки: формат flamegraph.pl и speedscope
+            with open(f"{base}-stacks.txt", "w", encoding="utf-8") as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in self._stacks.most_common())
+        except OSError as e:
+            logger.warning(f"Could not write profile report to {base}.txt: {e}")
+            return None
+        return f"{base}.txt"
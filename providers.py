@@ -0,0 +1,504 @@
+import os
+import ssl
+import json
+import math
+import time
+import base64
+import random
+import threading
+import http.client
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from chunking import estimate_tokens
+from imaging import EncodedImage
+from metrics import TokenUsage
+from resilience import RequestCancelled
+from templating import CompiledTemplate
+
+# Ошибки, при которых запрос по переиспользованному keep-alive соединению можно повторить на новом
+_STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                            ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+
+class ProviderError(RuntimeError):
+    """Ошибка обращения к провайдеру LLM. status и retry_after заполняются для HTTP-ответов."""
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+class Provider:
+    """
+    Интерфейс провайдера LLM. Провайдер держит свои соединения или клиентов
+    между запросами и должен быть потокобезопасным.
+    """
+    name: str = ""
+
+    def generate(self, template: CompiledTemplate, prompt: str, content: Any,
+                 on_chunk: Optional[Callable[[str], None]] = None,
+                 cancel: Optional[threading.Event] = None,
+                 on_usage: Optional[Callable[[TokenUsage], None]] = None) -> str:
+        """
+        Выполняет запрос. Если задан on_chunk, ответ читается потоком.
+        Установленный cancel прерывает чтение потока (RequestCancelled); обычный запрос
+        прервать нельзя, его результат просто отбрасывается.
+        on_usage получает расход токенов из метаданных ответа, если провайдер их сообщает.
+        :raises Exception: при любой ошибке; вызывающая сторона логирует ее и возвращает None.
+        """
+        raise NotImplementedError
+
+    def warm_up(self, template: CompiledTemplate) -> None:
+        """Заранее устанавливает соединение для модели шаблона."""
+
+    def close(self) -> None:
+        """Освобождает соединения."""
+
+
+class HTTPConnectionPool:
+    """
+    Пул постоянных (keep-alive) HTTP-соединений к одному хосту.
+    Соединение возвращается в пул, только если ответ прочитан полностью.
+    """
+    def __init__(self, base_url: str, size: int = 4, timeout: float = 120.0):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"Invalid base URL: {base_url!r}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.created = 0
+        self.reused = 0
+        self._idle: List[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+        self._ssl_context = ssl.create_default_context() if parts.scheme == "https" else None
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        with self._lock:
+            self.created += 1
+        if self._ssl_context is not None:
+            return http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout, context=self._ssl_context)
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _acquire(self) -> Tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _release(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def connect(self) -> None:
+        """Открывает соединение заранее и кладет его в пул."""
+        conn = self._new_connection()
+        conn.connect()
+        self._release(conn)
+
+    @contextmanager
+    def request(self, method: str, path: str, body: Optional[bytes] = None,
+                headers: Optional[Dict[str, str]] = None) -> Iterator[http.client.HTTPResponse]:
+        """
+        Отправляет запрос и отдает ответ. Если переиспользованное соединение
+        оказалось закрытым сервером, запрос один раз повторяется на новом.
+        """
+        conn, reused = self._acquire()
+        while True:
+            try:
+                conn.request(method, self.base_path + path, body=body, headers=headers or {})
+                response = conn.getresponse()
+                break
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self._new_connection(), False
+            except Exception:
+                conn.close()
+                raise
+
+        try:
+            yield response
+        except BaseException:
+            conn.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            self._release(conn)
+        else:
+            conn.close()
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After в секундах (форму с датой не поддерживаем)."""
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+class GeminiProvider(Provider):
+    """
+    Google Gemini через официальный SDK. Модели хранятся в пуле по имени и generation_config,
+    SDK переиспользует соединения внутри модели.
+    """
+    def __init__(self, name: str = "gemini", api_key_env: str = "GEMINI_API_KEY",
+                 model_factory: Optional[Callable[..., Any]] = None):
+        self.name = name
+        api_key = os.getenv(api_key_env)
+        if not api_key:
+            raise ValueError(f"{api_key_env} is not set in environment variables.")
+        # SDK импортируется здесь, а не при загрузке модуля: это самый тяжелый импорт приложения
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._model_factory = model_factory or genai.GenerativeModel
+        # Пул моделей: ключ — имя модели и сериализованный generation_config
+        self._models: Dict[Tuple[str, str], Any] = {}
+        self._models_lock = threading.Lock()
+        logger.info("Gemini API configured.")
+
+    def _get_model(self, template: CompiledTemplate) -> Any:
+        """
+        Возвращает модель из пула, создавая ее при первом обращении.
+        """
+        key = (template.model, template.generation_config_key)
+        with self._models_lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._model_factory(template.model, generation_config=template.generation_config or None)
+                self._models[key] = model
+                logger.debug(f"Created GenerativeModel '{template.model}' (pool size: {len(self._models)}).")
+        return model
+
+    def warm_up(self, template: CompiledTemplate) -> None:
+        # Дешевый запрос count_tokens устанавливает соединение заранее
+        self._get_model(template).count_tokens("ping")
+
+    def generate(self, template: CompiledTemplate, prompt: str, content: Any,
+                 on_chunk: Optional[Callable[[str], None]] = None,
+                 cancel: Optional[threading.Event] = None,
+                 on_usage: Optional[Callable[[TokenUsage], None]] = None) -> str:
+        model = self._get_model(template)
+        # Для vision моделей передаем промпт и заранее закодированное изображение
+        request_parts = [prompt, content.to_blob()] if isinstance(content, EncodedImage) else prompt
+        if on_chunk is None:
+            response = model.generate_content(request_parts)
+            self._report_usage(response, on_usage)
+            return response.text.strip()
+
+        started = time.perf_counter()
+        parts = []
+        response = model.generate_content(request_parts, stream=True)
+        for chunk in response:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled(f"{self.name}: stream from '{template.model}' cancelled")
+            try:
+                text = chunk.text
+            except ValueError:
+                # Служебные фрагменты (например, только finish_reason) не содержат текста
+                continue
+            if not text:
+                continue
+            if not parts:
+                logger.info(f"First token received after {(time.perf_counter() - started) * 1000:.0f} ms.")
+            parts.append(text)
+            on_chunk(text)
+        self._report_usage(response, on_usage)
+        return "".join(parts).strip()
+
+    @staticmethod
+    def _report_usage(response: Any, on_usage: Optional[Callable[[TokenUsage], None]]) -> None:
+        # В потоковом режиме usage_metadata приходит с последним фрагментом
+        metadata = getattr(response, "usage_metadata", None)
+        if on_usage and metadata is not None:
+            on_usage(TokenUsage(prompt_tokens=getattr(metadata, "prompt_token_count", 0) or 0,
+                                output_tokens=getattr(metadata, "candidates_token_count", 0) or 0))
+
+
+class OpenAICompatibleProvider(Provider):
+    """
+    Сервер с API /chat/completions в формате OpenAI (vLLM, llama.cpp, Ollama, LM Studio и т.п.).
+    Использует пул keep-alive соединений и потоковый ответ в формате SSE.
+    """
+    # Ключи generation_config в стиле Gemini и их аналоги в OpenAI API
+    _CONFIG_KEYS = {
+        "temperature": "temperature",
+        "top_p": "top_p",
+        "max_output_tokens": "max_tokens",
+        "stop_sequences": "stop",
+        "presence_penalty": "presence_penalty",
+        "frequency_penalty": "frequency_penalty",
+        "seed": "seed",
+    }
+
+    def __init__(self, name: str, base_url: str, api_key_env: Optional[str] = None,
+                 pool_size: int = 4, timeout: float = 120.0):
+        self.name = name
+        self.pool = HTTPConnectionPool(base_url, size=pool_size, timeout=timeout)
+        self._headers = {"Content-Type": "application/json", "Accept": "application/json, text/event-stream"}
+        api_key = os.getenv(api_key_env) if api_key_env else None
+        if api_key:
+            self._headers["Authorization"] = f"Bearer {api_key}"
+        logger.info(f"OpenAI-compatible provider '{name}' configured for {base_url} (pool size {self.pool.size}).")
+
+    def warm_up(self, template: CompiledTemplate) -> None:
+        self.pool.connect()
+
+    def _build_body(self, template: CompiledTemplate, prompt: str, content: Any, stream: bool) -> bytes:
+        if isinstance(content, EncodedImage):
+            data_url = f"data:{content.mime_type};base64,{base64.b64encode(content.data).decode('ascii')}"
+            message_content: Any = [{"type": "text", "text": prompt},
+                                    {"type": "image_url", "image_url": {"url": data_url}}]
+        else:
+            message_content = prompt
+        body = {"model": template.model, "messages": [{"role": "user", "content": message_content}], "stream": stream}
+        if stream:
+            # Расход токенов приходит последним событием потока
+            body["stream_options"] = {"include_usage": True}
+        for key, value in template.generation_config.items():
+            if key in self._CONFIG_KEYS:
+                body[self._CONFIG_KEYS[key]] = value
+        return json.dumps(body, ensure_ascii=False).encode("utf-8")
+
+    def generate(self, template: CompiledTemplate, prompt: str, content: Any,
+                 on_chunk: Optional[Callable[[str], None]] = None,
+                 cancel: Optional[threading.Event] = None,
+                 on_usage: Optional[Callable[[TokenUsage], None]] = None) -> str:
+        body = self._build_body(template, prompt, content, stream=on_chunk is not None)
+        with self.pool.request("POST", "/chat/completions", body=body, headers=self._headers) as response:
+            if response.status != 200:
+                raise ProviderError(f"{self.name}: HTTP {response.status}: {response.read()[:500].decode('utf-8', 'replace')}",
+                                    status=response.status, retry_after=_parse_retry_after(response.getheader("Retry-After")))
+            if on_chunk is None:
+                data = json.loads(response.read())
+                self._report_usage(data, on_usage)
+                return (data["choices"][0]["message"]["content"] or "").strip()
+            return self._read_stream(response, on_chunk, cancel, on_usage)
+
+    @staticmethod
+    def _report_usage(data: Dict[str, Any], on_usage: Optional[Callable[[TokenUsage], None]]) -> None:
+        usage = data.get("usage")
+        if on_usage and usage:
+            on_usage(TokenUsage(prompt_tokens=usage.get("prompt_tokens") or 0,
+                                output_tokens=usage.get("completion_tokens") or 0))
+
+    def _read_stream(self, response: http.client.HTTPResponse, on_chunk: Callable[[str], None],
+                     cancel: Optional[threading.Event] = None,
+                     on_usage: Optional[Callable[[TokenUsage], None]] = None) -> str:
+        """
+        Разбирает события SSE 'data: {...}' до 'data: [DONE]'. При отмене исключение
+        выходит из pool.request, и недочитанное соединение закрывается.
+        """
+        started = time.perf_counter()
+        parts = []
+        for raw_line in response:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled(f"{self.name}: stream cancelled")
+            line = raw_line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            payload = line[5:].strip()
+            if payload == b"[DONE]":
+                break
+            event = json.loads(payload)
+            self._report_usage(event, on_usage)
+            choices = event.get("choices") or []
+            text = (choices[0].get("delta") or {}).get("content") if choices else None
+            if not text:
+                continue
+            if not parts:
+                logger.info(f"First token from '{self.name}' after {(time.perf_counter() - started) * 1000:.0f} ms.")
+            parts.append(text)
+            on_chunk(text)
+        # Дочитываем остаток, чтобы соединение можно было вернуть в пул
+        response.read()
+        return "".join(parts).strip()
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+class FakeProvider(Provider):
+    """
+    Провайдер в памяти для офлайн-проверки и бенчмарков: отвечает с заданной задержкой.
+    По умолчанию возвращает исходный текст (для изображений — его размеры).
+    Распределение задержки: "uniform" (latency_ms ± jitter_ms), "lognormal" (медиана latency_ms,
+    разброс sigma — длинный хвост, как у реальных API) или "exponential" (среднее latency_ms).
+    """
+    DISTRIBUTIONS = ("uniform", "lognormal", "exponential")
+
+    def __init__(self, name: str = "fake", latency_ms: float = 200.0, jitter_ms: float = 0.0,
+                 stream_chunks: int = 8, failure_rate: float = 0.0, reply: Optional[str] = None,
+                 seed: Optional[int] = None, distribution: str = "uniform", sigma: float = 0.5):
+        if distribution not in self.DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution '{distribution}'. Available: {', '.join(self.DISTRIBUTIONS)}")
+        self.name = name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.distribution = distribution
+        self.sigma = sigma
+        self.stream_chunks = max(1, stream_chunks)
+        self.failure_rate = failure_rate
+        self.reply = reply
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sample_latency_ms(self) -> float:
+        """Вызывается под блокировкой."""
+        if self.latency_ms <= 0:
+            return 0.0
+        if self.distribution == "lognormal":
+            return self._random.lognormvariate(math.log(self.latency_ms), self.sigma)
+        if self.distribution == "exponential":
+            return self._random.expovariate(1.0 / self.latency_ms)
+        jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0.0
+        return self.latency_ms + jitter
+
+    def _next_latency(self) -> Tuple[float, bool]:
+        with self._lock:
+            self.calls += 1
+            return max(0.0, self._sample_latency_ms()) / 1000, self._random.random() < self.failure_rate
+
+    def generate(self, template: CompiledTemplate, prompt: str, content: Any,
+                 on_chunk: Optional[Callable[[str], None]] = None,
+                 cancel: Optional[threading.Event] = None,
+                 on_usage: Optional[Callable[[TokenUsage], None]] = None) -> str:
+        latency, fail = self._next_latency()
+        if isinstance(content, EncodedImage):
+            text = self.reply or f"[{template.model}] image {content.width}x{content.height}"
+        else:
+            text = self.reply if self.reply is not None else str(content)
+        wait = cancel.wait if cancel is not None else time.sleep
+        if on_chunk is None:
+            if wait(latency):
+                raise RequestCancelled(f"{self.name}: request cancelled")
+            if fail:
+                raise ProviderError(f"{self.name}: simulated failure")
+            return self._complete(prompt, text, on_usage)
+
+        size = max(1, -(-len(text) // self.stream_chunks))
+        pieces = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+        for piece in pieces:
+            if wait(latency / len(pieces)):
+                raise RequestCancelled(f"{self.name}: stream cancelled")
+            if fail:
+                raise ProviderError(f"{self.name}: simulated failure")
+            on_chunk(piece)
+        return self._complete(prompt, text, on_usage)
+
+    @staticmethod
+    def _complete(prompt: str, text: str, on_usage: Optional[Callable[[TokenUsage], None]]) -> str:
+        if on_usage:
+            # Вместо метаданных ответа сообщаем оценку токенов
+            on_usage(TokenUsage(prompt_tokens=estimate_tokens(prompt), output_tokens=estimate_tokens(text)))
+        return text
+
+
+# Типы провайдеров, которые можно указать в settings.json
+PROVIDER_TYPES: Dict[str, Callable[..., Provider]] = {
+    "gemini": GeminiProvider,
+    "openai": OpenAICompatibleProvider,
+    "fake": FakeProvider,
+}
+
+DEFAULT_PROVIDERS: Dict[str, Dict[str, Any]] = {
+    "gemini": {"type": "gemini"},
+    "fake": {"type": "fake"},
+}
+
+
+class ProviderRegistry:
+    """
+    Реестр провайдеров по имени. Провайдер создается при первом обращении,
+    поэтому SDK и соединения не поднимаются для неиспользуемых провайдеров.
+    """
+    def __init__(self):
+        self._factories: Dict[str, Callable[[], Provider]] = {}
+        self._instances: Dict[str, Provider] = {}
+        # По замку на имя: провайдер создается один раз, а _lock на время создания не держится
+        self._creating: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, config: Optional[Dict[str, Dict[str, Any]]] = None) -> "ProviderRegistry":
+        """
+        Создает реестр из настроек вида {"имя": {"type": "openai", "base_url": ...}}.
+        Провайдеры по умолчанию ("gemini", "fake") можно переопределить.
+        """
+        registry = cls()
+        for name, options in {**DEFAULT_PROVIDERS, **(config or {})}.items():
+            options = dict(options)
+            provider_type = options.pop("type", name)
+            if provider_type not in PROVIDER_TYPES:
+                logger.error(f"Unknown type '{provider_type}' for provider '{name}'. "
+                             f"Available: {', '.join(PROVIDER_TYPES)}")
+                continue
+            registry.register_factory(name, lambda t=provider_type, n=name, o=options: PROVIDER_TYPES[t](name=n, **o))
+        return registry
+
+    def register_factory(self, name: str, factory: Callable[[], Provider]) -> None:
+        with self._lock:
+            self._factories[name] = factory
+            self._instances.pop(name, None)
+
+    def register(self, provider: Provider) -> None:
+        """Регистрирует уже созданный провайдер под его именем."""
+        with self._lock:
+            self._factories[provider.name] = lambda: provider
+            self._instances[provider.name] = provider
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return sorted(self._factories)
+
+    def get(self, name: str) -> Provider:
+        """
+        Возвращает провайдер, создавая его при первом обращении.
+        :raises KeyError: если провайдер не зарегистрирован.
+        """
+        with self._lock:
+            provider = self._instances.get(name)
+            if provider is not None:
+                return provider
+            if name not in self._factories:
+                raise KeyError(name)
+            creating = self._creating.setdefault(name, threading.Lock())
+        # Фабрика может импортировать SDK и открывать соединения: остальные провайдеры тем временем доступны
+        with creating:
+            with self._lock:
+                provider = self._instances.get(name)
+                if provider is not None:
+                    return provider
+                factory = self._factories[name]
+            provider = factory()
+            with self._lock:
+                if self._factories.get(name) is factory:
+                    self._instances[name] = provider
+                    return provider
+        # Пока провайдер создавался, имя зарегистрировали заново: созданный экземпляр устарел
+        provider.close()
+        return self.get(name)
+
+    def close(self) -> None:
+        with self._lock:
+            instances, self._instances = list(self._instances.values()), {}
+        for provider in instances:
+            provider.close()
@@ -0,0 +1,282 @@
+import time
+import random
+import socket
+import threading
+import http.client
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+
+# HTTP-коды, после которых запрос имеет смысл повторить
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+# Исключения google.api_core без импорта самого SDK
+_RETRYABLE_ERROR_NAMES = {"ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "InternalServerError",
+                          "DeadlineExceeded", "GatewayTimeout", "BadGateway", "RetryError"}
+_RETRYABLE_ERROR_TYPES = (ConnectionError, TimeoutError, socket.timeout, http.client.HTTPException)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+StatusCallback = Callable[[Optional[str]], None]
+
+
+class CircuitOpenError(RuntimeError):
+    """Запрос отклонен без обращения к провайдеру: цепь разомкнута."""
+
+
+class RequestCancelled(RuntimeError):
+    """Запрос отменен вызывающей стороной (например, дублирующий запрос уже получил ответ)."""
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """Возвращает HTTP-код ошибки провайдера, если он известен."""
+    status = getattr(error, "status", None) or getattr(error, "code", None)
+    return status if isinstance(status, int) else None
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Определяет, стоит ли повторять запрос после этой ошибки."""
+    if isinstance(error, (CircuitOpenError, RequestCancelled)):
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    return isinstance(error, _RETRYABLE_ERROR_TYPES) or type(error).__name__ in _RETRYABLE_ERROR_NAMES
+
+
+class TokenBucket:
+    """
+    Корзина токенов с пополнением rate_per_minute в минуту и емкостью на одну минуту.
+    reserve() сразу списывает токены (баланс может уйти в минус), поэтому
+    ожидающие запросы обслуживаются по очереди.
+    """
+    def __init__(self, rate_per_minute: float):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """Списывает токены и возвращает, сколько секунд нужно подождать перед запросом."""
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= amount
+            return max(0.0, -self._tokens / self.rate)
+
+    def available(self) -> float:
+        with self._lock:
+            self._refill(time.monotonic())
+            return self._tokens
+
+
+class RateLimiter:
+    """Лимиты запросов (RPM) и токенов (TPM) в минуту для одной модели или провайдера."""
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def reserve(self, tokens: int) -> float:
+        """Резервирует один запрос и tokens токенов; возвращает время ожидания в секундах."""
+        wait = self.requests.reserve(1) if self.requests else 0.0
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(tokens))
+        return wait
+
+    def snapshot(self) -> Dict[str, float]:
+        state = {}
+        if self.requests:
+            state["requests_available"] = round(self.requests.available(), 2)
+        if self.tokens:
+            state["tokens_available"] = round(self.tokens.available())
+        return state
+
+
+class CircuitBreaker:
+    """
+    Размыкает цепь после failure_threshold ошибок подряд. Пока цепь разомкнута,
+    запросы отклоняются сразу; через reset_timeout пропускается один пробный запрос.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = CIRCUIT_HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == CIRCUIT_HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def retry_in(self) -> float:
+        """Через сколько секунд цепь пропустит пробный запрос."""
+        with self._lock:
+            if self.state != CIRCUIT_OPEN:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_neutral(self) -> None:
+        """
+        Исход ничего не говорит о доступности сервиса (запрос отменен или отклонен как неверный):
+        пробный слот освобождается, счетчик ошибок и состояние цепи не меняются.
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> bool:
+        """Учитывает ошибку; возвращает True, если цепь только что разомкнулась."""
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.failure_threshold:
+                opened = self.state != CIRCUIT_OPEN
+                self.state = CIRCUIT_OPEN
+                self._opened_at = time.monotonic()
+                return opened
+            return False
+
+
+@dataclass
+class RetryPolicy:
+    """Повтор с экспоненциальной задержкой и полным джиттером."""
+    max_attempts: int = 4
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+
+    def delay(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """Задержка перед попыткой attempt + 1 (attempt начинается с 1). Учитывает Retry-After."""
+        retry_after = getattr(error, "retry_after", None)
+        if isinstance(retry_after, (int, float)) and retry_after > 0:
+            return min(float(retry_after), self.max_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class ResilienceManager:
+    """
+    Лимиты квоты, повторы и предохранители для вызовов провайдеров.
+    Ключи настроек — имя провайдера ("gemini") или провайдер и модель ("gemini/gemini-1.5-flash"),
+    как в concurrency_limits; предохранитель ведется для каждой пары провайдер/модель.
+    """
+    def __init__(self,
+                 rate_limits: Optional[Dict[str, Dict[str, float]]] = None,
+                 retry: Optional[Dict[str, Any]] = None,
+                 circuit_breaker: Optional[Dict[str, Any]] = None,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.retry_policy = RetryPolicy(**(retry or {}))
+        self._breaker_options = dict(circuit_breaker or {})
+        self._limiters = {key: RateLimiter(limits.get("rpm"), limits.get("tpm"))
+                          for key, limits in (rate_limits or {}).items()}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self._sleep = sleep
+
+    def _breaker(self, key: str) -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = self._breakers[key] = CircuitBreaker(**self._breaker_options)
+            return breaker
+
+    def _pause(self, seconds: float, cancel: Optional[threading.Event]) -> None:
+        """Ждет seconds секунд; при отмене прерывает ожидание исключением RequestCancelled."""
+        if cancel is None:
+            self._sleep(seconds)
+        elif cancel.wait(seconds):
+            raise RequestCancelled("Request cancelled while waiting.")
+
+    def _wait_for_quota(self, provider: str, model: str, tokens: int, on_status: Optional[StatusCallback],
+                        cancel: Optional[threading.Event] = None) -> None:
+        key = f"{provider}/{model}"
+        wait = max((limiter.reserve(tokens) for name, limiter in self._limiters.items() if name in (provider, key)),
+                   default=0.0)
+        if wait <= 0:
+            return
+        logger.info(f"Waiting {wait:.1f}s for '{key}' quota.")
+        if on_status:
+            on_status(f"waiting for quota ({key}, {wait:.1f}s)")
+        try:
+            self._pause(wait, cancel)
+        finally:
+            if on_status:
+                on_status(None)
+
+    def call(self, provider: str, model: str, tokens: int, request: Callable[[], Any],
+             on_status: Optional[StatusCallback] = None, retryable: Callable[[], bool] = lambda: True,
+             cancel: Optional[threading.Event] = None) -> Any:
+        """
+        Выполняет request() с учетом квоты, повторов и предохранителя.
+        retryable() позволяет запретить повтор (например, если часть потокового ответа уже показана).
+        cancel прерывает ожидание квоты и паузы между повторами; отмененный запрос не влияет на предохранитель.
+        :raises CircuitOpenError: если цепь для модели разомкнута.
+        :raises RequestCancelled: если запрос отменен.
+        """
+        key = f"{provider}/{model}"
+        breaker = self._breaker(key)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not breaker.allow():
+                raise CircuitOpenError(f"'{key}' is unavailable after repeated failures; "
+                                       f"next attempt in {breaker.retry_in():.1f}s.")
+            try:
+                self._wait_for_quota(provider, model, tokens, on_status, cancel)
+                result = request()
+            except Exception as e:
+                if isinstance(e, RequestCancelled) or (cancel is not None and cancel.is_set()):
+                    breaker.record_neutral()
+                    if isinstance(e, RequestCancelled):
+                        raise
+                    raise RequestCancelled(f"Request to '{key}' cancelled.") from e
+                if not is_retryable(e):
+                    # Ошибка запроса (например, 400): не успех и не сбой сервиса, предохранитель не трогаем
+                    breaker.record_neutral()
+                    raise
+                if breaker.record_failure():
+                    logger.warning(f"Circuit for '{key}' opened after {breaker.failures} failures.")
+                if attempt >= self.retry_policy.max_attempts or not retryable():
+                    raise
+                delay = self.retry_policy.delay(attempt, e)
+                logger.warning(f"Request to '{key}' failed ({type(e).__name__}: {e}); "
+                               f"retry {attempt + 1}/{self.retry_policy.max_attempts} in {delay:.1f}s.")
+                if on_status:
+                    on_status(f"retrying in {delay:.1f}s (attempt {attempt + 1}/{self.retry_policy.max_attempts})")
+                self._pause(delay, cancel)
+                continue
+            breaker.record_success()
+            return result
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Состояние лимитов и предохранителей для отображения и логов."""
+        state: Dict[str, Dict[str, Any]] = {key: limiter.snapshot() for key, limiter in self._limiters.items()}
+        with self._lock:
+            breakers = list(self._breakers.items())
+        for key, breaker in breakers:
+            state.setdefault(key, {}).update({"circuit": breaker.state, "failures": breaker.failures})
+        return state
+
+    def open_circuits(self) -> List[str]:
+        with self._lock:
+            return [key for key, breaker in self._breakers.items() if breaker.state == CIRCUIT_OPEN]
@@ -1,100 +1,595 @@
 import os
+import time
 import threading
-from typing import Dict, Any, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
+from dataclasses import replace
+from typing import Callable, Dict, Any, Iterable, List, Optional, Tuple
 
-import google.generativeai as genai
 from loguru import logger
-from PIL import Image
-import winsound
 
-from utils import RESOURCES_DIR
+from cache import ResponseCache, make_cache_key
+from chunking import (PACK_INSTRUCTION, estimate_tokens, normalize_segment, pack_segments, split_segments,
+                      split_text, split_text_with_separators, unpack_segments)
+from hedging import HedgeStats, LatencyTracker, run_hedged
+from blobstore import ImageHandle
+from imaging import EncodedImage, is_image_content, is_pil_image, prepare_image
+from metrics import STEP_PREFIX, RequestTrace
+from pipeline import PIPELINE_INPUT, CompiledPipeline, PipelineResult
+from providers import ProviderRegistry
+from resilience import CircuitOpenError, RequestCancelled, ResilienceManager, StatusCallback
+from templating import ChunkingConfig, CompiledTemplate, IncrementalConfig
 
 class LLMService:
     """
     Сервис для взаимодействия с API языковых моделей.
+    Запросы направляются провайдеру из реестра по полю api_provider шаблона.
     """
-    def __init__(self):
-        self.api_key = os.getenv("GEMINI_API_KEY")
-        if not self.api_key:
-            raise ValueError("GEMINI_API_KEY is not set in environment variables.")
-        
-        genai.configure(api_key=self.api_key)
-        logger.info("LLMService initialized and Gemini API configured.")
+    # Грубая оценка стоимости изображения в токенах для лимита TPM
+    IMAGE_TOKENS_ESTIMATE = 258
+
+    def __init__(self, cache: Optional[ResponseCache] = None, providers: Optional[ProviderRegistry] = None,
+                 resilience: Optional[ResilienceManager] = None):
+        self.cache = cache or ResponseCache()
+        self.providers = providers or ProviderRegistry.from_settings()
+        self.resilience = resilience or ResilienceManager()
+        self.latencies = LatencyTracker()
+        self.hedge_stats = HedgeStats()
+        logger.info(f"LLMService initialized with providers: {', '.join(self.providers.names())}.")
+
+    @classmethod
+    def from_settings(cls, settings: Dict[str, Any]) -> "LLMService":
+        """Создает сервис с провайдерами, лимитами квоты и политикой повторов из настроек приложения."""
+        return cls(
+            providers=ProviderRegistry.from_settings(settings.get("providers")),
+            resilience=ResilienceManager(settings.get("rate_limits"), settings.get("retry"), settings.get("circuit_breaker")),
+        )
+
+    def warm_up(self, templates: Iterable[CompiledTemplate]) -> threading.Thread:
+        """
+        В фоновом потоке заранее устанавливает соединения провайдеров
+        для моделей переданных шаблонов.
+        """
+        templates = list(templates)
+
+        def _run() -> None:
+            started = time.perf_counter()
+            warmed = set()
+            for template in templates:
+                key = (template.api_provider, template.model, template.generation_config_key)
+                if key in warmed:
+                    continue
+                warmed.add(key)
+                try:
+                    self.providers.get(template.api_provider).warm_up(template)
+                except Exception as e:
+                    logger.warning(f"Warm-up for '{template.api_provider}/{template.model}' failed: {e}")
+            logger.info(f"Warmed up {len(warmed)} models in {(time.perf_counter() - started) * 1000:.0f} ms.")
+
+        thread = threading.Thread(target=_run, name="LLMWarmUp", daemon=True)
+        thread.start()
+        return thread
 
-    def execute_request(self, template: Dict[str, Any], content: str | Image.Image) -> Optional[str]:
+    def init_providers(self, names: Iterable[str]) -> None:
+        """
+        Создает провайдеры заранее (импорт SDK, настройка клиента), чтобы это
+        не пришлось на первый запрос. Ошибки только логируются.
+        """
+        for name in sorted(set(names)):
+            try:
+                self.providers.get(name)
+            except KeyError:
+                logger.error(f"Templates refer to unknown provider '{name}'.")
+            except Exception as e:
+                logger.opt(exception=True).error(f"Failed to initialize provider '{name}': {e}")
+
+    def close(self) -> None:
+        """Закрывает соединения всех созданных провайдеров."""
+        self.providers.close()
+
+    def execute_request(self, template: CompiledTemplate, content: Any,
+                        on_chunk: Optional[Callable[[str], None]] = None,
+                        on_status: Optional[StatusCallback] = None,
+                        on_model: Optional[Callable[[str], None]] = None,
+                        trace: Optional[RequestTrace] = None) -> Optional[str]:
         """
         Выполняет запрос к LLM на основе шаблона и контента.
         
-        :param template: Словарь с данными шаблона.
+        :param template: Скомпилированный шаблон.
         :param content: Текст или изображение из буфера обмена.
+        :param on_chunk: Если задан, ответ запрашивается в потоковом режиме и каждый фрагмент передается в колбэк.
+        :param on_status: Получает описание ожидания (квота, повтор) или None, когда ожидание закончилось.
+        :param on_model: Получает "провайдер/модель", которая фактически ответила (при попадании в кэш не вызывается).
+        :param trace: Трасса задачи: сюда пишутся этапы prompt, cache, network, first_chunk, расход токенов и модель.
         :return: Результат от LLM или None в случае ошибки.
         """
-        provider = template.get("api_provider")
-        if provider == "gemini":
-            return self._execute_gemini_request(template, content)
-        else:
-            logger.error(f"Unsupported API provider: {provider}")
+        if template.api_provider not in self.providers.names():
+            logger.error(f"Unsupported API provider: {template.api_provider}. "
+                         f"Configured: {', '.join(self.providers.names())}")
             return None
 
-    def _execute_gemini_request(self, template: Dict[str, Any], content: Any) -> Optional[str]:
+        input_type = template.input_type
+        if not ((input_type == "text" and isinstance(content, str)) or
+                (input_type == "image" and is_image_content(content))):
+            logger.error(f"Mismatched input type: template requires '{input_type}' but content is '{type(content).__name__}'.")
+            return f"Error: Template requires {input_type}, but received different content type."
+
+        content = self.prepare_content(template, content)
+        if template.incremental and isinstance(content, str) and len(segments := split_segments(content)) > 1:
+            return self._execute_incremental(template, segments, template.incremental, on_chunk, on_status,
+                                             on_model, trace)
+        chunking = template.chunking
+        if chunking and isinstance(content, str) and estimate_tokens(content) > chunking.max_tokens:
+            return self._execute_chunked(template, content, chunking, on_chunk, on_status, on_model, trace)
+        return self._execute_single(template, content, on_chunk, on_status, on_model, trace)
+
+    def _execute_single(self, template: CompiledTemplate, content: Any,
+                        on_chunk: Optional[Callable[[str], None]] = None,
+                        on_status: Optional[StatusCallback] = None,
+                        on_model: Optional[Callable[[str], None]] = None,
+                        trace: Optional[RequestTrace] = None) -> Optional[str]:
+        """Выполняет один запрос к провайдеру с учетом кэша."""
+        started = time.perf_counter()
+        full_prompt = template.render_prompt(content)
+        if trace:
+            trace.add_span("prompt", started)
+        if not template.cache:
+            logger.debug(f"Cache disabled for template '{template.name}'.")
+            return self._call_provider(template, full_prompt, content, on_chunk, on_status, on_model, trace)
+
+        lookup_started = time.perf_counter()
+        lookup_done = []
+
+        def compute() -> Optional[str]:
+            # Промах кэша: поиск закончился, начинается запрос к провайдеру
+            lookup_done.append(True)
+            if trace:
+                trace.add_span("cache", lookup_started)
+            return self._call_provider(template, full_prompt, content, on_chunk, on_status, on_model, trace)
+
+        # Ответ запасной модели кэшируется под ключом основной: шаблон считается одним запросом
+        key = make_cache_key(template.api_provider, template.model, template.generation_config_key,
+                             full_prompt, content)
+        result = self.cache.get_or_compute(key, compute)
+        if trace and not lookup_done:
+            trace.add_span("cache", lookup_started)
+        logger.info(f"Response cache stats: {self.cache.stats.as_dict()}")
+        return result
+
+    def prepare_content(self, template: CompiledTemplate | CompiledPipeline, content: Any) -> Any:
         """
-        Выполняет запрос к Gemini API.
+        Готовит контент к отправке: изображения уменьшаются и кодируются один раз
+        по настройкам "image_pipeline" шаблона. Текст возвращается как есть.
         """
-        model_name = template["model"]
-        input_type = template["input_type"]
-        prompt_template = template["prompt"]
-        
-        model = genai.GenerativeModel(model_name)
-        
-        # Формируем промпт
-        full_prompt = prompt_template.format(clipboard_text=content if isinstance(content, str) else "")
+        if is_pil_image(content) or isinstance(content, ImageHandle):
+            return prepare_image(content, template.image_pipeline)
+        return content
 
-        logger.info(f"Executing request to Gemini model '{model_name}' with input type '{input_type}'.")
+    def _execute_chunked(self, template: CompiledTemplate, content: str, chunking: ChunkingConfig,
+                         on_chunk: Optional[Callable[[str], None]] = None,
+                         on_status: Optional[StatusCallback] = None,
+                         on_model: Optional[Callable[[str], None]] = None,
+                         trace: Optional[RequestTrace] = None) -> Optional[str]:
+        """
+        Map-reduce обработка длинного текста: фрагменты обрабатываются параллельно,
+        затем склеиваются (mode "concat") или сводятся отдельным промптом (mode "reduce").
+        Повторно выполняются только фрагменты, завершившиеся ошибкой.
+        """
+        chunks = split_text(content, chunking.max_tokens)
+        mode = chunking.mode
+        max_retries = chunking.max_retries
+        logger.info(f"Input split into {len(chunks)} chunks for template '{template.name}' (mode: {mode}).")
 
-        try:
-            if input_type == "text" and isinstance(content, str):
-                response = model.generate_content(full_prompt)
-            elif input_type == "image" and isinstance(content, Image.Image):
-                # Для vision моделей передаем промпт и изображение
-                response = model.generate_content([full_prompt, content])
-            else:
-                logger.error(f"Mismatched input type: template requires '{input_type}' but content is '{type(content).__name__}'.")
-                return f"Error: Template requires {input_type}, but received different content type."
+        results: List[Optional[str]] = [None] * len(chunks)
+        next_to_emit = 0
+        with ThreadPoolExecutor(max_workers=chunking.parallelism,
+                                thread_name_prefix="ChunkWorker") as pool:
+            for attempt in range(max_retries + 1):
+                pending = [i for i, result in enumerate(results) if result is None]
+                if not pending:
+                    break
+                if attempt:
+                    logger.warning(f"Retrying {len(pending)} failed chunks (attempt {attempt + 1}/{max_retries + 1}).")
+                futures = {pool.submit(self._execute_single, template, chunks[i], None, on_status, on_model, trace): i for i in pending}
+                for future in as_completed(futures):
+                    index = futures[future]
+                    try:
+                        results[index] = future.result()
+                    except Exception as e:
+                        logger.opt(exception=True).error(f"Chunk {index + 1}/{len(chunks)} crashed: {e}")
+                    # В режиме concat отдаем готовый префикс результата по мере поступления
+                    while mode == "concat" and on_chunk and next_to_emit < len(results) and results[next_to_emit] is not None:
+                        on_chunk(("\n\n" if next_to_emit else "") + results[next_to_emit])
+                        next_to_emit += 1
 
-            result_text = response.text.strip()
-            logger.info("Successfully received response from Gemini.")
-            logger.debug(f"Gemini response: {result_text[:100]}...")
-            return result_text
-        
+        failed = [i + 1 for i, result in enumerate(results) if result is None]
+        if failed:
+            logger.error(f"Chunks {failed} of {len(chunks)} failed after {max_retries + 1} attempts.")
+            return None
+
+        combined = "\n\n".join(results)
+        if mode != "reduce":
+            return combined
+        # Сводка не делится ни на фрагменты, ни на абзацы
+        reduce_template = replace(template, prompt=chunking.reduce_prompt or template.prompt, chunking=None,
+                                  incremental=None)
+        logger.info(f"Reducing {len(chunks)} partial results for template '{template.name}'.")
+        return self.execute_request(reduce_template, combined, on_chunk=on_chunk, on_status=on_status,
+                                    on_model=on_model, trace=trace)
+
+    def execute_batch(self, template: CompiledTemplate, contents: List[str],
+                      on_status: Optional[StatusCallback] = None,
+                      on_model: Optional[Callable[[str], None]] = None,
+                      trace: Optional[RequestTrace] = None) -> List[Optional[str]]:
+        """
+        Выполняет несколько коротких текстов одного шаблона одним запросом (пакетная отправка задач).
+        Ответы кэшируются под теми же ключами, что и отдельные запросы, поэтому уже обработанные
+        тексты не отправляются, а повтор задачи вне пакета берет ответ из кэша.
+        Расход токенов и сетевой этап записываются в trace (трассу первой задачи пакета).
+        """
+        keys = [make_cache_key(template.api_provider, template.model, template.generation_config_key,
+                               template.render_prompt(content), content)
+                for content in contents]
+        results: Dict[str, Optional[str]] = {}
+        if template.cache:
+            started = time.perf_counter()
+            for key in dict.fromkeys(keys):
+                cached = self.cache.get(key)
+                if cached is not None:
+                    results[key] = cached
+            if trace:
+                trace.add_span("cache", started)
+        missing = {key: content for key, content in zip(keys, contents) if key not in results}
+        if missing:
+            for key, answer in self._execute_packed(template, list(missing.items()), on_status, on_model,
+                                                    trace).items():
+                if answer is None:
+                    continue
+                results[key] = answer
+                if template.cache:
+                    self.cache.put(key, answer)
+        logger.info(f"Batch of {len(contents)} texts for '{template.name}': {len(contents) - len(missing)} from cache, "
+                    f"{len(missing)} sent in one request.")
+        return [results.get(key) for key in keys]
+
+    def _execute_incremental(self, template: CompiledTemplate, segments: List[Tuple[str, str]],
+                             config: IncrementalConfig,
+                             on_chunk: Optional[Callable[[str], None]] = None,
+                             on_status: Optional[StatusCallback] = None,
+                             on_model: Optional[Callable[[str], None]] = None,
+                             trace: Optional[RequestTrace] = None) -> Optional[str]:
+        """
+        Обработка текста по абзацам (segments из split_segments). Ответ на каждый абзац кэшируется
+        отдельно для пары шаблон/модель, поэтому после правки документа отправляются только новые
+        и измененные абзацы — пакетами до batch_tokens, размеченными метками в одном запросе.
+        Абзац длиннее batch_tokens отправляется частями (split_text_with_separators), а кэшируется целиком.
+        Ответ собирается по порядку из кэша и новых частей с исходными разделителями абзацев.
+        """
+        started = time.perf_counter()
+        # Промпт входит в ключ: правка шаблона делает ответы на абзацы устаревшими
+        keys = [make_cache_key(template.api_provider, template.model, template.generation_config_key,
+                               "incremental:" + template.prompt.source, normalize_segment(text))
+                for _, text in segments]
+        results: Dict[str, Optional[str]] = {}
+        if template.cache:
+            for key in dict.fromkeys(keys):
+                cached = self.cache.get(key)
+                if cached is not None:
+                    results[key] = cached
+        if trace:
+            trace.add_span("cache", started)
+        reused = sum(1 for key in keys if key in results)
+        missing = {key: text for key, (_, text) in zip(keys, segments) if key not in results}
+        # Абзац длиннее batch_tokens делится на части; каждая часть — отдельный запрос.
+        # Разделитель перед частью (перевод строки, пробел) запоминается для склейки ответов
+        long_parts = {key: split_text_with_separators(text, config.batch_tokens) for key, text in missing.items()
+                      if estimate_tokens(text) > config.batch_tokens}
+        part_keys = {f"{key}:{index}": key for key, parts in long_parts.items() for index in range(len(parts))}
+        part_results: Dict[str, str] = {}
+        batches = self._segment_batches([(key, text) for key, text in missing.items() if key not in long_parts],
+                                        config.batch_tokens)
+        batches += [[(f"{key}:{index}", part)] for key, parts in long_parts.items()
+                    for index, (_, part) in enumerate(parts)]
+        logger.info(f"Incremental run for '{template.name}': {reused} of {len(segments)} paragraphs from cache, "
+                    f"{len(missing)} to send in {len(batches)} requests.")
+
+        next_to_emit = 0
+
+        def emit_ready() -> None:
+            nonlocal next_to_emit
+            while on_chunk and next_to_emit < len(keys) and results.get(keys[next_to_emit]) is not None:
+                on_chunk(segments[next_to_emit][0] + results[keys[next_to_emit]])
+                next_to_emit += 1
+
+        emit_ready()
+        if batches:
+            with ThreadPoolExecutor(max_workers=config.parallelism, thread_name_prefix="SegmentWorker") as pool:
+                futures = [pool.submit(self._execute_packed, template, batch, on_status, on_model, trace)
+                           for batch in batches]
+                for future in as_completed(futures):
+                    try:
+                        answers = future.result()
+                    except Exception as e:
+                        logger.opt(exception=True).error(f"Paragraph batch crashed: {e}")
+                        continue
+                    for key, answer in answers.items():
+                        if answer is None:
+                            continue
+                        if key in part_keys:
+                            part_results[key] = answer
+                            key = part_keys[key]
+                            parts = [part_results.get(f"{key}:{index}") for index in range(len(long_parts[key]))]
+                            if any(part is None for part in parts):
+                                continue
+                            answer = "".join(separator + part for (separator, _), part in zip(long_parts[key], parts))
+                        results[key] = answer
+                        if template.cache:
+                            self.cache.put(key, answer)
+                    emit_ready()
+
+        if trace:
+            trace.segments = {"total": len(segments), "reused": reused, "sent": len(missing), "requests": len(batches)}
+        failed = [i + 1 for i, key in enumerate(keys) if results.get(key) is None]
+        if failed:
+            logger.error(f"Paragraphs {failed} of {len(segments)} failed for template '{template.name}'.")
+            return None
+        return "".join(separator + results[key] for (separator, _), key in zip(segments, keys))
+
+    @staticmethod
+    def _segment_batches(segments: List[Tuple[str, str]], batch_tokens: int) -> List[List[Tuple[str, str]]]:
+        """Группирует (ключ, абзац) в пакеты не больше batch_tokens; длинный абзац идет отдельным пакетом."""
+        batches: List[List[Tuple[str, str]]] = []
+        size = 0
+        for key, text in segments:
+            tokens = estimate_tokens(text)
+            if not batches or size + tokens > batch_tokens:
+                batches.append([])
+                size = 0
+            batches[-1].append((key, text))
+            size += tokens
+        return batches
+
+    def _execute_packed(self, template: CompiledTemplate, batch: List[Tuple[str, str]],
+                        on_status: Optional[StatusCallback] = None,
+                        on_model: Optional[Callable[[str], None]] = None,
+                        trace: Optional[RequestTrace] = None) -> Dict[str, Optional[str]]:
+        """
+        Отправляет пакет текстов (ключ, текст) — абзацев или коротких задач — одним запросом
+        и разбирает ответ по меткам. Если модель нарушила разметку, тексты отправляются по одному.
+        """
+        if len(batch) == 1:
+            key, text = batch[0]
+            answer = self._call_provider(template, template.render_prompt(text), text, None, on_status, on_model,
+                                         trace)
+            return {key: answer.strip() if answer is not None else None}
+        packed = pack_segments([text for _, text in batch])
+        answer = self._call_provider(template, template.render_prompt(packed) + PACK_INSTRUCTION, packed, None,
+                                     on_status, on_model, trace)
+        if answer is None:
+            return {key: None for key, _ in batch}
+        parts = unpack_segments(answer, len(batch))
+        if parts is not None:
+            return {key: part for (key, _), part in zip(batch, parts)}
+        logger.warning(f"The answer for {len(batch)} packed texts lost its markers; sending them one by one.")
+        answers: Dict[str, Optional[str]] = {}
+        for item in batch:
+            answers.update(self._execute_packed(template, [item], on_status, on_model, trace))
+        return answers
+
+    def execute_pipeline(self, pipeline: CompiledPipeline, content: Any,
+                         on_status: Optional[StatusCallback] = None,
+                         on_model: Optional[Callable[[str], None]] = None,
+                         trace: Optional[RequestTrace] = None) -> PipelineResult:
+        """
+        Выполняет составной шаблон (после bind): шаг запускается, как только готов его вход,
+        независимые шаги идут параллельно. Промежуточные результаты берутся из кэша ответов,
+        поэтому после правки шага повторно выполняются только он и зависящие от него шаги.
+        Ошибка шага пропускает зависящие от него шаги, остальные ветви доводятся до конца.
+        """
+        outcome = PipelineResult(outputs=pipeline.outputs)
+        steps = {step.name: step for step in pipeline.steps}
+        waiting = list(pipeline.steps)
+        running: Dict[Future, str] = {}
+        logger.info(f"Running pipeline '{pipeline.name}': {len(steps)} steps, outputs {list(pipeline.outputs)}.")
+
+        def run_step(name: str, step_input: Any) -> Optional[str]:
+            started = time.perf_counter()
+            try:
+                return self.execute_request(steps[name].template, step_input, on_status=on_status,
+                                            on_model=on_model, trace=trace)
+            finally:
+                outcome.timings_ms[name] = (time.perf_counter() - started) * 1000
+                if trace:
+                    trace.add_span(STEP_PREFIX + name, started)
+
+        with ThreadPoolExecutor(max_workers=pipeline.parallelism, thread_name_prefix="PipelineStep") as pool:
+            while waiting or running:
+                for step in list(waiting):
+                    if step.input == PIPELINE_INPUT:
+                        step_input = content
+                    elif step.input in outcome.results:
+                        step_input = outcome.results[step.input]
+                    else:
+                        continue  # Предыдущий шаг еще выполняется
+                    waiting.remove(step)
+                    if step_input is None:
+                        outcome.skipped.append(step.name)
+                        outcome.results[step.name] = None
+                        continue
+                    running[pool.submit(run_step, step.name, step_input)] = step.name
+                if not running:
+                    continue  # Пропуск шага мог сделать готовыми (к пропуску) следующие
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        outcome.results[name] = future.result()
+                    except Exception as e:
+                        logger.opt(exception=True).error(f"Pipeline step '{name}' crashed: {e}")
+                        outcome.results[name] = None
+                    logger.info(f"Pipeline '{pipeline.name}' step '{name}' "
+                                f"{'finished' if outcome.results[name] is not None else 'failed'} "
+                                f"in {outcome.timings_ms[name]:.0f} ms.")
+
+        if outcome.skipped:
+            logger.warning(f"Pipeline '{pipeline.name}': skipped {outcome.skipped} after a failed step.")
+        return outcome
+
+    def execute_speculative(self, template: CompiledTemplate, content: str, on_chunk: Callable[[str], None],
+                            cancel: threading.Event, trace: Optional[RequestTrace] = None) -> Optional[str]:
+        """
+        Упреждающий запрос по первому копированию: только основная модель, без дублирования,
+        всегда потоком, чтобы cancel прерывал генерацию. Кэш проверяет Speculator (cached_response)
+        до запуска, а ответ попадает в кэш только после подтверждения. Возвращает None при ошибке или отмене.
+        """
+        full_prompt = template.render_prompt(content)
+        try:
+            return self._invoke(replace(template, hedging=None), full_prompt, content, on_chunk, cancel=cancel,
+                                trace=trace)
+        except RequestCancelled:
+            return None
         except Exception as e:
-            logger.opt(exception=True).error(f"An error occurred while querying Gemini API: {e}")
+            logger.warning(f"Speculative request for '{template.name}' failed: {type(e).__name__}: {e}")
             return None
 
-class SoundService:
-    """
-    Сервис для воспроизведения звуковых сигналов.
-    """
-    def __init__(self, resource_dir: str = RESOURCES_DIR):
-        self.in_sound_path = os.path.join(resource_dir, "in.wav")
-        self.out_sound_path = os.path.join(resource_dir, "out.wav")
-        logger.info("SoundService initialized.")
-
-    def _play_sound(self, sound_path: str):
-        """Воспроизводит звук в отдельном потоке, чтобы не блокировать GUI."""
-        if not os.path.exists(sound_path):
-            logger.warning(f"Sound file not found: {sound_path}")
-            return
+    def cached_response(self, template: CompiledTemplate, content: Any) -> Optional[str]:
+        """Ответ из кэша под тем же ключом, что у execute_request; None — его нет или кэш шаблона выключен."""
+        if not template.cache:
+            return None
+        return self.cache.get(make_cache_key(template.api_provider, template.model, template.generation_config_key,
+                                             template.render_prompt(content), content))
+
+    def remember(self, template: CompiledTemplate, content: Any, result: str) -> None:
+        """Кладет в кэш ответ, полученный в обход execute_request (подтвержденный упреждающий запрос)."""
+        if template.cache:
+            self.cache.put(make_cache_key(template.api_provider, template.model, template.generation_config_key,
+                                          template.render_prompt(content), content), result)
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Возвращает счетчики попаданий и промахов кэша ответов."""
+        return self.cache.stats.as_dict()
+
+    @staticmethod
+    def _latency_key(provider: str, model: str, streaming: bool) -> str:
+        """Ключ замеров времени ответа: для потока замеряется время до первого фрагмента."""
+        return f"{provider}/{model}" + (" (first chunk)" if streaming else "")
+
+    def _call_provider(self, template: CompiledTemplate, full_prompt: str, content: Any,
+                       on_chunk: Optional[Callable[[str], None]] = None,
+                       on_status: Optional[StatusCallback] = None,
+                       on_model: Optional[Callable[[str], None]] = None,
+                       trace: Optional[RequestTrace] = None) -> Optional[str]:
+        """
+        Выполняет запрос через провайдера шаблона с учетом квоты, повторов и предохранителя.
+        Если в шаблоне задан hedging, медленный или неудачный запрос дублируется запасными моделями.
+        При наличии on_chunk ответ читается потоком.
+        """
+        name = f"{template.api_provider}/{template.model}"
         try:
-            threading.Thread(target=lambda: winsound.PlaySound(sound_path, winsound.SND_FILENAME), daemon=True).start()
+            if template.hedging:
+                result_text, model = self._call_hedged(template, full_prompt, content, on_chunk, on_status, trace)
+            else:
+                result_text, model = self._invoke(template, full_prompt, content, on_chunk, on_status,
+                                                  trace=trace), template.model
+        except (CircuitOpenError, RequestCancelled) as e:
+            logger.error(str(e))
+            return None
         except Exception as e:
-            logger.error(f"Could not play sound {sound_path}: {e}")
+            logger.opt(exception=True).error(f"An error occurred while querying '{name}': {e}")
+            return None
+        answered_by = f"{template.api_provider}/{model}"
+        if trace:
+            trace.set_model(answered_by)
+        if on_model:
+            on_model(answered_by)
+        return result_text
+
+    def _call_hedged(self, template: CompiledTemplate, full_prompt: str, content: Any,
+                     on_chunk: Optional[Callable[[str], None]] = None,
+                     on_status: Optional[StatusCallback] = None,
+                     trace: Optional[RequestTrace] = None) -> Tuple[str, str]:
+        """
+        Запрашивает основную модель; если она не ответила за задержку (перцентиль времени
+        ее прошлых ответов) или вернула ошибку, запрашивает следующую модель из hedging.models.
+        Возвращает первый успешный ответ и имя ответившей модели.
+        """
+        hedging = template.hedging
+        models = [template.model] + [model for model in hedging.models if model != template.model]
+        streaming = on_chunk is not None
+        attempts = [
+            lambda cancel, claim, attempt_template=replace(template, model=model, hedging=None):
+                self._invoke(attempt_template, full_prompt, content, on_chunk, on_status, cancel, claim, trace)
+            for model in models
+        ]
+
+        def delay_for(index: int) -> float:
+            learned = self.latencies.percentile(self._latency_key(template.api_provider, models[index], streaming),
+                                                hedging.percentile, hedging.min_samples)
+            return learned if learned is not None else hedging.delay_ms / 1000
 
-    def play_in(self):
-        """Воспроизводит звук начала операции."""
-        logger.debug("Playing 'in' sound.")
-        self._play_sound(self.in_sound_path)
+        self.hedge_stats.increment("requests")
+        outcome = run_hedged(attempts, delay_for, self.hedge_stats, name=f"'{template.name}'")
+        if outcome.index:
+            self.hedge_stats.increment("fallback_wins")
+            logger.info(f"'{template.api_provider}/{models[outcome.index]}' answered for '{template.name}' "
+                        f"instead of '{template.model}' ({outcome.launched} requests sent).")
+        logger.info(f"Hedging stats: {self.hedge_stats.as_dict()}")
+        return outcome.value, models[outcome.index]
 
-    def play_out(self):
-        """Воспроизводит звук завершения операции."""
-        logger.debug("Playing 'out' sound.")
-        self._play_sound(self.out_sound_path)
\ No newline at end of file
+    def _invoke(self, template: CompiledTemplate, full_prompt: str, content: Any,
+                on_chunk: Optional[Callable[[str], None]] = None,
+                on_status: Optional[StatusCallback] = None,
+                cancel: Optional[threading.Event] = None,
+                claim: Optional[Callable[[], bool]] = None,
+                trace: Optional[RequestTrace] = None) -> str:
+        """
+        Один запрос к модели шаблона через ResilienceManager. Время успешного ответа
+        записывается в self.latencies, этапы network и first_chunk и расход токенов — в trace. claim() вызывается перед первым фрагментом потока:
+        если другая попытка уже отвечает, запрос прерывается.
+        :raises Exception: при ошибке провайдера, разомкнутой цепи или отмене.
+        """
+        name = f"{template.api_provider}/{template.model}"
+        logger.info(f"Executing request to '{name}' with input type '{template.input_type}'.")
+        tokens = estimate_tokens(full_prompt) + (self.IMAGE_TOKENS_ESTIMATE if isinstance(content, EncodedImage) else 0)
+        latency_key = self._latency_key(template.api_provider, template.model, on_chunk is not None)
+        provider = self.providers.get(template.api_provider)
+        streamed = []
+        attempt_started = [0.0]
+
+        def forward_chunk(text: str) -> None:
+            if not streamed:
+                if claim is not None and not claim():
+                    raise RequestCancelled(f"Stream from '{name}' dropped: another model is already answering.")
+                self.latencies.record(latency_key, time.perf_counter() - attempt_started[0])
+                if trace:
+                    trace.add_span("first_chunk", attempt_started[0])
+            streamed.append(True)
+            on_chunk(text)
+
+        def request() -> str:
+            attempt_started[0] = time.perf_counter()
+            result = provider.generate(template, full_prompt, content, forward_chunk if on_chunk else None, cancel,
+                                       trace.add_usage if trace else None)
+            if on_chunk is None:
+                self.latencies.record(latency_key, time.perf_counter() - attempt_started[0])
+            return result
+
+        started = time.perf_counter()
+        try:
+            result_text = self.resilience.call(
+                template.api_provider, template.model, tokens, request,
+                on_status=on_status,
+                # Повтор после частично показанного потокового ответа продублировал бы текст
+                retryable=lambda: not streamed,
+                cancel=cancel,
+            )
+        finally:
+            # Отмененная попытка может завершиться позже победителя и не должна удлинять этап
+            if trace and not (cancel is not None and cancel.is_set()):
+                trace.add_span("network", started)
+        if isinstance(content, EncodedImage):
+            logger.info(f"Image request with {len(content.data) // 1024} KB payload "
+                        f"({(content.raw_bytes - len(content.data)) // 1024} KB saved) "
+                        f"completed in {(time.perf_counter() - started) * 1000:.0f} ms.")
+        logger.info(f"Successfully received response from '{name}' in {(time.perf_counter() - started) * 1000:.0f} ms.")
+        logger.debug(f"Response: {result_text[:100]}...")
+        return result_text
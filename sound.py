@@ -0,0 +1,37 @@
+import os
+import threading
+
+from loguru import logger
+
+from utils import RESOURCES_DIR
+
+
+class SoundService:
+    """
+    Сервис для воспроизведения звуковых сигналов.
+    """
+    def __init__(self, resource_dir: str = RESOURCES_DIR):
+        self.in_sound_path = os.path.join(resource_dir, "in.wav")
+        self.out_sound_path = os.path.join(resource_dir, "out.wav")
+        logger.info("SoundService initialized.")
+
+    def _play_sound(self, sound_path: str):
+        """Воспроизводит звук в отдельном потоке, чтобы не блокировать GUI."""
+        if not os.path.exists(sound_path):
+            logger.warning(f"Sound file not found: {sound_path}")
+            return
+        try:
+            import winsound  # Доступен только в Windows
+            threading.Thread(target=lambda: winsound.PlaySound(sound_path, winsound.SND_FILENAME), daemon=True).start()
+        except Exception as e:
+            logger.error(f"Could not play sound {sound_path}: {e}")
+
+    def play_in(self):
+        """Воспроизводит звук начала операции."""
+        logger.debug("Playing 'in' sound.")
+        self._play_sound(self.in_sound_path)
+
+    def play_out(self):
+        """Воспроизводит звук завершения операции."""
+        logger.debug("Playing 'out' sound.")
+        self._play_sound(self.out_sound_path)
\ No newline at end of file
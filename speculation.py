@@ -0,0 +1,278 @@
+import time
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from chunking import estimate_tokens, split_segments
+from metrics import RequestTrace
+from resilience import TokenBucket
+from templating import CompiledTemplate
+from utils import accepted_options, SPECULATION_GRACE_S, SPECULATION_MAX_CHARS, SPECULATION_MAX_PER_MINUTE, SPECULATION_MIN_CHARS
+
+
+@dataclass
+class SpeculationStats:
+    """
+    Счетчики упреждающих запросов для настройки фильтров и лимита.
+    """
+    started: int = 0
+    committed: int = 0  # Подтверждены вторым копированием
+    discarded: int = 0  # Не подтверждены: отменены или ответ выброшен
+    failed: int = 0
+    filtered: int = 0  # Первое копирование не прошло фильтры
+    rate_limited: int = 0
+    cached: int = 0  # Ответ на первое копирование уже был в кэше: запрос не отправлялся
+    wasted_prompt_tokens: int = 0
+    wasted_output_tokens: int = 0
+    saved_ms: float = 0.0  # Насколько раньше начался запрос у подтвержденных задач
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def increment(self, counter: str, amount: float = 1) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.committed / self.started if self.started else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "started": self.started,
+                "committed": self.committed,
+                "discarded": self.discarded,
+                "failed": self.failed,
+                "filtered": self.filtered,
+                "rate_limited": self.rate_limited,
+                "cached": self.cached,
+                "hit_rate": round(self.hit_rate, 3),
+                "wasted_prompt_tokens": self.wasted_prompt_tokens,
+                "wasted_output_tokens": self.wasted_output_tokens,
+                "saved_ms": round(self.saved_ms),
+            }
+
+
+class Speculation:
+    """
+    Упреждающий запрос по первому копированию. Ответ хранится здесь и никуда не попадает
+    (ни в кэш, ни в историю), пока задача второго копирования не заберет его через adopt().
+    Запрос всегда читается потоком, чтобы отмена прерывала генерацию.
+    """
+    def __init__(self, template: CompiledTemplate, content: str):
+        self.template = template
+        self.content = content
+        self.started_at = time.perf_counter()
+        self.cancel = threading.Event()
+        self.done = threading.Event()
+        self.result: Optional[str] = None
+        self.trace = RequestTrace(template.name, f"{template.api_provider}/{template.model}", self.started_at)
+        self.claimed = False
+        self.discarded = False
+        self.from_cache = False
+        # claim или _discard учли запрос в статистике как отправленный (до того, как стал известен ответ из кэша)
+        self.counted = False
+        self.timer: Optional[threading.Timer] = None
+        self._chunks: List[str] = []
+        self._forward: Optional[Callable[[str], None]] = None
+        self._lock = threading.Lock()
+
+    @property
+    def streamed(self) -> bool:
+        """Получен хотя бы один фрагмент ответа."""
+        with self._lock:
+            return bool(self._chunks)
+
+    def on_chunk(self, text: str) -> None:
+        with self._lock:
+            self._chunks.append(text)
+            forward = self._forward
+        if forward:
+            forward(text)
+
+    def adopt(self, on_chunk: Optional[Callable[[str], None]], trace: Optional[RequestTrace]) -> Optional[str]:
+        """
+        Дожидается ответа для подтвержденной задачи. Уже полученные фрагменты передаются
+        в on_chunk сразу, остальные — по мере поступления. None — запрос завершился ошибкой.
+        """
+        if on_chunk:
+            with self._lock:
+                # Повтор под блокировкой: новый фрагмент не обгонит уже полученные
+                for text in self._chunks:
+                    on_chunk(text)
+                self._forward = on_chunk
+        waited = time.perf_counter()
+        self.done.wait()
+        if trace and self.from_cache:
+            trace.add_span("cache", waited)
+        elif trace:
+            trace.add_span("network", waited)
+            trace.add_usage(self.trace.usage)
+            if self.result is not None:
+                trace.set_model(f"{self.template.api_provider}/{self.template.model}")
+        return self.result
+
+    def wasted_tokens(self) -> tuple[int, int]:
+        """Токены неподтвержденного запроса; если провайдер их не сообщил (запрос прерван) — оценка."""
+        with self._lock:
+            streamed = "".join(self._chunks)
+        prompt_tokens = self.trace.usage.prompt_tokens or estimate_tokens(self.template.render_prompt(self.content))
+        return prompt_tokens, self.trace.usage.output_tokens or estimate_tokens(streamed)
+
+
+class Speculator:
+    """
+    Запускает запрос текущего шаблона по первому копированию, не дожидаясь второго.
+    Если за окно двойного копирования пришло подтверждение (claim), задача получает уже
+    идущий или готовый ответ; иначе запрос отменяется, а его токены учитываются как потерянные.
+    Одновременно выполняется не больше одного упреждающего запроса; частота ограничена в минуту.
+    on_first_copy вызывается из потока ClipboardMonitor, claim — из потока интерфейса.
+    """
+    def __init__(self, service: Any, get_template: Callable[[], Optional[Any]], window: float,
+                 min_chars: int = SPECULATION_MIN_CHARS, max_chars: int = SPECULATION_MAX_CHARS,
+                 max_per_minute: float = SPECULATION_MAX_PER_MINUTE):
+        self.service = service
+        self.get_template = get_template
+        self.window = window
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self.stats = SpeculationStats()
+        self._bucket = TokenBucket(max_per_minute)
+        self._current: Optional[Speculation] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, service: Any, settings: Optional[Dict[str, Any]], get_template: Callable[[], Optional[Any]],
+                      repeat_threshold: float) -> Optional["Speculator"]:
+        """Создает упреждающий режим по разделу "speculation" настроек; None, если он выключен."""
+        options = dict(settings or {})
+        if not options.pop("enabled", False):
+            return None
+        return cls(service, get_template, window=repeat_threshold + SPECULATION_GRACE_S,
+                   **accepted_options(cls, options, "speculation", provided=("service", "get_template", "window")))
+
+    def _skip_reason(self, template: Any, content: Any) -> Optional[str]:
+        if not isinstance(template, CompiledTemplate):
+            return "no template or a pipeline is selected"
+        if template.input_type != "text" or not isinstance(content, str):
+            return "only text is speculated"
+        if not self.min_chars <= len(content) <= self.max_chars:
+            return f"{len(content)} characters is outside {self.min_chars}..{self.max_chars}"
+        if template.chunking and estimate_tokens(content) > template.chunking.max_tokens:
+            return "the text would be processed in chunks"
+        if template.incremental and len(split_segments(content)) > 1:
+            return "the text would be processed by paragraph"
+        if f"{template.api_provider}/{template.model}" in self.service.resilience.open_circuits():
+            return "the model is temporarily unavailable"
+        return None
+
+    def on_first_copy(self, content: Any) -> None:
+        """Первое копирование: запускает упреждающий запрос, если содержимое проходит фильтры и лимит."""
+        content = content.strip() if isinstance(content, str) else content
+        template = self.get_template()
+        reason = self._skip_reason(template, content)
+        if reason is None and self._bucket.available() < 1:
+            reason = "rate limit"
+        if reason is not None:
+            self.stats.increment("rate_limited" if reason == "rate limit" else "filtered")
+            logger.debug(f"Not speculating on first copy: {reason}.")
+            self._replace_current(None)
+            return
+
+        speculation = Speculation(template, content)
+        # Таймер создается до публикации: claim из потока интерфейса может прийти сразу
+        speculation.timer = threading.Timer(self.window, self._expire, args=(speculation,))
+        speculation.timer.daemon = True
+        self._replace_current(speculation)
+        threading.Thread(target=self._run, args=(speculation,), name="Speculation", daemon=True).start()
+        speculation.timer.start()
+
+    def claim(self, template: Any, content: Any) -> Optional[Speculation]:
+        """Второе копирование того же текста для того же шаблона забирает упреждающий запрос."""
+        with self._lock:
+            speculation = self._current
+            if speculation is None or speculation.template != template or speculation.content != content:
+                return None
+            speculation.claimed = True
+            self._current = None
+        speculation.timer.cancel()
+        with speculation._lock:
+            from_cache = speculation.from_cache
+            speculation.counted = not from_cache
+        if from_cache:
+            logger.info("Second copy confirmed a first copy that was answered from the cache.")
+            return speculation
+        ahead_ms = (time.perf_counter() - speculation.started_at) * 1000
+        self.stats.increment("committed")
+        self.stats.increment("saved_ms", ahead_ms)
+        logger.info(f"Second copy confirmed the speculative request started {ahead_ms:.0f} ms earlier "
+                    f"({'answer ready' if speculation.done.is_set() else 'still running'}). "
+                    f"Speculation stats: {self.stats.as_dict()}")
+        return speculation
+
+    def close(self) -> None:
+        self._replace_current(None)
+
+    def _replace_current(self, speculation: Optional[Speculation]) -> None:
+        with self._lock:
+            previous, self._current = self._current, speculation
+        if previous is not None:
+            self._discard(previous, "superseded by another copy")
+
+    def _expire(self, speculation: Speculation) -> None:
+        with self._lock:
+            if speculation.claimed or self._current is not speculation:
+                return
+            self._current = None
+        self._discard(speculation, "no second copy")
+
+    def _discard(self, speculation: Speculation, reason: str) -> None:
+        speculation.cancel.set()
+        if speculation.timer:
+            speculation.timer.cancel()
+        with speculation._lock:
+            speculation.discarded = True
+            finished = speculation.done.is_set()
+            from_cache = speculation.from_cache
+            speculation.counted = speculation.counted or not from_cache
+        if from_cache:
+            return
+        self.stats.increment("discarded")
+        logger.debug(f"Speculative request for '{speculation.template.name}' discarded: {reason}.")
+        if finished:
+            self._count_waste(speculation)
+
+    def _count_waste(self, speculation: Speculation) -> None:
+        prompt_tokens, output_tokens = speculation.wasted_tokens()
+        self.stats.increment("wasted_prompt_tokens", prompt_tokens)
+        self.stats.increment("wasted_output_tokens", output_tokens)
+
+    def _run(self, speculation: Speculation) -> None:
+        template, content = speculation.template, speculation.content
+        # Тот же ключ, что у execute_request: готовый ответ не оплачивается повторно и не тратит лимит.
+        # Поиск может читать диск, поэтому он здесь, а не в потоке ClipboardMonitor
+        cached = self.service.cached_response(template, content)
+        with speculation._lock:
+            speculation.from_cache = cached is not None
+            counted = speculation.counted
+        if cached is not None:
+            speculation.on_chunk(cached)
+            speculation.result = cached
+            speculation.done.set()
+            self.stats.increment("started" if counted else "cached")
+            logger.debug(f"First copy for '{template.name}' already has a cached answer.")
+            return
+        self._bucket.reserve(1)
+        self.stats.increment("started")
+        logger.info(f"Speculatively requesting '{template.name}' for a first copy ({len(content)} characters).")
+        speculation.result = self.service.execute_speculative(speculation.template, speculation.content,
+                                                              speculation.on_chunk, speculation.cancel,
+                                                              speculation.trace)
+        if speculation.result is None and not speculation.cancel.is_set():
+            self.stats.increment("failed")
+        with speculation._lock:
+            speculation.done.set()
+            discarded = speculation.discarded
+        if discarded:
+            self._count_waste(speculation)
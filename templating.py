@@ -0,0 +1,303 @@
+import json
+import string
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+
+from imaging import DEFAULT_IMAGE_PIPELINE
+from utils import (CHUNK_MAX_TOKENS, CHUNK_PARALLELISM, CHUNK_MAX_RETRIES, HEDGE_DELAY_MS, HEDGE_PERCENTILE,
+                   HEDGE_MIN_SAMPLES, INCREMENTAL_BATCH_TOKENS, BATCH_WINDOW_MS, BATCH_MAX_ITEMS, BATCH_MAX_TOKENS)
+
+# Плейсхолдеры, которые можно использовать в промптах
+PROMPT_FIELDS = ("clipboard_text",)
+
+_IMAGE_PIPELINE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "additionalProperties": False,
+    "properties": {
+        "max_long_edge": {"type": "integer", "minimum": 0},
+        "mode": {"type": ["string", "null"], "enum": [None, "RGB", "L", "P"]},
+        "colors": {"type": "integer", "minimum": 2},
+        "format": {"type": "string", "enum": ["WEBP", "JPEG", "PNG", "webp", "jpeg", "png"]},
+        "quality": {"type": "integer", "minimum": 1},
+        "crop_borders": {"type": "boolean"},
+        "border_tolerance": {"type": "integer", "minimum": 0},
+    },
+}
+
+TEMPLATE_SCHEMA: Dict[str, Any] = {
+    "type": "object",
+    "required": ["name", "description", "api_provider", "model", "input_type", "prompt"],
+    "properties": {
+        "name": {"type": "string", "minLength": 1},
+        "description": {"type": "string"},
+        "api_provider": {"type": "string", "minLength": 1},
+        "model": {"type": "string", "minLength": 1},
+        "input_type": {"type": "string", "enum": ["text", "image"]},
+        "prompt": {"type": "string", "minLength": 1},
+        "cache": {"type": "boolean"},
+        "stream": {"type": "boolean"},
+        "generation_config": {"type": "object"},
+        "chunking": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {
+                "max_tokens": {"type": "integer", "minimum": 1},
+                "mode": {"type": "string", "enum": ["concat", "reduce"]},
+                "parallelism": {"type": "integer", "minimum": 1},
+                "max_retries": {"type": "integer", "minimum": 0},
+                "reduce_prompt": {"type": "string", "minLength": 1},
+            },
+        },
+        "incremental": {
+            "type": ["boolean", "object"],
+            "additionalProperties": False,
+            "properties": {
+                "batch_tokens": {"type": "integer", "minimum": 1},
+                "parallelism": {"type": "integer", "minimum": 1},
+            },
+        },
+        "batching": {
+            "type": ["boolean", "object"],
+            "additionalProperties": False,
+            "properties": {
+                "window_ms": {"type": "integer", "minimum": 0},
+                "max_items": {"type": "integer", "minimum": 1},
+                "max_tokens": {"type": "integer", "minimum": 1},
+            },
+        },
+        "hedging": {
+            "type": "object",
+            "required": ["models"],
+            "additionalProperties": False,
+            "properties": {
+                "models": {"type": "array", "minItems": 1, "items": {"type": "string", "minLength": 1}},
+                "delay_ms": {"type": "integer", "minimum": 0},
+                "percentile": {"type": "number", "minimum": 1, "maximum": 100},
+                "min_samples": {"type": "integer", "minimum": 1},
+            },
+        },
+        "image_pipeline": _IMAGE_PIPELINE_SCHEMA,
+    },
+}
+
+_JSON_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "boolean": bool,
+    "null": type(None),
+}
+
+
+class TemplateError(ValueError):
+    """Ошибка валидации или компиляции шаблона."""
+
+
+def validate(instance: Any, schema: Dict[str, Any], path: str = "$") -> List[str]:
+    """
+    Проверяет значение по подмножеству JSON Schema (type, required, properties, additionalProperties,
+    items, enum, minimum, maximum, minLength, minItems, minProperties). Возвращает список ошибок.
+    """
+    errors: List[str] = []
+    expected = schema.get("type")
+    if expected is not None:
+        types = expected if isinstance(expected, list) else [expected]
+        if not any(_is_type(instance, t) for t in types):
+            return [f"{path}: expected {' or '.join(types)}, got {type(instance).__name__}"]
+    if "enum" in schema and instance not in schema["enum"]:
+        errors.append(f"{path}: must be one of {schema['enum']}")
+    if "minimum" in schema and isinstance(instance, (int, float)) and instance < schema["minimum"]:
+        errors.append(f"{path}: must be >= {schema['minimum']}")
+    if "maximum" in schema and isinstance(instance, (int, float)) and instance > schema["maximum"]:
+        errors.append(f"{path}: must be <= {schema['maximum']}")
+    if "minLength" in schema and isinstance(instance, str) and len(instance) < schema["minLength"]:
+        errors.append(f"{path}: must not be empty")
+    if isinstance(instance, list):
+        if "minItems" in schema and len(instance) < schema["minItems"]:
+            errors.append(f"{path}: must have at least {schema['minItems']} items")
+        if "items" in schema:
+            for index, item in enumerate(instance):
+                errors.extend(validate(item, schema["items"], f"{path}[{index}]"))
+    if isinstance(instance, dict):
+        properties = schema.get("properties", {})
+        for key in schema.get("required", []):
+            if key not in instance:
+                errors.append(f"{path}: missing required key '{key}'")
+        if "minProperties" in schema and len(instance) < schema["minProperties"]:
+            errors.append(f"{path}: must have at least {schema['minProperties']} keys")
+        additional = schema.get("additionalProperties", True)
+        for key, value in instance.items():
+            if key in properties:
+                errors.extend(validate(value, properties[key], f"{path}.{key}"))
+            elif additional is False:
+                errors.append(f"{path}: unknown key '{key}'")
+            elif isinstance(additional, dict):
+                errors.extend(validate(value, additional, f"{path}.{key}"))
+    return errors
+
+
+def _is_type(instance: Any, json_type: str) -> bool:
+    if json_type == "integer":
+        return isinstance(instance, int) and not isinstance(instance, bool)
+    if json_type == "number":
+        return isinstance(instance, (int, float)) and not isinstance(instance, bool)
+    return isinstance(instance, _JSON_TYPES[json_type])
+
+
+@dataclass(frozen=True)
+class CompiledPrompt:
+    """
+    Промпт, заранее разобранный на литералы и плейсхолдеры.
+    Рендер — простая склейка без повторного разбора строки.
+    """
+    source: str
+    segments: Tuple[Tuple[str, Optional[str]], ...]
+
+    @classmethod
+    def parse(cls, source: str, where: str = "prompt") -> "CompiledPrompt":
+        segments = []
+        try:
+            for literal, field_name, format_spec, conversion in string.Formatter().parse(source):
+                if field_name is not None and field_name not in PROMPT_FIELDS:
+                    raise TemplateError(f"{where}: unknown placeholder '{{{field_name}}}'. "
+                                        f"Allowed: {', '.join('{' + f + '}' for f in PROMPT_FIELDS)}")
+                if format_spec or conversion:
+                    raise TemplateError(f"{where}: format specs and conversions are not supported in placeholders")
+                segments.append((literal, field_name))
+        except ValueError as e:
+            if isinstance(e, TemplateError):
+                raise
+            raise TemplateError(f"{where}: {e} (use '{{{{' and '}}}}' for literal braces)") from e
+        return cls(source=source, segments=tuple(segments))
+
+    def render(self, clipboard_text: str = "") -> str:
+        values = {"clipboard_text": clipboard_text}
+        return "".join(literal + (values[name] if name else "") for literal, name in self.segments)
+
+
+@dataclass(frozen=True)
+class ChunkingConfig:
+    """Настройки map-reduce обработки длинного текста с подставленными значениями по умолчанию."""
+    max_tokens: int = CHUNK_MAX_TOKENS
+    mode: str = "concat"
+    parallelism: int = CHUNK_PARALLELISM
+    max_retries: int = CHUNK_MAX_RETRIES
+    reduce_prompt: Optional[CompiledPrompt] = None
+
+
+@dataclass(frozen=True)
+class IncrementalConfig:
+    """
+    Обработка текста по абзацам с кэшем каждого абзаца: повторно отправляются только новые
+    и измененные абзацы, пакетами до batch_tokens (по оценке) в одном запросе.
+    """
+    batch_tokens: int = INCREMENTAL_BATCH_TOKENS
+    parallelism: int = CHUNK_PARALLELISM
+
+
+@dataclass(frozen=True)
+class BatchingConfig:
+    """
+    Пакетная отправка: короткие задачи одного шаблона и модели, поставленные в очередь
+    в пределах window_ms, отправляются одним запросом (до max_items задач и max_tokens по оценке).
+    """
+    window_ms: int = BATCH_WINDOW_MS
+    max_items: int = BATCH_MAX_ITEMS
+    max_tokens: int = BATCH_MAX_TOKENS
+
+
+@dataclass(frozen=True)
+class HedgingConfig:
+    """
+    Запасные модели того же провайдера и задержка, после которой отправляется
+    дублирующий запрос. Если для модели накоплено min_samples ответов, задержка
+    берется как перцентиль percentile их времени; до этого — delay_ms.
+    """
+    models: Tuple[str, ...]
+    delay_ms: int = HEDGE_DELAY_MS
+    percentile: float = HEDGE_PERCENTILE
+    min_samples: int = HEDGE_MIN_SAMPLES
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """
+    Проверенный и подготовленный к выполнению шаблон.
+    Создается один раз при загрузке файла; путь запроса только рендерит готовый промпт.
+    """
+    name: str
+    description: str
+    api_provider: str
+    model: str
+    input_type: str
+    prompt: CompiledPrompt
+    cache: bool = True
+    stream: Optional[bool] = None
+    generation_config: Dict[str, Any] = field(default_factory=dict)
+    generation_config_key: str = "{}"
+    chunking: Optional[ChunkingConfig] = None
+    incremental: Optional[IncrementalConfig] = None
+    batching: Optional[BatchingConfig] = None
+    hedging: Optional[HedgingConfig] = None
+    image_pipeline: Dict[str, Any] = field(default_factory=lambda: dict(DEFAULT_IMAGE_PIPELINE))
+    source_path: Optional[str] = None
+    raw: Dict[str, Any] = field(default_factory=dict, compare=False, repr=False)
+
+    def render_prompt(self, content: Any) -> str:
+        """Формирует итоговый промпт. Для изображений плейсхолдер заменяется пустой строкой."""
+        return self.prompt.render(content if isinstance(content, str) else "")
+
+
+def compile_template(data: Any, source_path: Optional[str] = None) -> CompiledTemplate:
+    """
+    Проверяет данные шаблона по схеме и компилирует их.
+    :raises TemplateError: если шаблон некорректен.
+    """
+    errors = validate(data, TEMPLATE_SCHEMA)
+    if errors:
+        raise TemplateError("; ".join(errors))
+
+    chunking = None
+    if data.get("chunking"):
+        options = dict(data["chunking"])
+        reduce_prompt = options.pop("reduce_prompt", None)
+        chunking = ChunkingConfig(
+            **options,
+            reduce_prompt=CompiledPrompt.parse(reduce_prompt, "chunking.reduce_prompt") if reduce_prompt else None,
+        )
+
+    incremental = None
+    if data.get("incremental") not in (None, False):
+        options = data["incremental"] if isinstance(data["incremental"], dict) else {}
+        incremental = IncrementalConfig(**options)
+
+    batching = None
+    if data.get("batching") not in (None, False):
+        options = data["batching"] if isinstance(data["batching"], dict) else {}
+        batching = BatchingConfig(**options)
+
+    hedging = None
+    if data.get("hedging"):
+        options = dict(data["hedging"])
+        hedging = HedgingConfig(models=tuple(options.pop("models")), **options)
+
+    generation_config = dict(data.get("generation_config") or {})
+    return CompiledTemplate(
+        name=data["name"],
+        description=data["description"],
+        api_provider=data["api_provider"],
+        model=data["model"],
+        input_type=data["input_type"],
+        prompt=CompiledPrompt.parse(data["prompt"]),
+        cache=data.get("cache", True),
+        stream=data.get("stream"),
+        generation_config=generation_config,
+        generation_config_key=json.dumps(generation_config, sort_keys=True),
+        chunking=chunking,
+        incremental=incremental,
+        batching=batching,
+        hedging=hedging,
+        image_pipeline={**DEFAULT_IMAGE_PIPELINE, **(data.get("image_pipeline") or {})},
+        source_path=source_path,
+        raw=data,
+    )
@@ -0,0 +1,44 @@
+"""
+Структурная гарантия бюджета запуска: импорт main, разбор аргументов и импорт окна
+не загружают Gemini SDK, сервис LLM, провайдеров, очередь задач и sqlite3.
+Все это загружается в фоне после первой отрисовки.
+
+Время запуска измеряет отдельно benchmarks/bench_startup.py.
+"""
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FORBIDDEN_MODULES = ("services", "providers", "jobs", "sqlite3", "google.generativeai")
+
+_PROBE = """
+import sys, json
+%s
+print(json.dumps([m for m in %r if m in sys.modules]))
+"""
+
+
+def loaded_modules(code: str) -> list:
+    """Выполняет code в чистом процессе и возвращает загруженные им запрещенные модули."""
+    output = subprocess.run([sys.executable, "-c", _PROBE % (code, FORBIDDEN_MODULES)], cwd=ROOT,
+                            capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def test_main_and_argument_parsing_stay_light():
+    assert loaded_modules("import main\nmain._parse_args([])") == []
+
+
+def test_batch_arguments_do_not_load_cli():
+    # Подкоманда batch разбирается в main; cli импортируется, только когда она запускается
+    assert loaded_modules("import main\nmain._parse_args(['batch', 'Corrector', 'a.txt'])") == []
+
+
+def test_gui_import_stays_light():
+    pytest.importorskip("customtkinter")
+    assert loaded_modules("import main\nimport app_gui") == []
@@ -0,0 +1,159 @@
+import time
+from collections import deque
+from typing import Any, Deque, Iterator, Optional, Tuple
+
+from loguru import logger
+
+from utils import TEXT_PREVIEW_MAX_CHARS, TEXT_RENDER_BUDGET_MS, TEXT_RENDER_CHUNK_CHARS
+
+
+def preview_text(text: str, max_chars: int) -> Tuple[str, int]:
+    """
+    Обрезает текст для показа в окне. Возвращает (текст для показа, сколько символов скрыто).
+    Граница сдвигается к концу строки, если он недалеко, чтобы не резать строку посередине.
+    """
+    if max_chars <= 0 or len(text) <= max_chars:
+        return text, 0
+    cut = text.rfind("\n", max_chars - max_chars // 10, max_chars)
+    cut = cut + 1 if cut >= 0 else max_chars
+    return text[:cut], len(text) - cut
+
+
+def truncation_note(hidden_chars: Optional[int]) -> str:
+    hidden = f"{hidden_chars:,} more characters" if hidden_chars is not None else "The rest of the text is"
+    return f"\n\n[... {hidden} not shown. The full text is in the clipboard and history.]"
+
+
+def split_for_insert(text: str, chunk_chars: int) -> Iterator[str]:
+    """Делит текст на части примерно по chunk_chars символов, по возможности по концам строк."""
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + chunk_chars)
+        if end < len(text):
+            newline = text.rfind("\n", start + chunk_chars // 2, end)
+            if newline >= 0:
+                end = newline + 1
+        yield text[start:end]
+        start = end
+
+
+class ChunkedTextWriter:
+    """
+    Выводит текст в текстовое поле Tk частями через after(), не блокируя mainloop.
+    За один проход вставляется столько частей, сколько укладывается в budget_ms, остальное —
+    в следующих проходах, между которыми Tk обрабатывает события и перерисовку.
+    Текст длиннее max_chars показывается обрезанным; полный текст доступен в full_text.
+    Все методы вызываются из потока интерфейса.
+    """
+    def __init__(self, widget: Any, readonly: bool = False, max_chars: int = TEXT_PREVIEW_MAX_CHARS,
+                 chunk_chars: int = TEXT_RENDER_CHUNK_CHARS, budget_ms: float = TEXT_RENDER_BUDGET_MS):
+        self.widget = widget
+        self.readonly = readonly
+        self.max_chars = max_chars
+        self.chunk_chars = chunk_chars
+        self.budget = budget_ms / 1000
+        self.full_text = ""
+        self.hidden_chars = 0
+        self._shown_chars = 0  # Сколько символов текста (без пометки об обрезке) поставлено в вывод
+        self._pending: Deque[str] = deque()
+        self._after_id: Optional[str] = None
+        self._follow = False
+        self._locked = False  # Поле только для чтения до следующего set_text (например, изображение)
+        self._image: Optional[Any] = None  # Миниатюра в поле; Tk не держит ссылку на PhotoImage сам
+
+    @property
+    def busy(self) -> bool:
+        """Часть текста еще не выведена."""
+        return bool(self._pending)
+
+    @property
+    def truncated(self) -> bool:
+        return self.hidden_chars > 0
+
+    @property
+    def editable(self) -> bool:
+        """Показан весь текст и его можно править в поле."""
+        return not (self.readonly or self._locked or self.truncated or self.busy)
+
+    def owns(self, widget: Any) -> bool:
+        """Относится ли виджет к этому полю (CTkTextbox или вложенный tkinter.Text)."""
+        return widget is self.widget or widget is getattr(self.widget, "_textbox", None)
+
+    def set_text(self, text: str, locked: bool = False, follow: bool = False) -> None:
+        """
+        Заменяет содержимое поля. Первая часть выводится сразу, остальные — в следующих проходах.
+        locked делает поле только для чтения; follow прокручивает поле к концу по мере вывода.
+        """
+        self.cancel()
+        self.full_text = text
+        self._image = None
+        self._locked = locked
+        self._follow = follow
+        self._shown_chars = 0
+        self.hidden_chars = 0
+        self.widget.configure(state="normal")
+        self.widget.delete("1.0", "end")
+        self._enqueue(text)
+        self._render()
+
+    def set_image(self, image: Any, caption: str) -> None:
+        """Показывает миниатюру (PhotoImage) с подписью; поле только для чтения до следующего set_text."""
+        self.set_text("\n" + caption, locked=True)
+        self._image = image
+        self.widget.configure(state="normal")
+        # CTkTextbox не пробрасывает image_create, миниатюра вставляется во вложенный tkinter.Text
+        getattr(self.widget, "_textbox", self.widget).image_create("1.0", image=image)
+        self.widget.configure(state="disabled")
+
+    def append(self, text: str) -> None:
+        """Дописывает текст в конец (потоковый ответ). После max_chars текст только копится в full_text."""
+        self.full_text += text
+        self._follow = True
+        self._enqueue(text)
+        if self._after_id is None:
+            self._render()
+
+    def cancel(self) -> None:
+        """Отменяет вывод оставшихся частей."""
+        if self._after_id is not None:
+            self.widget.after_cancel(self._after_id)
+            self._after_id = None
+        self._pending.clear()
+
+    def _enqueue(self, text: str) -> None:
+        if self.truncated:
+            self.hidden_chars += len(text)
+            return
+        if self.max_chars <= 0:
+            visible, hidden = text, 0
+        elif self._shown_chars >= self.max_chars:
+            visible, hidden = "", len(text)
+        else:
+            visible, hidden = preview_text(text, self.max_chars - self._shown_chars)
+        self._shown_chars += len(visible)
+        self._pending.extend(split_for_insert(visible, self.chunk_chars))
+        if hidden:
+            self.hidden_chars = hidden
+            # При потоковом выводе итоговый размер еще неизвестен
+            self._pending.append(truncation_note(None if self._follow else hidden))
+
+    def _render(self) -> None:
+        self._after_id = None
+        if not self._pending:
+            self._finish_pass()
+            return
+        started = time.perf_counter()
+        self.widget.configure(state="normal")
+        while self._pending and time.perf_counter() - started < self.budget:
+            self.widget.insert("end", self._pending.popleft())
+        self._finish_pass()
+        if self._pending:
+            # after(1), а не after_idle: между проходами Tk успевает обработать ввод и перерисовку
+            self._after_id = self.widget.after(1, self._render)
+        elif self.truncated:
+            logger.debug(f"Showing {self._shown_chars} of {len(self.full_text)} characters in {self.widget}.")
+
+    def _finish_pass(self) -> None:
+        if self._follow:
+            self.widget.see("end")
+        self.widget.configure(state="normal" if self.editable else "disabled")
@@ -1,36 +1,156 @@
+import queue
+import inspect
 from dataclasses import dataclass
 from datetime import datetime
-from typing import Optional, Any
+from typing import Optional, Any, Callable, Dict, Sequence
+
+from loguru import logger
 
 # Константы
 APP_NAME = "AutoReclipper"
 SETTINGS_FILE = "settings.json"
 TEMPLATES_DIR = "templates"
+TEMPLATES_POLL_INTERVAL = 1.0  # Период проверки изменений в директории шаблонов, секунды
 RESOURCES_DIR = "rsc"
-HISTORY_MAX_LEN = 20
+HISTORY_MAX_LEN = 20  # Сколько последних записей показывать в выпадающем списке
+HISTORY_DB_FILE = "history.db"
+HISTORY_MAX_ENTRIES = 10000
+HISTORY_MAX_BYTES = 256 * 1024 * 1024
 GLOBAL_HOTKEY = "<ctrl>+<shift>+<space>"
 
+# Кэш ответов LLM
+CACHE_DIR = "cache"
+CACHE_MEMORY_ENTRIES = 256
+CACHE_DISK_MAX_BYTES = 50 * 1024 * 1024
+CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Хранилище изображений из буфера обмена (сжатые пиксели по хэшу, только на время сессии)
+BLOB_DIR = "blobs"
+BLOB_MEMORY_BYTES = 64 * 1024 * 1024
+BLOB_DISK_MAX_BYTES = 1024 * 1024 * 1024
+THUMBNAIL_SIZE = 160
+
+# Обработка длинных текстов по частям (map-reduce)
+CHUNK_MAX_TOKENS = 4000
+CHUNK_PARALLELISM = 4
+CHUNK_MAX_RETRIES = 2
+INCREMENTAL_BATCH_TOKENS = 2000  # Сколько новых абзацев (по оценке токенов) отправляется одним запросом
+
+# Пакетная отправка коротких задач одного шаблона
+BATCH_WINDOW_MS = 150  # Сколько первая задача пакета ждет остальные
+BATCH_MAX_ITEMS = 10
+BATCH_MAX_TOKENS = 2000
+
+# Составные шаблоны (конвейеры)
+PIPELINE_PARALLELISM = 4  # Сколько независимых шагов выполняется одновременно
+
+# Упреждающий запрос по первому копированию
+SPECULATION_MIN_CHARS = 20
+SPECULATION_MAX_CHARS = 8000
+SPECULATION_MAX_PER_MINUTE = 10
+SPECULATION_GRACE_S = 0.5  # Запас сверх окна двойного копирования на доставку события в поток интерфейса
+
+# Дублирующие запросы к запасным моделям (hedging)
+HEDGE_DELAY_MS = 2000  # Задержка, пока не накоплена статистика времени ответа
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_SAMPLES = 20
+HEDGE_LATENCY_WINDOW = 200  # Сколько последних ответов модели учитывается в перцентиле
+
+# Локальный HTTP API для редакторов и скриптов (только 127.0.0.1)
+API_PORT = 8765
+API_TOKEN_FILE = "api_token.txt"  # Создается при первом запуске, если токен не задан в настройках
+API_MAX_CONNECTIONS = 16
+API_MAX_JOBS = 8  # Сколько задач API одновременно находится в очереди JobEngine
+API_MAX_BODY_BYTES = 32 * 1024 * 1024
+
+# Профилирование работающего приложения (включается из трея, панели Stats или настройкой "profiling")
+PROFILE_DIR = "profiles"
+PROFILE_INTERVAL_MS = 10  # Период снятия стеков всех потоков
+PROFILE_TOP = 20  # Сколько строк в каждой таблице отчета
+PROFILE_MEMORY_FRAMES = 5  # Глубина стека, которую tracemalloc запоминает для каждого выделения
+PROFILE_MEMORY_INTERVAL_S = 30.0  # Период записи объема отслеживаемой памяти
+
+# Метрики этапов обработки задач
+METRICS_FILE = "metrics.json"
+METRICS_WINDOW = 500  # Сколько последних задач каждой пары шаблон/модель учитывается в перцентилях
+METRICS_DUMP_INTERVAL = 10.0  # Не чаще одного сохранения сводки в секунды
+
+# Вывод больших текстов в окне
+TEXT_PREVIEW_MAX_CHARS = 200_000  # Длиннее — в поле показывается начало, полный текст идет в буфер и историю
+TEXT_RENDER_CHUNK_CHARS = 16 * 1024
+TEXT_RENDER_BUDGET_MS = 8  # Сколько времени mainloop тратит на вставку за один проход
+
+def make_source_preview(source_content: Any) -> str:
+    """Возвращает короткий предпросмотр исходного контента для списков истории."""
+    if isinstance(source_content, str):
+        # --- ИСПРАВЛЕНИЕ: Длина предпросмотра увеличена до 50 символов ---
+        return source_content[:50].replace('\n', ' ') + '...'
+    return "[Image]"  # Предполагаем, что это изображение
+
+
 @dataclass
 class HistoryEntry:
     """
     Структура данных для хранения одной записи в истории операций.
+    В списках истории source_content и result_text не загружаются (None) —
+    полная запись читается из базы только при открытии.
     """
-    source_content: str | Any  # Текст или PIL.Image
+    source_content: Optional[str | Any]  # Текст или EncodedImage
     template_name: str
-    result_text: str
+    result_text: Optional[str]
     timestamp: datetime
+    id: Optional[int] = None
+    source_preview: str = ""
+    model: Optional[str] = None  # Модель, которая ответила; None для ответов из кэша и старых записей
+
+    def __post_init__(self) -> None:
+        if not self.source_preview and self.source_content is not None:
+            self.source_preview = make_source_preview(self.source_content)
 
     def __str__(self) -> str:
         """
         Возвращает строковое представление для отображения в ComboBox.
         """
         time_str = self.timestamp.strftime('%Y-%m-%d %H:%M')
-        
-        source_preview = ""
-        if isinstance(self.source_content, str):
-            # --- ИСПРАВЛЕНИЕ: Длина предпросмотра увеличена до 50 символов ---
-            source_preview = self.source_content[:50].replace('\n', ' ') + '...'
-        else: # Предполагаем, что это изображение
-            source_preview = "[Image]"
-
-        return f"{time_str} | {self.template_name} | {source_preview}"
\ No newline at end of file
+        return f"{time_str} | {self.template_name} | {self.source_preview}"
+
+
+def accepted_options(factory: Callable, options: Dict[str, Any], section: str,
+                     provided: Sequence[str] = ()) -> Dict[str, Any]:
+    """
+    Оставляет из раздела настроек только параметры, которые принимает factory.
+    Неизвестные ключи (опечатки, устаревшие настройки) и параметры из provided,
+    которые вызывающий передает сам, пропускаются с предупреждением в логе.
+    """
+    accepted = set(inspect.signature(factory).parameters) - set(provided)
+    ignored = sorted(set(options) - accepted)
+    if ignored:
+        logger.warning(f"Ignoring unknown '{section}' settings: {', '.join(ignored)}.")
+    return {key: value for key, value in options.items() if key in accepted}
+
+
+def percentile(values: Sequence[float], pct: float) -> float:
+    """
+    Возвращает перцентиль pct (0-100) с линейной интерполяцией. Для пустого списка — 0.0.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+class NotifyingQueue(queue.Queue):
+    """
+    Очередь, вызывающая notify после каждой вставки. Позволяет будить
+    mainloop по событию вместо периодического опроса.
+    """
+    def __init__(self, notify: Callable[[], None], maxsize: int = 0):
+        super().__init__(maxsize)
+        self._notify = notify
+
+    def put(self, item: Any, block: bool = True, timeout: Optional[float] = None) -> None:
+        super().put(item, block, timeout)
+        self._notify()